@@ -0,0 +1,100 @@
+"""Per-tile GeoTIFF write time, comparing the original tile_to_geotiff with the current one.
+
+    python benchmarks/bench_geotiff.py [--repeats 50]
+
+Run from the repository root with the package installed (pip install -e .).
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+import rasterio  # type: ignore
+from rasterio.warp import reproject, Resampling  # type: ignore
+from osm_changes.coordinates import tile_to_latlon
+from osm_changes.images import tile_to_geotiff
+from osm_changes.types import Image
+
+TILE = (32449, 21776, 16)
+
+
+def legacy_tile_to_geotiff(image: Image, x: int, y: int, z: int, filename: str):
+    """tile_to_geotiff as it was before the rewrite, kept here as the baseline"""
+    with rasterio.Env():
+        if len(image.shape) != 3:
+            image = np.expand_dims(image, axis=0)
+        else:
+            if image.shape[0] == 4:
+                image = image[:3]
+            if image.shape[2] == 3 or image.shape[2] == 1:
+                image = np.moveaxis(image, -1, 0)
+        band_count = image.shape[0]
+
+        if image.dtype == bool:
+            image = image.astype(np.uint8) * 255
+
+        dst_shape = image.shape
+        destination = image.copy()
+        src_crs = {"init": "EPSG:3857"}
+        dst_crs = {"init": "EPSG:4326"}
+
+        lat1, lon1 = tile_to_latlon(x, y, z)
+        lat2, lon2 = tile_to_latlon(x + 1, y + 1, z)
+        src_transform = rasterio.transform.from_bounds(lon1, lat2, lon2, lat1, 256, 256)  # type: ignore
+        dst_transform = rasterio.transform.from_bounds(lon1, lat2, lon2, lat1, 256, 256)  # type: ignore
+
+        reproject(
+            image,
+            destination,
+            src_transform=src_transform,
+            src_crs=src_crs,
+            dst_transform=dst_transform,
+            dst_crs=dst_crs,
+            resampling=Resampling.cubic,
+        )
+
+        with rasterio.open(  # type: ignore
+            filename,
+            "w",
+            driver="GTiff",
+            width=dst_shape[2],
+            height=dst_shape[1],
+            count=band_count,
+            dtype=image.dtype,
+            transform=dst_transform,
+            crs=dst_crs,
+        ) as dst:
+            for i in range(0, band_count):
+                dst.write(image[i], i + 1)
+
+
+def time_writer(name: str, write, mask: Image, directory: str, repeats: int) -> dict[str, float]:
+    filename = os.path.join(directory, f"{name}.tiff")
+    write(mask, *TILE, filename)  # warm up, e.g. loading the CRS database
+    start = time.perf_counter()
+    for _ in range(repeats):
+        write(mask, *TILE, filename)
+    elapsed = (time.perf_counter() - start) / repeats
+    return {"ms_per_tile": elapsed * 1000, "bytes": os.path.getsize(filename)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeats", type=int, default=50)
+    args = parser.parse_args()
+
+    mask = np.random.default_rng(0).random((256, 256)) < 0.05
+    writers = {
+        "legacy": legacy_tile_to_geotiff,
+        "EPSG:3857": lambda *a: tile_to_geotiff(*a, crs="EPSG:3857"),
+        "EPSG:4326": lambda *a: tile_to_geotiff(*a, crs="EPSG:4326"),
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        for name, write in writers.items():
+            result = time_writer(name.replace(":", "_"), write, mask, directory, args.repeats)
+            print(f"{name:>10}: {result['ms_per_tile']:7.2f} ms/tile {result['bytes']:8d} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+"""End-to-end throughput of each stage of a run, on synthetic tiles served from a local stub tile server.
+
+    python benchmarks/bench_pipeline.py [--sizes 4 8 16] [--output results.json] [--compare baseline.json]
+
+Each size is the width of a square area in tiles. Synthetic OS-style palette tiles with known new buildings
+are served over HTTP from localhost in place of the real layer_urls, then every stage is timed:
+
+    enumerate  tiles_in_bbox for the area
+    download   Downloader.download_tiles for both layers, into a SQLite tile store
+    decode     bytes_to_image, the float RGBA decode
+    detect     Detector.detect_change on the decoded images
+    detect_indexed  Detector.detect_change_in_bytes, the palette decode and lookup used by runs
+    write      tile_to_geotiff of each mask
+
+and reported as tiles per second with the peak RSS reached during the stage. The detected pixels are checked
+against the known changes. Results are saved as JSON, and --compare prints the speed-up against an earlier run.
+
+Run from the repository root with the package installed (pip install -e .).
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import tempfile
+import threading
+import time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Iterator
+import numpy as np
+from PIL import Image as PILImage  # type: ignore
+from osm_changes.config import Config
+from osm_changes.coordinates import tile_to_latlon_array, tiles_in_bbox
+from osm_changes.detector import Detector
+from osm_changes.downloader import Downloader, layer_urls
+from osm_changes.images import bytes_to_image, tile_to_geotiff
+from osm_changes.logger import logger
+from osm_changes.storage import SQLiteTileStore
+from osm_changes.types import Coordinate
+
+LAYER1 = "201610"
+LAYER2 = "202310"
+ZOOM = 16
+ORIGIN = (32449, 21776)
+
+# palette of the OS OpenData layers: background, building, text
+PALETTE = [(249, 249, 247), (248, 216, 184), (0, 0, 0)]
+
+
+@lru_cache(maxsize=None)
+def synthetic_tiles(x: int, y: int) -> tuple[bytes, bytes, int]:
+    """Before and after palette PNGs for a tile, and the number of pixels that became buildings"""
+    rng = np.random.default_rng([x, y])
+    before = np.zeros((256, 256), dtype=np.uint8)
+    for _ in range(rng.integers(5, 20)):
+        row, col = rng.integers(0, 240, size=2)
+        height, width = rng.integers(4, 16, size=2)
+        before[row : row + height, col : col + width] = 1
+    # a few labels, which never change
+    labels = np.zeros((256, 256), dtype=bool)
+    for _ in range(rng.integers(0, 4)):
+        row, col = rng.integers(0, 250, size=2)
+        labels[row : row + 3, col : col + 20] = True
+
+    after = before.copy()
+    for _ in range(rng.integers(0, 8)):
+        row, col = rng.integers(0, 240, size=2)
+        height, width = rng.integers(4, 16, size=2)
+        after[row : row + height, col : col + width] = 1
+    before[labels] = 2
+    after[labels] = 2
+    changed = int(((before == 0) & (after == 1)).sum())
+    return _palette_png(before), _palette_png(after), changed
+
+
+def _palette_png(indices: np.ndarray) -> bytes:
+    image = PILImage.fromarray(indices, mode="P")
+    image.putpalette([value for colour in PALETTE for value in colour])
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class StubTileHandler(BaseHTTPRequestHandler):
+    """Serves /<layer>/<zoom>/<x>/<y>.png from synthetic_tiles"""
+
+    def do_GET(self):
+        try:
+            layer, _, x, y = self.path.strip("/").removesuffix(".png").split("/")
+            before, after, _ = synthetic_tiles(int(x), int(y))
+            data = before if layer == LAYER1 else after
+        except ValueError:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubTileServer:
+    """A local tile server standing in for layer_urls[LAYER1] and layer_urls[LAYER2] while in use"""
+
+    def __enter__(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubTileHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        url = f"http://127.0.0.1:{self.server.server_port}"
+        self.original_urls = {layer: layer_urls[layer] for layer in (LAYER1, LAYER2)}
+        for layer in self.original_urls:
+            layer_urls[layer] = f"{url}/{layer}/"
+        return self
+
+    def __exit__(self, *args):
+        layer_urls.update(self.original_urls)
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def reset_peak_rss():
+    """Reset the peak RSS so it can be measured per stage, where the OS allows it (Linux)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # peak for the whole process, in kB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / (1024 if platform.system() == "Darwin" else 1)
+
+
+class Stage:
+    """Times the calls made inside `with stage.timed():`, e.g. only the detection and not the decode feeding it"""
+
+    def __init__(self):
+        self.seconds = 0.0
+
+    def timed(self):
+        return _Timer(self)
+
+
+class _Timer:
+    def __init__(self, stage: Stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        self.stage.seconds += time.perf_counter() - self.start
+
+
+def run_stage(name: str, n_tiles: int, func: Callable[[Stage], None]) -> dict:
+    stage = Stage()
+    reset_peak_rss()
+    func(stage)
+    result = {
+        "stage": name,
+        "tiles": n_tiles,
+        "seconds": stage.seconds,
+        "tiles_per_second": n_tiles / stage.seconds if stage.seconds > 0 else float("inf"),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    print(
+        f"{n_tiles:>6} tiles {name:>15}: {result['tiles_per_second']:10.1f} tiles/s "
+        f"{result['seconds']:8.3f} s {result['peak_rss_mb']:8.1f} MB peak RSS"
+    )
+    return result
+
+
+def benchmark_size(size: int, directory: str, download_workers: int) -> list[dict]:
+    expected_tiles = {(ORIGIN[0] + i, ORIGIN[1] + j) for i in range(size) for j in range(size)}
+    # the bounding box from the centre of the first tile to the centre of the last
+    (lat1, lat2), (lon1, lon2) = tile_to_latlon_array(
+        np.array([ORIGIN[0] + 0.5, ORIGIN[0] + size - 0.5]), np.array([ORIGIN[1] + 0.5, ORIGIN[1] + size - 0.5]), ZOOM
+    )
+    # generate the tiles up front, so the server's time isn't counted against the downloader
+    for tile in expected_tiles:
+        synthetic_tiles(*tile)
+
+    cfg = Config()
+    cfg.set_output_dir(directory)
+    cfg.zoom = ZOOM
+    cfg.download_workers = download_workers
+    cfg.download_rate_limit = 0
+    # loading the config sets the log level, keep the per-tile messages out of the timings
+    logger.setLevel("WARNING")
+    store = SQLiteTileStore(os.path.join(directory, f"tiles_{size}.sqlite"))
+    results = []
+    tiles: set[Coordinate] = set()
+
+    def enumerate_tiles(stage: Stage):
+        with stage.timed():
+            tiles.update(tiles_in_bbox(min(lat1, lat2), max(lat1, lat2), min(lon1, lon2), max(lon1, lon2), ZOOM))
+        assert tiles == expected_tiles, f"expected {len(expected_tiles)} tiles, found {len(tiles)}"
+
+    def download(stage: Stage):
+        downloader = Downloader(cfg, store=store)
+        with stage.timed():
+            for layer in (LAYER1, LAYER2):
+                downloader.set_layer(layer)
+                downloader.download_tiles(tiles)
+
+    def tile_bytes() -> Iterator[tuple[Coordinate, bytes, bytes]]:
+        for tile in sorted(tiles):
+            yield tile, store.get(LAYER1, ZOOM, *tile), store.get(LAYER2, ZOOM, *tile)  # type: ignore
+
+    def decode(stage: Stage):
+        for _, data1, data2 in tile_bytes():
+            with stage.timed():
+                bytes_to_image(data1, format="png")
+                bytes_to_image(data2, format="png")
+
+    detector = Detector(cfg, store=store)
+    detector.set_layers(LAYER1, LAYER2)
+
+    def check(changed: int):
+        expected = sum(synthetic_tiles(*tile)[2] for tile in tiles)
+        assert changed == expected, f"detected {changed} changed pixels, expected {expected}"
+
+    def detect(stage: Stage):
+        changed = 0
+        for _, data1, data2 in tile_bytes():
+            image1 = bytes_to_image(data1, format="png")
+            image2 = bytes_to_image(data2, format="png")
+            with stage.timed():
+                mask = detector.detect_change(image1, image2)
+            changed += int(mask.sum())
+        check(changed)
+
+    def detect_indexed(stage: Stage):
+        changed = 0
+        for _, data1, data2 in tile_bytes():
+            with stage.timed():
+                mask = detector.detect_change_in_bytes(data1, data2)
+            changed += int(mask.sum())
+        check(changed)
+
+    def write(stage: Stage):
+        filename = os.path.join(directory, "mask.tiff")
+        for tile, data1, data2 in tile_bytes():
+            mask = detector.detect_change_in_bytes(data1, data2)
+            with stage.timed():
+                tile_to_geotiff(mask, tile[0], tile[1], ZOOM, filename)
+
+    stages = {
+        "enumerate": enumerate_tiles,
+        "download": download,
+        "decode": decode,
+        "detect": detect,
+        "detect_indexed": detect_indexed,
+        "write": write,
+    }
+    try:
+        for name, func in stages.items():
+            results.append(run_stage(name, len(expected_tiles), func))
+    finally:
+        store.close()
+    return results
+
+
+def compare(results: list[dict], baseline: list[dict]):
+    """Print the speed-up of each stage against a baseline run"""
+    before = {(r["tiles"], r["stage"]): r for r in baseline}
+    for result in results:
+        old = before.get((result["tiles"], result["stage"]))
+        if old is None or old["seconds"] <= 0 or result["seconds"] <= 0:
+            continue
+        print(
+            f"{result['tiles']:>6} tiles {result['stage']:>15}: {old['seconds'] / result['seconds']:6.2f}x faster, "
+            f"peak RSS {result['peak_rss_mb'] - old['peak_rss_mb']:+.1f} MB"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[4, 8, 16], help="widths of the areas in tiles")
+    parser.add_argument("--download-workers", type=int, default=4)
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    results = []
+    with StubTileServer(), tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            results += benchmark_size(size, directory, args.download_workers)
+
+    report = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved results to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)["results"])
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,15 @@
 from osm_changes.logger import logger
+from osm_changes.metrics import metrics
 from osm_changes.config import Config
 from osm_changes.grid import Grid
-from osm_changes.coordinates import Coordinate, latlon_to_tile
+from osm_changes.coordinates import Coordinate
 from osm_changes.downloader import Downloader
 from osm_changes.detector import Detector
+from osm_changes.hierarchy import HierarchicalSearch
+from osm_changes.pipeline import Pipeline
+from osm_changes.storage import open_tile_store
+from osm_changes.timeseries import TimeSeriesDetector
+from osm_changes.transitions import TransitionDetector
 
 
 def main():
@@ -12,27 +18,58 @@ def main():
     # create grid
     grid = Grid(cfg)
 
-    # create a set of tiles
-    tiles: set[Coordinate] = set()
-
-    # for each point in the grid, find the tile
-    for point in grid.grid:
-        tile = latlon_to_tile(point[0], point[1], cfg.zoom)[0]
-        tiles.add(tile)
+    # find the set of tiles covering the bounding box
+    tiles: set[Coordinate] = grid.tiles()
 
     logger.info(f"Number of tiles: {len(tiles)}")
+    run(cfg, tiles)
+
+    if cfg.metrics:
+        metrics.write_json(cfg.resolve_output_path(cfg.metrics_file))
+        if cfg.prometheus_file:
+            metrics.write_prometheus(cfg.resolve_output_path(cfg.prometheus_file))
+
+
+def run(cfg: Config, tiles: set[Coordinate]) -> dict[str, int]:
+    """Download and detect changes in the tiles, returning the number of tiles with each status"""
+    # downloaded tiles are shared between the downloader and detector through the tile store
+    store = open_tile_store(cfg)
+
+    # one downloader for both layers, so they share the connection pool and rate limit
+    downloader = Downloader(cfg, store=store)
+    if cfg.layers:
+        detector: Detector = TimeSeriesDetector(cfg, store=store)
+    elif cfg.transitions:
+        detector = TransitionDetector(cfg, store=store)
+    else:
+        detector = Detector(cfg, store=store)
+
+    try:
+        searched = len(tiles)
+        if cfg.coarse_zoom is not None and cfg.coarse_zoom < cfg.zoom:
+            logger.info(f"Comparing layers from zoom {cfg.coarse_zoom} to find the tiles that may have changed")
+            tiles = HierarchicalSearch(downloader, detector, cfg.coarse_zoom).search(tiles)
+            logger.info(f"{len(tiles)} of {searched} tiles may have changed")
+
+        if cfg.pipeline:
+            logger.info("Downloading and detecting changes in tiles")
+            counts = Pipeline(cfg, store=store, downloader=downloader, detector=detector).run(tiles)
+            logger.info("Detection complete")
+        else:
+            for layer in detector.input_layers:
+                logger.info(f"Downloading tiles for layer {layer}")
+                downloader.set_layer(layer)
+                downloader.download_tiles(tiles)
+                logger.info("Layer download complete")
 
-    for layer in [cfg.layer1, cfg.layer2]:
-        logger.info(f"Downloading tiles for layer {layer}")
-        downloader = Downloader(cfg)
-        downloader.set_layer(layer)
-        downloader.download_tiles(tiles)
-        logger.info("Layer download complete")
-
-    logger.info("Detecting changes in tiles")
-    detector = Detector(cfg)
-    detector.detect_changes_in_tiles(tiles)
-    logger.info("Detection complete")
+            logger.info("Detecting changes in tiles")
+            counts = detector.detect_changes_in_tiles(tiles)
+            logger.info("Detection complete")
+    finally:
+        store.close()
+    # tiles left out by the coarse search are counted like those skipped as unchanged
+    counts["skipped"] += searched - len(tiles)
+    return counts
 
 
 if __name__ == "__main__":
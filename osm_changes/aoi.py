@@ -0,0 +1,155 @@
+"""An area of interest given as a GeoJSON polygon or multipolygon, rather than a bounding box.
+
+The polygon is projected into tile coordinates at the detection zoom, where its exact tile cover is found
+by scanline rasterization: a tile is in the cover if the polygon's boundary passes through it, or if its
+centre is inside the polygon (even-odd rule, so holes are left out). A long, thin area like a river
+corridor then only needs the tiles along it rather than every tile in its bounding box.
+
+Edges are straight lines in Web Mercator between the polygon's vertices, which for the short edges of
+real boundaries is the same as straight in lat/lon to well under a pixel.
+"""
+
+import json
+import math
+import numpy as np
+from osm_changes.coordinates import latlon_to_fractional_tile_array
+from osm_changes.types import Coordinate, Image
+
+
+class AOI:
+    """A polygon area of interest in tile coordinates at one zoom level.
+
+    :param polygons: each polygon as a list of rings, the outer ring first then any holes, with each ring
+        an array of (lon, lat) vertices as in GeoJSON
+    """
+
+    def __init__(self, polygons: list[list[Image]], zoom: int, tile_size: int = 256):
+        self.zoom = zoom
+        self.tile_size = tile_size
+        starts, ends = [], []
+        for polygon in polygons:
+            for ring in polygon:
+                ring = np.asarray(ring, dtype=np.float64)[:, :2]
+                x, y = latlon_to_fractional_tile_array(ring[:, 1], ring[:, 0], zoom)
+                points = np.column_stack([x, y])
+                # the edges of the ring, closing it if the last vertex isn't the first
+                starts.append(points)
+                ends.append(np.roll(points, -1, axis=0))
+        if not starts:
+            raise ValueError("The AOI has no polygons")
+        # each edge as (x0, y0, x1, y1), leaving out the zero length ones
+        edges = np.hstack([np.vstack(starts), np.vstack(ends)])
+        self.edges = edges[(edges[:, 0] != edges[:, 2]) | (edges[:, 1] != edges[:, 3])]
+
+    @classmethod
+    def from_geojson(cls, geojson: dict, zoom: int, **kwargs) -> "AOI":
+        """From a GeoJSON FeatureCollection, Feature or geometry, using every Polygon and MultiPolygon in it"""
+        return cls(_polygons(geojson), zoom, **kwargs)
+
+    @classmethod
+    def from_file(cls, filepath: str, zoom: int, **kwargs) -> "AOI":
+        with open(filepath) as f:
+            return cls.from_geojson(json.load(f), zoom, **kwargs)
+
+    def _edges_in_strip(self, top: float, bottom: float) -> Image:
+        """The edges that reach the horizontal strip between top and bottom, clipped to it"""
+        x0, y0, x1, y1 = self.edges.T
+        low, high = np.minimum(y0, y1), np.maximum(y0, y1)
+        # horizontal edges along the top of the strip count as in it
+        edges = self.edges[((low < bottom) & (high > top)) | ((low == high) & (low >= top) & (low < bottom))]
+        if len(edges) == 0:
+            return edges
+        x0, y0, x1, y1 = edges.T
+        horizontal = y0 == y1
+        with np.errstate(divide="ignore", invalid="ignore"):
+            slope = np.where(horizontal, 0, (x1 - x0) / (y1 - y0))
+        ya, yb = np.clip(y0, top, bottom), np.clip(y1, top, bottom)
+        xa = x0 + (ya - y0) * slope
+        xb = np.where(horizontal, x1, x0 + (yb - y0) * slope)
+        return np.column_stack([xa, ya, xb, yb])
+
+    def _spans(self, y: float, edges: Image | None = None) -> Image:
+        """The (start, end) x of each span inside the polygon along the horizontal line at y"""
+        if edges is None:
+            edges = self.edges
+        x0, y0, x1, y1 = edges.T
+        crosses = (y0 <= y) != (y1 <= y)
+        x0, y0, x1, y1 = x0[crosses], y0[crosses], x1[crosses], y1[crosses]
+        crossings = np.sort(x0 + (y - y0) * (x1 - x0) / (y1 - y0))
+        return crossings.reshape(-1, 2)
+
+    def tile_spans(self) -> dict[int, list[tuple[int, int]]]:
+        """The cover as the inclusive (first x, last x) runs of tiles in each tile row"""
+        n = 2**self.zoom
+        ys = self.edges[:, [1, 3]]
+        rows = range(max(0, math.floor(ys.min())), min(n, math.ceil(ys.max())))
+        cover: dict[int, list[tuple[int, int]]] = {}
+        for y in rows:
+            runs = []
+            # tiles the boundary passes through
+            for x0, _, x1, _ in self._edges_in_strip(y, y + 1):
+                first, last = math.floor(min(x0, x1)), math.ceil(max(x0, x1)) - 1
+                runs.append((first, max(first, last)))
+            # tiles with their centre inside
+            for start, end in self._spans(y + 0.5):
+                first, last = math.ceil(start - 0.5), math.ceil(end - 0.5) - 1
+                if last >= first:
+                    runs.append((first, last))
+            merged = _merge_runs(runs, 0, n - 1)
+            if merged:
+                cover[y] = merged
+        return cover
+
+    def tiles(self) -> set[Coordinate]:
+        """The exact tile cover of the polygon"""
+        return {
+            (x, y) for y, runs in self.tile_spans().items() for first, last in runs for x in range(first, last + 1)
+        }
+
+    def mask(self, tile: Coordinate) -> Image | None:
+        """Which pixels of a tile have their centre inside the polygon, or None if all of them do"""
+        tx, ty = int(tile[0]), int(tile[1])
+        ts = self.tile_size
+        edges = self._edges_in_strip(ty, ty + 1)
+        left, right = np.minimum(edges[:, 0], edges[:, 2]), np.maximum(edges[:, 0], edges[:, 2])
+        if not ((left < tx + 1) & (right > tx)).any():
+            # the boundary doesn't cross the tile, so it's either all inside or all outside
+            inside = any(start <= tx + 0.5 < end for start, end in self._spans(ty + 0.5, edges))
+            return None if inside else np.zeros((ts, ts), dtype=bool)
+
+        mask = np.zeros((ts, ts), dtype=bool)
+        for row in range(ts):
+            for start, end in self._spans(ty + (row + 0.5) / ts, edges):
+                first = max(0, math.ceil((start - tx) * ts - 0.5))
+                last = min(ts, math.ceil((end - tx) * ts - 0.5))
+                if last > first:
+                    mask[row, first:last] = True
+        return None if mask.all() else mask
+
+
+def _merge_runs(runs: list[tuple[int, int]], low: int, high: int) -> list[tuple[int, int]]:
+    merged: list[tuple[int, int]] = []
+    for first, last in sorted(runs):
+        first, last = max(first, low), min(last, high)
+        if last < first:
+            continue
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def _polygons(geojson: dict) -> list[list[Image]]:
+    kind = geojson.get("type")
+    if kind == "FeatureCollection":
+        return [polygon for feature in geojson["features"] for polygon in _polygons(feature)]
+    if kind == "Feature":
+        return _polygons(geojson["geometry"]) if geojson.get("geometry") else []
+    if kind == "GeometryCollection":
+        return [polygon for geometry in geojson["geometries"] for polygon in _polygons(geometry)]
+    if kind == "Polygon":
+        return [[np.asarray(ring) for ring in geojson["coordinates"]]]
+    if kind == "MultiPolygon":
+        return [[np.asarray(ring) for ring in polygon] for polygon in geojson["coordinates"]]
+    raise ValueError(f"The AOI must be made of Polygons or MultiPolygons, not {kind}")
@@ -0,0 +1,146 @@
+"""Remove small connected regions from detection masks (the equivalent of MATLAB's bwareaopen).
+
+Most of the noise in the detection masks is small specks around map labels. Cleaning each tile on its
+own would also remove real buildings that happen to be cut into small pieces by a tile edge, so
+RegionCleaner looks at each tile together with a halo taken from its neighbours: a region touching the
+tile is only removed if it is small once all of its pixels, in whichever tiles, are counted.
+"""
+
+import math
+import os
+import shutil
+import tempfile
+import zlib
+from collections import OrderedDict
+from typing import Callable
+import numpy as np
+from scipy import ndimage  # type: ignore
+from osm_changes.storage import SQLiteTileStore, TileRecord
+from osm_changes.types import Coordinate, Image
+
+
+def remove_small_regions(mask: Image, min_area: int, connectivity: int = 8, keep_border: bool = False) -> Image:
+    """Remove connected regions with fewer than min_area pixels from a boolean mask.
+
+    :param connectivity: 4 or 8 connected neighbours
+    :param keep_border: keep regions touching the edge of the mask, as they may continue beyond it
+    """
+    structure = ndimage.generate_binary_structure(2, 1 if connectivity == 4 else 2)
+    labels, n = ndimage.label(mask, structure=structure)
+    if n == 0:
+        return mask.copy()
+    sizes = np.bincount(labels.ravel(), minlength=n + 1)
+    remove = sizes < min_area
+    remove[0] = False  # the background
+    if keep_border:
+        border = np.concatenate([labels[0], labels[-1], labels[:, 0], labels[:, -1]])
+        remove[border] = False
+    return mask & ~remove[labels]
+
+
+class RegionCleaner:
+    """Removes regions smaller than min_area from a grid of tile masks, using halos from the neighbouring tiles.
+
+    A region reaching the edge of the halo stretches at least `halo` pixels from the tile, so with a halo
+    of min_area pixels it is known to be big enough and is kept without having to see all of it.
+
+    :param read_mask: returns the raw mask of a tile, or None for tiles with no mask (treated as empty)
+    :param cache_size: number of raw tile masks kept in memory. Cleaning tiles column by column (sorted by x,
+        then y) only needs the columns within the halo, so this can be small compared with the number of tiles.
+    """
+
+    def __init__(
+        self,
+        read_mask: Callable[[Coordinate], Image | None],
+        min_area: int,
+        tile_size: int = 256,
+        connectivity: int = 8,
+        cache_size: int = 1024,
+    ):
+        self.read_mask = read_mask
+        self.min_area = min_area
+        self.tile_size = tile_size
+        self.connectivity = connectivity
+        self.halo = min_area
+        # number of neighbouring tiles needed in each direction to fill the halo
+        self.rings = math.ceil(self.halo / tile_size)
+        self.cache_size = max(cache_size, (2 * self.rings + 1) ** 2)
+        self._cache: OrderedDict[Coordinate, Image | None] = OrderedDict()
+
+    def _get(self, tile: Coordinate) -> Image | None:
+        if tile in self._cache:
+            self._cache.move_to_end(tile)
+            return self._cache[tile]
+        mask = self.read_mask(tile)
+        self._cache[tile] = mask
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return mask
+
+    def window(self, tile: Coordinate) -> Image:
+        """The tile's raw mask with a halo of `halo` pixels from its neighbours"""
+        ts = self.tile_size
+        r = self.rings
+        full = np.zeros(((2 * r + 1) * ts, (2 * r + 1) * ts), dtype=bool)
+        x, y = int(tile[0]), int(tile[1])
+        for j in range(-r, r + 1):
+            for i in range(-r, r + 1):
+                mask = self._get((x + i, y + j))
+                if mask is not None:
+                    full[(j + r) * ts : (j + r + 1) * ts, (i + r) * ts : (i + r + 1) * ts] = mask
+        start = r * ts - self.halo
+        return full[start : start + ts + 2 * self.halo, start : start + ts + 2 * self.halo]
+
+    def clean(self, tile: Coordinate) -> Image:
+        if self._get(tile) is None:
+            # removing regions can't add any, so there's no need to look at the neighbours
+            return np.zeros((self.tile_size, self.tile_size), dtype=bool)
+        window = remove_small_regions(self.window(tile), self.min_area, self.connectivity, keep_border=True)
+        return window[self.halo : self.halo + self.tile_size, self.halo : self.halo + self.tile_size]
+
+
+class RawMaskWriter:
+    """Keeps the raw detection masks of a run for RegionCleaner to read back.
+
+    Masks are bit-packed and compressed into a temporary SQLite tile store, so large areas don't need to
+    fit in memory. Empty masks aren't stored at all. Call remove() once the masks are no longer needed.
+    """
+
+    layer = "raw"
+
+    def __init__(self, zoom: int, batch_size: int = 256):
+        self.zoom = zoom
+        self.batch_size = batch_size
+        self._tmpdir = tempfile.mkdtemp(prefix="osm_changes_masks_")
+        self.store = SQLiteTileStore(os.path.join(self._tmpdir, "masks.sqlite"))
+        self._batch: list[TileRecord] = []
+
+    def write_tile(self, tile: Coordinate, mask: Image):
+        if not mask.any():
+            return
+        self._batch.append((self.layer, self.zoom, int(tile[0]), int(tile[1]), pack_mask(mask)))
+        if len(self._batch) >= self.batch_size:
+            self.close()
+
+    def close(self):
+        self.store.put_many(self._batch)
+        self._batch.clear()
+
+    def read(self, tile: Coordinate) -> Image | None:
+        data = self.store.get(self.layer, self.zoom, int(tile[0]), int(tile[1]))
+        return None if data is None else unpack_mask(data)
+
+    def remove(self):
+        self.store.close()
+        shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+
+def pack_mask(mask: Image) -> bytes:
+    height, width = mask.shape
+    return np.array([height, width], dtype=">u4").tobytes() + zlib.compress(np.packbits(mask).tobytes())
+
+
+def unpack_mask(data: bytes) -> Image:
+    height, width = np.frombuffer(data[:8], dtype=">u4")
+    bits = np.unpackbits(np.frombuffer(zlib.decompress(data[8:]), dtype=np.uint8), count=int(height * width))
+    return bits.reshape(int(height), int(width)).astype(bool)
@@ -2,8 +2,16 @@
 
 import os
 from osm_changes.logger import logger, configure_logger
+from osm_changes.metrics import configure_metrics
 
-SUPPORTED_OUTPUTS = ["png", "tiff"]
+SUPPORTED_OUTPUTS = ["png", "tiff", "cog", "geojson", "gpkg"]
+# outputs written as one file per tile, the others cover the whole area in a single file
+TILE_OUTPUTS = ["png", "tiff"]
+# polygon outputs and their file extensions
+SUPPORTED_VECTOR_OUTPUTS = {"geojson": ".geojsonl", "gpkg": ".gpkg"}
+SUPPORTED_TILE_STORES = ["directory", "sqlite"]
+# CRSs 'tiff' output tiles can be written in, see images.tile_to_geotiff
+SUPPORTED_TIFF_CRS = ["EPSG:3857", "EPSG:4326"]
 
 
 class TileFilepath:
@@ -21,7 +29,7 @@ class TileFilepath:
         if self.output_dir is None or self.config_cwd is None:
             raise Exception("Filepath not initialized, use config.init_filepaths()")
 
-        if output not in SUPPORTED_OUTPUTS:
+        if output not in TILE_OUTPUTS:
             raise RuntimeError(f"Unsupported output type {output}")
 
         self.output = output
@@ -65,7 +73,7 @@ class Config:
         self.init_filepaths()
 
     def set_output_dir(self, new_output_dir: str):
-        self.output_dir = new_output_dir
+        self._output_dir = new_output_dir
         self.init_filepaths()
 
     def set_cwd(self, new_cwd: str):
@@ -89,6 +97,10 @@ class Config:
 
             self.layer1 = self.data["layer1"]
             self.layer2 = self.data["layer2"]
+            # an ordered list of layers to find when changes first happened, instead of comparing layer1 and layer2
+            self.layers: list[str] = self.data.get("layers", [])
+            # write every class-to-class transition between layer1 and layer2, instead of only initial_label -> final_label
+            self.transitions: bool = self.data.get("transitions", False)
 
             self.initial_label = self.data["initial_label"]
             self.final_label = self.data["final_label"]
@@ -101,11 +113,54 @@ class Config:
             self.min_lon = self.data["min_longitude"]
             self.max_lon = self.data["max_longitude"]
 
+            # a GeoJSON file with the polygon(s) of the area to download and detect, instead of the bounding box
+            self.aoi: str | None = self.data.get("aoi")
+            # blank out the parts of the edge tiles outside the AOI polygon
+            self.clip_to_aoi: bool = self.data.get("clip_to_aoi", False)
+
             # calculate step sizes
             self.lat_step = (self.max_lat - self.min_lat) / self.height
             self.lon_step = (self.max_lon - self.min_lon) / self.width
 
             self.output = self.data["output"]
+            # CRS of 'tiff' output tiles, EPSG:3857 writes them as they are, EPSG:4326 warps them
+            self.tiff_crs: str = self.data.get("tiff_crs", "EPSG:3857")
+            if self.tiff_crs not in SUPPORTED_TIFF_CRS:
+                raise ValueError(f"Unsupported tiff_crs {self.tiff_crs}, supported CRSs: {SUPPORTED_TIFF_CRS}")
+            # don't write output tiles where both layers are byte-identical
+            self.skip_unchanged: bool = self.data.get("skip_unchanged", False)
+            # remove changed regions smaller than this many pixels (0 keeps everything), see cleanup.py
+            self.min_area: int = self.data.get("min_area", 0)
+            self.min_area_connectivity: int = self.data.get("min_area_connectivity", 8)
+            if self.min_area_connectivity not in (4, 8):
+                raise ValueError(f"min_area_connectivity must be 4 or 8, got {self.min_area_connectivity}")
+            # find up to date outputs from a manifest of their inputs and parameters rather than by their files
+            self.manifest: bool = self.data.get("manifest", False)
+            self.manifest_path: str = self.data.get("manifest_path", "manifest.sqlite")
+            # also write the results for the whole area into one memory-mapped array, see maskarray.py
+            self.mask_array: bool = self.data.get("mask_array", False)
+            # build a pyramid of change density tiles down to pyramid_min_zoom, see pyramid.py
+            self.pyramid: bool = self.data.get("pyramid", False)
+            self.pyramid_min_zoom: int = self.data.get("pyramid_min_zoom", 8)
+
+            # detection processes, and how many tiles are sent to a process at a time
+            self.detect_workers: int = self.data.get("detect_workers", 1)
+            self.detect_chunk_size: int = self.data.get("detect_chunk_size", 16)
+
+            # compare the layers at this zoom first and only descend to the detection zoom where they differ,
+            # see hierarchy.py (None detects every tile at the detection zoom)
+            self.coarse_zoom: int | None = self.data.get("coarse_zoom")
+
+            # stream tiles through download and detection together instead of one phase after another
+            self.pipeline: bool = self.data.get("pipeline", False)
+            self.pipeline_queue_size: int = self.data.get("pipeline_queue_size", 64)
+
+            # the on-demand tile server, see server.py: where it listens, how many tiles it keeps in memory,
+            # and the directory it also caches them in
+            self.server_host: str = self.data.get("server_host", "127.0.0.1")
+            self.server_port: int = self.data.get("server_port", 8080)
+            self.server_cache_size: int = self.data.get("server_cache_size", 4096)
+            self.server_cache_dir: str = self.data.get("server_cache_dir", "server_cache")
 
             if self.output not in SUPPORTED_OUTPUTS:
                 raise RuntimeError(f"Unsupported output type {self.output}, supported types: {SUPPORTED_OUTPUTS}")
@@ -117,6 +172,46 @@ class Config:
                 os.makedirs(self._output_dir)
                 logger.info(f"Created output directory {self._output_dir}")
 
+            # download concurrency, the fallbacks here give the old one-request-at-a-time behaviour, default.json
+            # downloads 4 tiles at once at up to 8 requests a second
+            self.download_workers: int = self.data.get("download_workers", 1)
+            self.download_rate_limit: float = self.data.get("download_rate_limit", 0)
+            self.download_retries: int = self.data.get("download_retries", 0)
+            self.download_backoff: float = self.data.get("download_backoff", 0.5)
+            # longest wait between retries, however long the server's Retry-After asks for
+            self.download_max_delay: float = self.data.get("download_max_delay", 60)
+            self.download_timeout: float = self.data.get("download_timeout", 30)
+
+            # where downloaded tiles are kept, see osm_changes/storage.py
+            self.tile_store: str = self.data.get("tile_store", "directory")
+            self.tile_store_path: str = self.data.get("tile_store_path", "tiles.sqlite")
+            # seconds a stored tile of each layer stays fresh before it's revalidated with the server, layers
+            # not listed (e.g. the frozen OS archive layers) never expire
+            self.layer_max_age: dict[str, float | None] = self.data.get("layer_max_age", {"default": 86400})
+            # ETag/Last-Modified of stored tiles, kept in the tile store itself for the 'sqlite' store
+            self.tile_metadata_path: str = self.data.get("tile_metadata_path", "tile_metadata.sqlite")
+
+            # the shared queue of shards for runs split between workers, see osm_changes/shards.py
+            self.shard_queue_path: str = self.data.get("shard_queue_path", "shards.sqlite")
+            self.shard_size: int = self.data.get("shard_size", 64)
+            self.shard_lease_seconds: float = self.data.get("shard_lease_seconds", 600)
+            self.shard_max_attempts: int = self.data.get("shard_max_attempts", 3)
+
+            # per-stage timings and counters, written at the end of a run, see osm_changes/metrics.py
+            self.metrics: bool = self.data.get("metrics", False)
+            self.metrics_file: str = self.data.get("metrics_file", "metrics.json")
+            self.prometheus_file: str | None = self.data.get("prometheus_file")
+            configure_metrics(self.metrics)
+
+            if self.tile_store not in SUPPORTED_TILE_STORES:
+                raise RuntimeError(f"Unsupported tile store {self.tile_store}, supported types: {SUPPORTED_TILE_STORES}")
+
+    def resolve_output_path(self, filepath: str) -> str:
+        """Absolute path for a file given relative to the output directory"""
+        if os.path.isabs(filepath):
+            return filepath
+        return os.path.normpath(os.path.join(self._cwd, self._output_dir, filepath))
+
     def init_filepaths(self):
         TileFilepath.output_dir = self._output_dir
         TileFilepath.config_cwd = self._cwd
@@ -2,7 +2,12 @@
 Mainly the EPSG:3857 (WGS 84 / Pseudo-Mercator) tile system used by OSM and WGS84 (EPSG:4326) used by everything else.
 """
 import math
-from .types import Coordinate
+from typing import Iterator
+import numpy as np
+from .types import Coordinate, Image
+
+# half the circumference of the earth in EPSG:3857 metres, the x/y extent of the tile grid is +-this
+ORIGIN_SHIFT = 20037508.342789244
 
 
 def latlon_to_tile(lat: float, lon: float, zoom: int, img_size: int = 256) -> tuple[Coordinate, Coordinate]:
@@ -32,3 +37,146 @@ def tile_to_latlon(tile_x: int, tile_y: int, zoom: int, img_size: int = 256) ->
     lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * tile_y / n))))
 
     return lat, lon
+
+
+def tile_to_mercator(tile_x: int | float, tile_y: int | float, zoom: int) -> tuple[float, float]:
+    """Convert OSM tile coordinates to EPSG:3857 metres
+    :param tile_x: int | float
+    :param tile_y: int | float
+    :return: tuple[float, float] of (x, y) in metres
+    """
+
+    tile_size = 2 * ORIGIN_SHIFT / 2 ** zoom
+    return tile_x * tile_size - ORIGIN_SHIFT, ORIGIN_SHIFT - tile_y * tile_size
+
+
+def tile_mercator_bounds(tile_x: int, tile_y: int, zoom: int) -> tuple[float, float, float, float]:
+    """EPSG:3857 bounds of a tile
+    :param tile_x: int
+    :param tile_y: int
+    :return: tuple[float, float, float, float] of (west, south, east, north) in metres
+    """
+
+    west, north = tile_to_mercator(tile_x, tile_y, zoom)
+    east, south = tile_to_mercator(tile_x + 1, tile_y + 1, zoom)
+    return west, south, east, north
+
+
+def tile_ranges(
+    min_lat: float, max_lat: float, min_lon: float, max_lon: float, zoom: int
+) -> tuple[range, range]:
+    """Find the x and y tile ranges covering a WGS84 bounding box
+    :param min_lat: float
+    :param max_lat: float
+    :param min_lon: float
+    :param max_lon: float
+    :param zoom: int
+    :return: tuple[range, range] of (x_range, y_range), both inclusive of the edge tiles
+    """
+
+    # tile y increases southwards, so the north-west corner gives the smallest x and y
+    (x_min, y_min), _ = latlon_to_tile(max_lat, min_lon, zoom)
+    (x_max, y_max), _ = latlon_to_tile(min_lat, max_lon, zoom)
+
+    return range(int(x_min), int(x_max) + 1), range(int(y_min), int(y_max) + 1)
+
+
+def tiles_in_bbox(
+    min_lat: float, max_lat: float, min_lon: float, max_lon: float, zoom: int
+) -> Iterator[Coordinate]:
+    """Lazily yield every (x, y) tile covering a WGS84 bounding box, row by row
+    :param min_lat: float
+    :param max_lat: float
+    :param min_lon: float
+    :param max_lon: float
+    :param zoom: int
+    :return: Iterator[Coordinate]
+    """
+
+    x_range, y_range = tile_ranges(min_lat, max_lat, min_lon, max_lon, zoom)
+    for y in y_range:
+        for x in x_range:
+            yield (x, y)
+
+
+def latlon_to_tile_array(
+    lat: Image, lon: Image, zoom: int, img_size: int = 256
+) -> tuple[Image, Image, Image, Image]:
+    """Vectorised latlon_to_tile, converting arrays of lat/lon to OSM tile and pixel coordinates in one call
+    :param lat: array of latitudes
+    :param lon: array of longitudes
+    :return: tuple of int64 arrays (tile_x, tile_y, pixel_x, pixel_y)
+    """
+
+    tile_x, tile_y = latlon_to_fractional_tile_array(lat, lon, zoom)
+
+    # astype truncates towards zero, like int() in the scalar version
+    tile_x_int = tile_x.astype(np.int64)
+    tile_y_int = tile_y.astype(np.int64)
+    # np.rint rounds half to even, like round() in the scalar version
+    pixel_x = np.rint((tile_x - tile_x_int) * img_size).astype(np.int64)
+    pixel_y = np.rint((tile_y - tile_y_int) * img_size).astype(np.int64)
+
+    return tile_x_int, tile_y_int, pixel_x, pixel_y
+
+
+def latlon_to_fractional_tile_array(lat: Image, lon: Image, zoom: int) -> tuple[Image, Image]:
+    """Convert arrays of lat/lon to tile coordinates, keeping the position inside the tile as the fractional part
+    :param lat: array of latitudes
+    :param lon: array of longitudes
+    :return: tuple of float64 arrays (tile_x, tile_y)
+    """
+
+    lat_rad = np.radians(np.asarray(lat, dtype=np.float64))
+    n = 2 ** zoom
+    tile_x = (np.asarray(lon, dtype=np.float64) + 180) / 360 * n
+    tile_y = (1 - np.log(np.tan(lat_rad) + 1 / np.cos(lat_rad)) / np.pi) / 2 * n
+
+    return tile_x, tile_y
+
+
+def tile_to_latlon_array(tile_x: Image, tile_y: Image, zoom: int) -> tuple[Image, Image]:
+    """Vectorised tile_to_latlon. Fractional tile coordinates give positions inside the tile.
+    :param tile_x: array of tile x coordinates
+    :param tile_y: array of tile y coordinates
+    :return: tuple of float64 arrays (lat, lon)
+    """
+
+    n = 2 ** zoom
+    lon = np.asarray(tile_x, dtype=np.float64) / n * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.asarray(tile_y, dtype=np.float64) / n))))
+
+    return lat, lon
+
+
+def pixel_to_latlon_array(
+    tile_x: Image, tile_y: Image, pixel_x: Image, pixel_y: Image, zoom: int, img_size: int = 256
+) -> tuple[Image, Image]:
+    """Convert pixel offsets within tiles to lat/lon, e.g. for the pixels of a detection mask
+    :param tile_x: array of tile x coordinates
+    :param tile_y: array of tile y coordinates
+    :param pixel_x: array of pixel column offsets within the tile
+    :param pixel_y: array of pixel row offsets within the tile
+    :return: tuple of float64 arrays (lat, lon)
+    """
+
+    return tile_to_latlon_array(
+        np.asarray(tile_x) + np.asarray(pixel_x) / img_size,
+        np.asarray(tile_y) + np.asarray(pixel_y) / img_size,
+        zoom,
+    )
+
+
+def tile_bounds_array(tile_x: Image, tile_y: Image, zoom: int) -> tuple[Image, Image, Image, Image]:
+    """WGS84 bounds of arrays of tiles
+    :param tile_x: array of tile x coordinates
+    :param tile_y: array of tile y coordinates
+    :return: tuple of float64 arrays (west, south, east, north)
+    """
+
+    tile_x = np.asarray(tile_x)
+    tile_y = np.asarray(tile_y)
+    north, west = tile_to_latlon_array(tile_x, tile_y, zoom)
+    south, east = tile_to_latlon_array(tile_x + 1, tile_y + 1, zoom)
+
+    return west, south, east, north
@@ -0,0 +1,40 @@
+"""Per-tile count tables, streamed to a CSV file as tiles are processed."""
+
+import csv
+import os
+from typing import Callable
+from osm_changes.types import Coordinate, Image
+from osm_changes.logger import logger
+
+
+class TileCountsWriter:
+    """Writes one CSV row of counts per tile, e.g. the number of pixels in each class of a raster.
+
+    :param filepath: the CSV file, overwritten when the writer is created
+    :param columns: names of the count columns, after the tile x and y
+    :param count: function returning the counts of a tile's raster, one per column
+    """
+
+    def __init__(self, filepath: str, columns: list[str], count: Callable[[Image], list[int]]):
+        self.filepath = filepath
+        self.count = count
+        os.makedirs(os.path.dirname(os.path.abspath(filepath)), exist_ok=True)
+        self._file = open(filepath, "w", newline="")
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(["x", "y"] + columns)
+
+    def write_tile(self, tile: Coordinate, mask: Image):
+        self._writer.writerow([int(tile[0]), int(tile[1])] + [int(n) for n in self.count(mask)])
+
+    def close(self):
+        logger.info(f"Saved tile counts to {self.filepath}")
+        self._file.close()
+
+
+def read_tile_counts(filepath: str) -> dict[Coordinate, dict[str, int]]:
+    """Read a CSV written by TileCountsWriter back into {(x, y): {column: count}}"""
+    with open(filepath, newline="") as f:
+        return {
+            (int(row.pop("x")), int(row.pop("y"))): {column: int(n) for column, n in row.items()}
+            for row in csv.DictReader(f)
+        }
@@ -1,13 +1,34 @@
 """ Takes two images and detects a given change between them. """
 
 from osm_changes.types import Color, Image, Coordinate
-from osm_changes.config import Config, TileFilepath, SUPPORTED_OUTPUTS
-from osm_changes.images import bytes_to_image
+from osm_changes.config import Config, TileFilepath, SUPPORTED_OUTPUTS, SUPPORTED_VECTOR_OUTPUTS, TILE_OUTPUTS
+from osm_changes.images import bytes_to_image, bytes_to_indexed, png_size
+from osm_changes.storage import TileStore, open_tile_store, tile_hash
 import osm_changes.display
 from osm_changes.logger import logger
+from osm_changes.metrics import metrics
+from typing import Iterator, Protocol, TYPE_CHECKING
 import numpy as np
+import math
 import os
 
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+    from osm_changes.aoi import AOI
+    from osm_changes.cleanup import RawMaskWriter
+    from osm_changes.manifest import RunManifest
+
+# (tile, status, error message, mask) for each processed tile
+TileResult = tuple[Coordinate, str, str | None, Image | None]
+
+
+class MaskSink(Protocol):
+    """An output that is sent the detection mask of every tile, e.g. a mosaic covering the whole area"""
+
+    def write_tile(self, tile: Coordinate, mask: Image) -> None: ...
+
+    def close(self) -> None: ...
+
 
 def normalize_difference(x: float | Image) -> float | Image:
     return x / 2 + 0.5
@@ -25,23 +46,67 @@ class Detector:
         "Text": (0.0, 0.0, 0.0),
     }
 
+    # per-channel tolerance used when matching pixels to class_colors
+    class_tolerance: float = 0.1
+
+    # whether the outputs are boolean masks that small regions can be removed from, see min_area
+    supports_cleanup: bool = True
+
     def __init__(
         self,
         config: Config,
         overwrite: bool = False,
+        store: TileStore | None = None,
     ) -> None:
+        self.config = config
         self.zoom = config.zoom
         self.overwrite = overwrite
+        # where the downloaded tiles are read from
+        self.store: TileStore = store if store is not None else open_tile_store(config)
         self.output = config.output
+        self.tiff_crs: str = config.tiff_crs
+        # don't write an output tile at all when both input tiles are byte-identical
+        self.skip_unchanged: bool = config.skip_unchanged
+        # number of processes used by detect_changes_in_tiles, and tiles sent to a process at a time
+        self.workers: int = config.detect_workers
+        self.chunk_size: int = config.detect_chunk_size
+        # whether process_tile hands back its mask, set when outputs covering the whole area are open
+        self.return_masks = False
+        # whether process_tile writes the per-tile outputs, unset while collecting masks to clean up
+        self.write_outputs = True
+        # changed regions smaller than this many pixels are removed, 0 keeps everything
+        self.min_area: int = config.min_area
+        self.min_area_connectivity: int = config.min_area_connectivity
+        # the outputs are clipped to the AOI polygon when set
+        self.aoi: "AOI | None" = None
+        if config.aoi and config.clip_to_aoi:
+            from osm_changes.aoi import AOI
+
+            self.aoi = AOI.from_file(config.aoi, self.zoom)
+        # whether existing outputs are found from the run manifest's fingerprints rather than by their files
+        self.use_manifest: bool = config.manifest and self.output in TILE_OUTPUTS
+        # the manifest and the hashes of each tile's inputs, only set in the parent process during a run
+        self.manifest: "RunManifest | None" = None
+        self.input_hashes: dict[Coordinate, list[str | None]] = {}
 
         if self.output not in SUPPORTED_OUTPUTS:
             raise RuntimeError(f"Unsupported output type {self.output}")
 
+        # palette -> label lookup tables, tiles from one layer usually share a palette
+        self._lut_cache: dict[tuple[bytes, str], Image] = {}
+
         self.initial_label = ""
         self.final_label = ""
         self.set_layers(config.layer1, config.layer2)
         self.set_target(config.initial_label, config.final_label)
 
+    def __getstate__(self):
+        # worker processes never use the manifest, and its connection can't be pickled
+        state = self.__dict__.copy()
+        state["manifest"] = None
+        state["input_hashes"] = {}
+        return state
+
     def update_layer_name(self) -> None:
         self.layerName = f"{self.layer1}To{self.layer2}Detected{self.initial_label}To{self.final_label}"
 
@@ -112,8 +177,10 @@ class Detector:
         return mask
 
     def color_mask(
-        self, mask: Image, color: Color | str, tolerance: float = 0.1
+        self, mask: Image, color: Color | str, tolerance: float | None = None
     ) -> Image:
+        if tolerance is None:
+            tolerance = self.class_tolerance
         if isinstance(color, str):
             if color in self.class_colors:
                 color = self.class_colors[color]
@@ -134,54 +201,495 @@ class Detector:
 
     def detect_change(self, img1: Image, img2: Image):
         """A more robust methods if to find where the pixel is type A in the first image and type B in the second image"""
-        mask1 = self.color_mask(img1, self.initial_label)
-        mask2 = self.color_mask(img2, self.final_label)
-        mask = mask1 & mask2
+        with metrics.timer("detect"):
+            mask1 = self.color_mask(img1, self.initial_label)
+            mask2 = self.color_mask(img2, self.final_label)
+            mask = mask1 & mask2
         return mask
 
-    def detect_changes_in_tiles(self, tiles: set[Coordinate]):
-        for tile in tiles:
-            new_filepath = TileFilepath(
-                self.layerName, tile[0], tile[1], self.zoom, output=self.output
-            )()
-            if not self.overwrite and os.path.exists(new_filepath):
-                logger.debug(f"File {new_filepath} already exists, skipping")
-                continue
-            # make output directory if it does not exist
-            os.makedirs(os.path.dirname(new_filepath), exist_ok=True)
-            detection_mask = self.detect_changes_in_tile(tile)
-            logger.info(f"Saving detection mask to {new_filepath}")
-
-            # save the detection mask
-            if self.output == "png":
-                from matplotlib.pyplot import imsave  # type: ignore
-
-                imsave(new_filepath, detection_mask, cmap="gray")
-            elif self.output == "tiff":
-                from osm_changes.images import tile_to_geotiff
-
-                tile_to_geotiff(
-                    detection_mask, int(tile[0]), int(tile[1]), self.zoom, new_filepath
+    def labels_are_disjoint(self) -> bool:
+        """True if no pixel colour can match both the initial and final label.
+        When this holds, two identical tiles cannot contain a change."""
+        color1 = self.class_colors[self.initial_label]
+        color2 = self.class_colors[self.final_label]
+        return any(abs(a - b) >= 2 * self.class_tolerance for a, b in zip(color1, color2))
+
+    def tiles_unchanged(self, data1: bytes, data2: bytes) -> bool:
+        """Check whether the raw tile bytes show that there can't be a change, without decoding them"""
+        return data1 == data2 and self.labels_are_disjoint()
+
+    def palette_lut(self, palette: Image, label: str) -> Image:
+        """Boolean lookup table of which palette entries match a label, using the same test as color_mask"""
+        key = (palette.tobytes(), label)
+        lut = self._lut_cache.get(key)
+        if lut is None:
+            if len(self._lut_cache) > 1024:
+                self._lut_cache.clear()
+            # scale the palette the same way matplotlib's imread does, so results match the float decode
+            colours = np.divide(palette[np.newaxis, :, :3], 255, dtype=np.float32)
+            lut = self.color_mask(colours, label)[0]
+            self._lut_cache[key] = lut
+        return lut
+
+    def classify_indexed(self, indices: Image, palette: Image, label: str) -> Image:
+        """Mask of the pixels matching a label, as a single gather through the palette lookup table"""
+        return self.palette_lut(palette, label)[indices]
+
+    def classify_all_indexed(self, indices: Image, palette: Image) -> Image:
+        """Index into class_colors of the first class each pixel matches, or len(class_colors) if none, as uint8"""
+        labels = list(self.class_colors)
+        classes = np.full(len(palette), len(labels), dtype=np.uint8)
+        # go backwards so earlier classes win where colours overlap
+        for i in reversed(range(len(labels))):
+            classes[self.palette_lut(palette, labels[i])] = i
+        return classes[indices]
+
+    def detect_change_indexed(self, indexed1: tuple[Image, Image], indexed2: tuple[Image, Image]) -> Image:
+        """detect_change for images decoded with bytes_to_indexed"""
+        with metrics.timer("detect"):
+            mask1 = self.classify_indexed(*indexed1, self.initial_label)
+            mask2 = self.classify_indexed(*indexed2, self.final_label)
+            return mask1 & mask2
+
+    def detect_changes_in_tiles(self, tiles: set[Coordinate], workers: int | None = None):
+        """Detect changes in every tile and save the outputs.
+
+        Tiles are processed in sorted order, in a pool of `workers` processes when workers > 1.
+        A tile that fails is logged and counted, and the rest of the run carries on.
+        """
+        if workers is None:
+            workers = self.workers
+        # sort so runs are deterministic whatever order the set iterates in
+        ordered_tiles = sorted((int(tile[0]), int(tile[1])) for tile in tiles)
+        counts = {"processed": 0, "unchanged": 0, "missing": 0, "skipped": 0, "existing": 0, "failed": 0}
+        self.open_manifest(ordered_tiles)
+        try:
+            if self.manifest is not None and not self.cleans_regions:
+                # the workers don't see the manifest, so leave out the tiles that are up to date here
+                todo = [tile for tile in ordered_tiles if not self.output_exists(tile)]
+                counts["existing"] = len(ordered_tiles) - len(todo)
+                ordered_tiles = todo
+            self._detect_ordered_tiles(ordered_tiles, workers, counts)
+        finally:
+            self.close_manifest()
+
+        self.log_counts(counts)
+        return counts
+
+    def _detect_ordered_tiles(self, ordered_tiles: list[Coordinate], workers: int, counts: dict[str, int]):
+        if self.cleans_regions:
+            # collect the raw masks first, and only write the outputs once they've been cleaned up
+            raw_masks = self.start_cleanup()
+            sinks: list[MaskSink] = [raw_masks]
+        else:
+            # outputs covering the whole area are written here, from the masks the workers send back
+            sinks = self.open_sinks(ordered_tiles)
+            self.return_masks = len(sinks) > 0
+
+        if workers <= 1:
+            results = map(self.try_process_tile, ordered_tiles)
+        else:
+            results = self._process_tiles_in_pool(ordered_tiles, workers)
+
+        self.failed_tiles: list[tuple[Coordinate, str]] = []
+        # tiles with an output to write after cleaning up, and their status
+        detected: dict[Coordinate, str] = {}
+        try:
+            for tile, status, error, mask in results:
+                counts[status] += 1
+                if error is not None:
+                    logger.error(f"Failed to detect changes in tile {self.zoom}/{tile[0]}/{tile[1]}: {error}")
+                    self.failed_tiles.append((tile, error))
+                if status in ("processed", "unchanged", "missing"):
+                    detected[tile] = status
+                if mask is not None:
+                    self.write_sinks(sinks, tile, mask)
+                if not self.cleans_regions:
+                    self.record_output(tile, status)
+        finally:
+            for sink in sinks:
+                sink.close()
+
+        if self.cleans_regions:
+            for tile in self.finish_cleanup(raw_masks, list(detected)):
+                counts[detected[tile]] -= 1
+                counts["existing"] += 1
+
+    @property
+    def cleans_regions(self) -> bool:
+        return self.min_area > 0 and self.supports_cleanup
+
+    def start_cleanup(self) -> "RawMaskWriter":
+        """Set up the detector to hand back raw masks without writing any outputs, for finish_cleanup"""
+        from osm_changes.cleanup import RawMaskWriter
+
+        self.write_outputs = False
+        self.return_masks = True
+        return RawMaskWriter(self.zoom)
+
+    def finish_cleanup(self, raw_masks: "RawMaskWriter", tiles: list[Coordinate]) -> list[Coordinate]:
+        """Remove regions smaller than min_area from the raw masks and write the outputs of `tiles`.
+
+        Regions crossing tile edges are measured across the neighbouring tiles, see RegionCleaner.
+        Only the masks of this run are used, tiles outside it count as empty.
+
+        :return: the tiles whose output already existed and was kept
+        """
+        from osm_changes.cleanup import RegionCleaner
+
+        self.write_outputs = True
+        self.return_masks = False
+        cleaner = RegionCleaner(raw_masks.read, self.min_area, connectivity=self.min_area_connectivity)
+        # go column by column, so the neighbours in the halo are still cached from the previous tiles
+        tiles = sorted(tiles)
+        sinks = self.open_sinks(tiles)
+        existing = []
+        try:
+            for tile in tiles:
+                if self.output_exists(tile):
+                    existing.append(tile)
+                    continue
+                # the raw masks were clipped when they were detected, and removing regions keeps them clipped
+                mask = cleaner.clean(tile)
+                new_filepath = self.output_filepath(tile)
+                if new_filepath is not None:
+                    self.save_mask(mask, tile, new_filepath)
+                self.write_sinks(sinks, tile, mask)
+                self.record_output(tile, "processed")
+        finally:
+            for sink in sinks:
+                sink.close()
+            raw_masks.remove()
+        return existing
+
+    def clip(self, tile: Coordinate, output: Image) -> Image:
+        """Replace the parts of a tile's output outside the AOI with empty_mask(), when clipping to the AOI.
+        Done once where the output is detected, so save_mask and the sinks are given the clipped output."""
+        if self.aoi is None:
+            return output
+        inside = self.aoi.mask(tile)
+        if inside is None:
+            return output
+        return np.where(inside, output, self.empty_mask())
+
+    def write_sinks(self, sinks: list[MaskSink], tile: Coordinate, mask: Image):
+        with metrics.timer(f"write_{self.output}"):
+            for sink in sinks:
+                sink.write_tile(tile, mask)
+
+    def log_counts(self, counts: dict[str, int]):
+        for status, n in counts.items():
+            metrics.count(f"tiles_{status}", n)
+        logger.info(
+            f"Detection finished: {counts['processed']} tiles processed, "
+            f"{counts['unchanged'] + counts['skipped']} identical tiles not decoded "
+            f"({counts['skipped']} of them not written), {counts['missing']} tiles not available from the server, "
+            f"{counts['existing']} existing outputs skipped, "
+            f"{counts['failed']} failed"
+        )
+
+    def open_sinks(self, tiles: list[Coordinate]) -> list[MaskSink]:
+        """Outputs that take every tile's mask in the parent process, rather than a file per tile"""
+        sinks: list[MaskSink] = []
+        if not tiles:
+            return sinks
+        if self.output == "cog":
+            from osm_changes.mosaic import MosaicWriter
+
+            # codes and layer indices are only meaningful as they are, so their overviews pick a pixel
+            resampling = "average" if self.empty_mask().dtype == bool else "nearest"
+            sinks.append(MosaicWriter.for_tiles(self.mosaic_filepath(), tiles, self.zoom, resampling=resampling))
+        elif self.output in SUPPORTED_VECTOR_OUTPUTS:
+            from osm_changes.vector import VectorWriter
+
+            filepath = self.config.resolve_output_path(self.layerName + SUPPORTED_VECTOR_OUTPUTS[self.output])
+            sinks.append(VectorWriter(filepath, self.zoom, output=self.output, connectivity=self.min_area_connectivity))
+        if self.config.mask_array:
+            from osm_changes.maskarray import MaskArray
+
+            # boolean masks are bit-packed, codes kept a byte per pixel
+            filepath = self.config.resolve_output_path(f"{self.layerName}.npy")
+            sinks.append(MaskArray.for_tiles(filepath, tiles, self.zoom, packed=self.empty_mask().dtype == bool))
+        if self.config.pyramid:
+            from osm_changes.pyramid import PyramidWriter
+
+            sinks.append(
+                PyramidWriter(
+                    f"{self.layerName}Density", self.zoom, self.config.pyramid_min_zoom, to_mask=self.change_mask
                 )
-            else:
-                raise RuntimeError(f"Unknown output type {self.output}")
+            )
+        return sinks
 
-    def detect_changes_in_tile(self, tile: Coordinate):
-        fp1 = TileFilepath(self.layer1, tile[0], tile[1], self.zoom)()
-        fp2 = TileFilepath(self.layer2, tile[0], tile[1], self.zoom)()
+    def change_mask(self, output: Image) -> Image:
+        """The pixels of a tile's output that changed, e.g. for the pyramid"""
+        return output
+
+    def mosaic_filepath(self) -> str:
+        return self.config.resolve_output_path(f"{self.layerName}.tif")
+
+    def process_pool(self, workers: int) -> "ProcessPoolExecutor":
+        """A process pool whose workers each hold a copy of this detector, see _process_chunk and _process_tile_data"""
+        from concurrent.futures import ProcessPoolExecutor
 
-        # check if the files exist
-        if not os.path.exists(fp1) or not os.path.exists(fp2):
+        return ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(self, TileFilepath.output_dir, TileFilepath.config_cwd, metrics.enabled),
+        )
+
+    def _process_tiles_in_pool(self, tiles: list[Coordinate], workers: int) -> Iterator[TileResult]:
+        # workers are sent tile coordinates only, and read the tiles from the store themselves
+        chunks = [tiles[i : i + self.chunk_size] for i in range(0, len(tiles), self.chunk_size)]
+        with self.process_pool(workers) as pool:
+            # map returns the chunks in order, keeping the output deterministic
+            for chunk_results, worker_metrics in pool.map(_process_chunk, chunks):
+                metrics.merge(worker_metrics)
+                yield from chunk_results
+
+    def try_process_tile(self, tile: Coordinate, data: list[bytes | None] | None = None) -> TileResult:
+        """process_tile, or process_read_tiles if the tiles have already been read,
+        returning (tile, "failed", error, None) instead of raising"""
+        try:
+            if data is None:
+                status, mask = self.process_tile(tile)
+            else:
+                status, mask = self.process_read_tiles(tile, data)
+            return tile, status, None, mask
+        except Exception as e:
+            return tile, "failed", f"{type(e).__name__}: {e}", None
+
+    def output_filepath(self, tile: Coordinate) -> str | None:
+        """The output file of a tile, or None when the output covers the whole area"""
+        if self.output not in TILE_OUTPUTS or not self.write_outputs:
+            return None
+        return TileFilepath(self.layerName, tile[0], tile[1], self.zoom, output=self.output)()
+
+    def output_exists(self, tile: Coordinate) -> bool:
+        """True if the tile's output has already been written and shouldn't be overwritten"""
+        new_filepath = self.output_filepath(tile)
+        if self.overwrite or new_filepath is None:
+            return False
+        if self.use_manifest:
+            # the manifest is only open in the parent process, which checks it before handing out tiles
+            return self.manifest is not None and self.manifest.is_current(tile, self.fingerprint(tile))
+        if not os.path.exists(new_filepath):
+            return False
+        logger.debug(f"File {new_filepath} already exists, skipping")
+        return True
+
+    def parameters(self) -> dict:
+        """Everything besides the input tiles that the outputs depend on, for the run manifest"""
+        return {
+            "detector": type(self).__name__,
+            "layers": self.input_layers,
+            "labels": [self.initial_label, self.final_label],
+            "class_colors": self.class_colors,
+            "class_tolerance": self.class_tolerance,
+            "output": self.output,
+            "tiff_crs": self.tiff_crs,
+            "skip_unchanged": self.skip_unchanged,
+            "aoi": None if self.aoi is None else tile_hash(self.aoi.edges.tobytes()),
+            "min_area": self.min_area if self.cleans_regions else 0,
+            "min_area_connectivity": self.min_area_connectivity,
+        }
+
+    def open_manifest(self, tiles: list[Coordinate] | None = None):
+        """Open the run manifest when use_manifest is set, hashing the stored inputs of `tiles`.
+        Tiles whose inputs aren't hashed here, e.g. because they are about to be downloaded, can be
+        added to input_hashes later with hash_inputs."""
+        if not self.use_manifest:
+            return
+        from osm_changes.manifest import RunManifest
+
+        filepath = self.config.resolve_output_path(self.config.manifest_path)
+        self.manifest = RunManifest(filepath, self.layerName, self.zoom, self.parameters())
+        for tile in tiles or []:
+            self.input_hashes[tile] = [
+                self.store.get_hash(layer, self.zoom, tile[0], tile[1]) or self._missing_hash(layer, tile)
+                for layer in self.input_layers
+            ]
+
+    def _missing_hash(self, layer: str, tile: Coordinate) -> str | None:
+        from osm_changes.manifest import MISSING
+
+        return MISSING if self.store.is_missing(layer, self.zoom, tile[0], tile[1]) else None
+
+    def hash_inputs(self, tile: Coordinate, data: list[bytes | None]):
+        """Add the hashes of a tile's inputs, already read, to input_hashes"""
+        from osm_changes.manifest import MISSING
+
+        self.input_hashes[tile] = [MISSING if tile_data is None else tile_hash(tile_data) for tile_data in data]
+
+    def close_manifest(self):
+        if self.manifest is not None:
+            self.manifest.close()
+        self.manifest = None
+        self.input_hashes = {}
+
+    def fingerprint(self, tile: Coordinate) -> str | None:
+        """The fingerprint of a tile's inputs and the parameters, see RunManifest.
+
+        When small regions are removed, the output also depends on the neighbouring tiles within the
+        cleanup halo, so their inputs are included too, with tiles outside the run counting as empty.
+        """
+        assert self.manifest is not None
+        x, y = int(tile[0]), int(tile[1])
+        if (x, y) not in self.input_hashes:
+            return None
+        if not self.cleans_regions:
+            return self.manifest.fingerprint(self.input_hashes[(x, y)])
+        rings = math.ceil(self.min_area / 256)
+        hashes: list[str | None] = []
+        for i in range(-rings, rings + 1):
+            for j in range(-rings, rings + 1):
+                hashes += self.input_hashes.get((x + i, y + j), ["-"])
+        return self.manifest.fingerprint(hashes)
+
+    def record_output(self, tile: Coordinate, status: str):
+        """Record a tile's fingerprint in the manifest once its output has been written, or skipped"""
+        if self.manifest is not None and status in ("processed", "unchanged", "missing", "skipped"):
+            self.manifest.record(tile, self.fingerprint(tile))
+
+    def process_tile(self, tile: Coordinate) -> tuple[str, Image | None]:
+        """Detect changes in a tile and save the output.
+
+        :return: (status, mask) where status is "existing" if the output already existed, "skipped" if the
+            input tiles were identical and nothing was written, "unchanged" if they were identical and an
+            empty mask was written, "missing" if the server has no tile for one of the layers and an empty
+            mask was written, otherwise "processed". The mask is only returned when return_masks is set.
+        """
+        if self.output_exists(tile):
+            return "existing", None
+        return self.process_read_tiles(tile, self.read_tiles(tile))
+
+    def process_read_tiles(self, tile: Coordinate, data: list[bytes | None]) -> tuple[str, Image | None]:
+        """process_tile_data, or an empty output where a layer has no tile"""
+        if any(tile_data is None for tile_data in data):
+            mask = self.empty_mask()
+            new_filepath = self.output_filepath(tile)
+            if new_filepath is not None:
+                self.save_mask(mask, tile, new_filepath)
+            return "missing", mask if self.return_masks else None
+        return self.process_tile_data(tile, data)  # type: ignore
+
+    def empty_mask(self) -> Image:
+        """The output for a tile where nothing could be detected"""
+        return np.zeros((256, 256), dtype=bool)
+
+    def process_tile_data(self, tile: Coordinate, data: list[bytes]) -> tuple[str, Image | None]:
+        """process_tile for tiles already read from each of input_layers"""
+        return self.process_tile_bytes(tile, *data)
+
+    def process_tile_bytes(self, tile: Coordinate, data1: bytes, data2: bytes) -> tuple[str, Image | None]:
+        """process_tile for tiles that have already been read, without checking for existing output"""
+        if self.tiles_unchanged(data1, data2):
+            if self.skip_unchanged:
+                logger.debug(f"Tiles for {tile} are identical, skipping")
+                return "skipped", None
+            detection_mask = np.zeros(png_size(data1)[::-1], dtype=bool)
+            status = "unchanged"
+        else:
+            detection_mask = self.clip(tile, self.detect_change_in_bytes(data1, data2))
+            status = "processed"
+
+        new_filepath = self.output_filepath(tile)
+        if new_filepath is not None:
+            self.save_mask(detection_mask, tile, new_filepath)
+        return status, detection_mask if self.return_masks else None
+
+    def save_mask(self, detection_mask: Image, tile: Coordinate, new_filepath: str):
+        with metrics.timer(f"write_{self.output}"):
+            self._save_mask(detection_mask, tile, new_filepath)
+
+    def _save_mask(self, detection_mask: Image, tile: Coordinate, new_filepath: str):
+        # make output directory if it does not exist
+        os.makedirs(os.path.dirname(new_filepath), exist_ok=True)
+        logger.info(f"Saving detection mask to {new_filepath}")
+
+        # save the detection mask
+        if self.output == "png" and detection_mask.dtype != bool:
+            # rasters of codes or indices are saved as they are, rather than scaled through a colour map
+            from PIL import Image as PILImage  # type: ignore
+
+            PILImage.fromarray(detection_mask.astype(np.uint8), mode="L").save(new_filepath)
+        elif self.output == "png":
+            from matplotlib.pyplot import imsave  # type: ignore
+
+            imsave(new_filepath, detection_mask, cmap="gray")
+        elif self.output == "tiff":
+            from osm_changes.images import tile_to_geotiff
+
+            tile_to_geotiff(
+                detection_mask, int(tile[0]), int(tile[1]), self.zoom, new_filepath, crs=self.tiff_crs
+            )
+        else:
+            raise RuntimeError(f"Unknown output type {self.output}")
+
+    @property
+    def input_layers(self) -> list[str]:
+        """The layers read for each tile, in order"""
+        return [self.layer1, self.layer2]
+
+    def read_tiles(self, tile: Coordinate) -> list[bytes | None]:
+        """Read the raw bytes of a tile from each of input_layers, None where the server is known to have no tile"""
+        layer_data = [
+            (layer, self.store.get(layer, self.zoom, int(tile[0]), int(tile[1])))
+            for layer in self.input_layers
+        ]
+
+        # check the tiles have been downloaded
+        missing = [
+            f"{layer}/{self.zoom}/{tile[0]}/{tile[1]}"
+            for layer, data in layer_data
+            if data is None and not self.store.is_missing(layer, self.zoom, int(tile[0]), int(tile[1]))
+        ]
+        if missing:
             raise FileNotFoundError(
-                f"Files not found, please download the tiles first using e.g. the downloader.py or main script:\n{fp1}\n{fp2}"
+                "Tiles not found, please download the tiles first using e.g. the downloader.py or main script:\n"
+                + "\n".join(missing)
             )
+        return [data for _, data in layer_data]
+
+    def detect_change_in_bytes(self, data1: bytes, data2: bytes) -> Image:
+        return self.detect_change_indexed(bytes_to_indexed(data1), bytes_to_indexed(data2))
+
+    def detect_changes_in_tile(self, tile: Coordinate):
+        return self.detect_changes_in_tile_bytes(*self.read_tiles(tile))
+
+    def detect_changes_in_tile_bytes(self, data1: bytes | None, data2: bytes | None) -> Image:
+        """detect_changes_in_tile for tiles that have already been read, None where the server has no tile"""
+        if data1 is None or data2 is None:
+            return self.empty_mask()
+        if self.tiles_unchanged(data1, data2):
+            return np.zeros(png_size(data1)[::-1], dtype=bool)
+        return self.detect_change_in_bytes(data1, data2)
+
+
+# the detector used by each worker process, set by _init_worker
+_worker_detector: Detector | None = None
+
+
+def _init_worker(detector: Detector, output_dir: str | None, config_cwd: str | None, metrics_enabled: bool = False):
+    global _worker_detector
+    # class attributes are not carried over when worker processes are spawned rather than forked
+    TileFilepath.output_dir = output_dir
+    TileFilepath.config_cwd = config_cwd
+    # forked workers start with a copy of the parent's metrics, which mustn't be sent back twice
+    metrics.reset(metrics_enabled)
+    _worker_detector = detector
+
+
+# both return the worker's metrics since the last call, for the parent process to merge
+
+
+def _process_chunk(tiles: list[Coordinate]) -> tuple[list[TileResult], dict | None]:
+    assert _worker_detector is not None
+    return [_worker_detector.try_process_tile(tile) for tile in tiles], metrics.drain()
 
-        with open(fp1, "rb") as f1, open(fp2, "rb") as f2:
-            img1 = bytes_to_image(f1.read(), format="png")
-            img2 = bytes_to_image(f2.read(), format="png")
-            detection_mask = self.detect_change(img1, img2)
 
-            return detection_mask
+def _process_tile_data(tile: Coordinate, data: list[bytes | None]) -> tuple[TileResult, dict | None]:
+    assert _worker_detector is not None
+    return _worker_detector.try_process_tile(tile, data), metrics.drain()
 
 
 def example():
@@ -1,8 +1,23 @@
 import requests
-from osm_changes.config import Config, TileFilepath
+from requests.adapters import HTTPAdapter
+from osm_changes.config import Config
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from urllib.parse import urlparse
 from osm_changes.types import Coordinate
+from osm_changes.storage import (
+    TileMetadata,
+    TileMetadataIndex,
+    TileStore,
+    TileRecord,
+    open_metadata_index,
+    open_tile_store,
+)
 from osm_changes.logger import logger
+from osm_changes.metrics import metrics
+from typing import Callable, Iterable
+import threading
+import time
 import os
 
 
@@ -49,8 +64,57 @@ def find_nearest_layer(given_date: str, base_urls: dict[str, str] = layer_urls)
     return base_urls[nearest_date]
 
 
+def get_layer_url(layer: str) -> str:
+    # check for the layer in the dictionary
+    if layer not in layer_urls:
+        nearest_layer = find_nearest_layer(layer)
+        # get the key of the nearest layer
+        nearest_layer_key = list(layer_urls.keys())[
+            list(layer_urls.values()).index(nearest_layer)
+        ]
+        raise Exception(
+            f"Layer {layer} not found, suggested layer: {nearest_layer_key} - {nearest_layer}"
+        )
+    return layer_urls[layer]
+
+
+# HTTP status codes worth retrying after a pause
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class TileNotFoundError(requests.HTTPError):
+    """The server has no tile here (HTTP 404), e.g. outside the coverage of the OS layers"""
+
+
+class TokenBucket:
+    """Thread safe token bucket, allowing `rate` requests per second with bursts of up to `capacity` requests.
+    A rate of zero or less disables the limit.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+
 class Downloader:
-    def __init__(self, cfg: Config):
+    def __init__(self, cfg: Config, store: TileStore | None = None):
         self.tile_url = "https://tile.openstreetmap.org/"
         self.headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:125.0) Gecko/20100101 Firefox/125.0"
@@ -58,40 +122,119 @@ class Downloader:
         self.zoom: int = cfg.zoom
         self.layer: str | None = None
 
-    def get_tile_png(self, zoom: int, x: int, y: int) -> bytes:
+        # where downloaded tiles are kept
+        self.store: TileStore = store if store is not None else open_tile_store(cfg)
+        self.batch_size = 256
+
+        self.workers: int = max(1, cfg.download_workers)
+        self.rate_limit: float = cfg.download_rate_limit
+        self.retries: int = cfg.download_retries
+        self.backoff: float = cfg.download_backoff
+        self.max_delay: float = cfg.download_max_delay
+        self.timeout: float = cfg.download_timeout
+
+        # seconds each layer's stored tiles stay fresh before being revalidated, layers not listed never expire
+        self.cfg = cfg
+        self.layer_max_age: dict[str, float | None] = cfg.layer_max_age
+        self._metadata: TileMetadataIndex | None = None
+        self._metadata_lock = threading.Lock()
+
+        # a pooled session keeps connections alive between tiles
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        # one rate limiter per host, shared by every layer downloaded with this instance
+        self._buckets: dict[str, TokenBucket] = {}
+        self._buckets_lock = threading.Lock()
+
+    def _bucket(self, url: str) -> TokenBucket:
+        host = urlparse(url).netloc
+        with self._buckets_lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.rate_limit)
+            return self._buckets[host]
+
+    def _retry_delay(self, attempt: int, response: requests.Response | None = None) -> float:
+        delay = self.backoff * 2 ** attempt
+        if response is not None and "Retry-After" in response.headers:
+            try:
+                delay = float(response.headers["Retry-After"])
+            except ValueError:
+                pass  # an HTTP date rather than seconds, fall back to the backoff
+        # so one odd response can't hold up a download worker for hours
+        return min(max(delay, 0), self.max_delay)
+
+    def get_tile_png(self, zoom: int, x: int, y: int, layer: str | None = None) -> bytes:
+        """Download a tile from the layer set with set_layer, or from `layer` if given"""
+        return self.get_tile_response(zoom, x, y, layer=layer).content
+
+    def get_tile_response(
+        self, zoom: int, x: int, y: int, layer: str | None = None, headers: dict[str, str] | None = None
+    ) -> requests.Response:
+        """get_tile_png returning the whole response, sending any extra headers e.g. for a conditional request"""
         # https://tile.openstreetmap.org/17/65521/43969.png
-        if self.layer is None:
+        if layer is not None:
+            tile_url = get_layer_url(layer)
+        elif self.layer is None:
             raise Exception("Layer not set, use this.set_layer(layer_name) to set the layer (where layer_name is a string YYYYMM, e.g. '202310' for October 2023)")
-        url = f"{self.tile_url}{zoom}/{x}/{y}.png"
+        else:
+            tile_url = self.tile_url
+        url = f"{tile_url}{zoom}/{x}/{y}.png"
         logger.info(f"Downloading tile {zoom}/{x}/{y} from {url}")
-        response = requests.get(url, headers=self.headers)
-        # check if the request was successful and bytes were returned
-        response.raise_for_status()
-        return response.content
+        request_headers = self.headers if headers is None else {**self.headers, **headers}
+        bucket = self._bucket(url)
+        for attempt in range(self.retries + 1):
+            bucket.acquire()
+            try:
+                with metrics.timer("download"):
+                    response = self.session.get(url, headers=request_headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                metrics.count("download_errors")
+                if attempt >= self.retries:
+                    raise
+                delay = self._retry_delay(attempt)
+                logger.warning(f"Error downloading tile {zoom}/{x}/{y} ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+
+            if response.status_code in RETRY_STATUS_CODES and attempt < self.retries:
+                metrics.count("download_retries")
+                delay = self._retry_delay(attempt, response)
+                logger.warning(f"HTTP {response.status_code} for tile {zoom}/{x}/{y}, retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+
+            # check if the request was successful and bytes were returned
+            if response.status_code == 404:
+                raise TileNotFoundError(f"Tile {zoom}/{x}/{y} not found at {url}", response=response)
+            response.raise_for_status()
+            if response.status_code == 304:
+                metrics.count("download_not_modified")
+            else:
+                metrics.count("download_bytes", len(response.content))
+                metrics.count("downloaded_tiles")
+            return response
+        raise Exception(f"Failed to download tile {zoom}/{x}/{y}")  # unreachable, keeps the type checker happy
 
     def set_layer(self, layer: str):
-        # check for the layer in the dictionary
-        if layer not in layer_urls:
-            nearest_layer = find_nearest_layer(layer)
-            # get the key of the nearest layer
-            nearest_layer_key = list(layer_urls.keys())[
-                list(layer_urls.values()).index(nearest_layer)
-            ]
-            raise Exception(
-                f"Layer {layer} not found, suggested layer: {nearest_layer_key} - {nearest_layer}"
-            )
-        self.tile_url = layer_urls[layer]
+        self.tile_url = get_layer_url(layer)
         self.layer = layer
 
     def save_tile(self, filepath: str, x: int, y: int, zoom: int | None = None):
         if zoom is None:
             zoom = self.zoom
 
-        # skip if the file already exists
-        if os.path.exists(filepath):
+        # skip if the file already exists and hasn't expired
+        exists = os.path.exists(filepath)
+        if exists and self.is_fresh(self.layer, zoom, x, y):  # type: ignore
             logger.debug(f"File {filepath} already exists, skipping")
             return
-        bytes = self.get_tile_png(zoom, x, y)
+        bytes = self.update_tile(x, y, zoom=zoom, stored=exists)
+        if exists and bytes is None:
+            logger.debug(f"File {filepath} has not changed on the server")
+            return
         if bytes:
             # create the directory if it does not exist
             os.makedirs(os.path.dirname(filepath), exist_ok=True)
@@ -100,12 +243,209 @@ class Downloader:
         else:
             raise Exception(f"Failed to download tile {zoom}/{x}/{y}")
 
-    def download_tiles(self, tiles: set[Coordinate]):
+    def fetch_tile(self, x: int, y: int, zoom: int | None = None, layer: str | None = None) -> bytes:
+        if zoom is None:
+            zoom = self.zoom
+        response = self.get_tile_response(zoom, int(x), int(y), layer=layer)
+        if not response.content:
+            raise Exception(f"Failed to download tile {zoom}/{x}/{y}")
+        self._record_metadata(layer, zoom, x, y, response)
+        return response.content
+
+    @property
+    def metadata(self) -> TileMetadataIndex:
+        """Cache metadata of the stored tiles, only opened once a layer that expires is downloaded"""
+        with self._metadata_lock:
+            if self._metadata is None:
+                self._metadata = open_metadata_index(self.cfg, self.store)
+            return self._metadata
+
+    def max_age(self, layer: str | None) -> float | None:
+        """Seconds a stored tile of the layer stays fresh, None if it never expires"""
+        return self.layer_max_age.get(layer if layer is not None else self.layer)  # type: ignore
+
+    def is_fresh(self, layer: str, zoom: int, x: int, y: int) -> bool:
+        """Whether a stored tile can be used without checking it with the server"""
+        max_age = self.max_age(layer)
+        if max_age is None:
+            return True
+        metadata = self.metadata.get(layer, zoom, x, y)
+        return metadata is not None and metadata.checked + max_age > time.time()
+
+    def _record_metadata(self, layer: str | None, zoom: int, x: int, y: int, response: requests.Response):
+        if layer is None:
+            layer = self.layer
+        if self.max_age(layer) is None:
+            return  # the tile never expires, so it's never revalidated
+        self.metadata.put(
+            layer,  # type: ignore
+            zoom,
+            x,
+            y,
+            TileMetadata(response.headers.get("ETag"), response.headers.get("Last-Modified"), time.time()),
+        )
+
+    def update_tile(
+        self, x: int, y: int, zoom: int | None = None, layer: str | None = None, stored: bool = False
+    ) -> bytes | None:
+        """Download a tile, or for a stored tile revalidate it with a conditional request.
+
+        :param stored: whether the tile is already in the store
+        :return: the tile's bytes, or None if the stored tile hasn't changed (HTTP 304)
+        """
+        if zoom is None:
+            zoom = self.zoom
+        if layer is None:
+            layer = self.layer
+        metadata = self.metadata.get(layer, zoom, x, y) if stored and self.max_age(layer) is not None else None  # type: ignore
+        if metadata is None or (metadata.etag is None and metadata.last_modified is None):
+            return self.fetch_tile(x, y, zoom=zoom, layer=layer)
+
+        headers = {}
+        if metadata.etag is not None:
+            headers["If-None-Match"] = metadata.etag
+        if metadata.last_modified is not None:
+            headers["If-Modified-Since"] = metadata.last_modified
+        response = self.get_tile_response(zoom, int(x), int(y), layer=layer, headers=headers)
+        if response.status_code == 304:
+            # the server may send new validators with a 304, otherwise keep the old ones
+            self.metadata.put(
+                layer,  # type: ignore
+                zoom,
+                x,
+                y,
+                TileMetadata(
+                    response.headers.get("ETag", metadata.etag),
+                    response.headers.get("Last-Modified", metadata.last_modified),
+                    time.time(),
+                ),
+            )
+            return None
+        if not response.content:
+            raise Exception(f"Failed to download tile {zoom}/{x}/{y}")
+        self._record_metadata(layer, zoom, x, y, response)
+        return response.content
+
+    def read_tile(self, layer: str, zoom: int, x: int, y: int) -> bytes | None:
+        """A tile's bytes from the store, downloading it first if it isn't stored yet or has gone stale.
+
+        :return: None if the server has no tile there
+        """
+        stored = self.store.has(layer, zoom, x, y)
+        if stored and self.is_fresh(layer, zoom, x, y):
+            return self.store.get(layer, zoom, x, y)
+        if not stored and self.store.is_missing(layer, zoom, x, y):
+            return None
+        try:
+            data = self.update_tile(x, y, zoom=zoom, layer=layer, stored=stored)
+        except TileNotFoundError:
+            self.store.put_missing(layer, zoom, x, y)
+            return None
+        if data is None:
+            return self.store.get(layer, zoom, x, y)
+        self.store.put(layer, zoom, x, y, data)
+        return data
+
+    def flush_metadata(self):
+        if self._metadata is not None:
+            self._metadata.flush()
+
+    def download_tiles(self, tiles: set[Coordinate], zoom: int | None = None):
         if self.layer is None:
             raise Exception("Layer not set, use this.set_layer(layer_name) to set the layer (where layer_name is a string YYYYMM, e.g. '202310' for October 2023)")
-        for tile in tiles:
-            filepath = TileFilepath(self.layer, tile[0], tile[1], self.zoom)()
-            self.save_tile(filepath, *tile)  # type: ignore
+        if zoom is None:
+            zoom = self.zoom
+        layer = self.layer
+
+        # skip tiles that are already stored and still fresh, revalidate the stale ones
+        stale: set[Coordinate] = set()
+
+        def needs_download(tile: Coordinate) -> bool:
+            if not self.store.has(layer, zoom, *tile):  # type: ignore
+                if self.store.is_missing(layer, zoom, *tile):  # type: ignore
+                    metrics.count("download_known_missing")
+                    return False
+                return True
+            if self.is_fresh(layer, zoom, *tile):  # type: ignore
+                metrics.count("download_cached")
+                return False
+            stale.add(tile)
+            return True
+
+        def fetch(tile: Coordinate) -> bytes | None:
+            try:
+                return self.update_tile(*tile, zoom=zoom, layer=layer, stored=tile in stale)  # type: ignore
+            except TileNotFoundError:
+                # remember it, so it's not requested again and detection treats it as empty
+                logger.info(f"Tile {zoom}/{tile[0]}/{tile[1]} is not available for layer {layer}")
+                metrics.count("download_not_found")
+                self.store.put_missing(layer, zoom, *tile)  # type: ignore
+                return None
+
+        pending = filter(needs_download, tiles)
+
+        # downloaded tiles are written from this thread in batches, one transaction per batch
+        batch: list[TileRecord] = []
+
+        def add(tile: Coordinate, data: bytes | None):
+            stale.discard(tile)
+            if data is None:
+                return  # the stored tile is still current
+            batch.append((layer, zoom, int(tile[0]), int(tile[1]), data))
+            if len(batch) >= self.batch_size:
+                self.store.put_many(batch)
+                batch.clear()
+
+        # tiles that fail are logged and the rest carry on, then the first error is raised at the end
+        failures: list[tuple[Coordinate, BaseException]] = []
+        try:
+            if self.workers <= 1:
+                for tile in pending:
+                    try:
+                        data = fetch(tile)
+                    except Exception as e:
+                        logger.error(f"Failed to download tile {zoom}/{tile[0]}/{tile[1]}: {e}")
+                        failures.append((tile, e))
+                    else:
+                        add(tile, data)
+            else:
+                self._download_concurrently(pending, zoom, fetch, add, failures)
+        finally:
+            self.store.put_many(batch)
+            self.flush_metadata()
+
+        if failures:
+            raise Exception(f"Failed to download {len(failures)} tiles for layer {layer}, first error: {failures[0][1]}")
+
+    def _download_concurrently(
+        self,
+        tiles: Iterable[Coordinate],
+        zoom: int,
+        fetch: Callable[[Coordinate], bytes | None],
+        add: Callable[[Coordinate, bytes | None], None],
+        failures: list[tuple[Coordinate, BaseException]],
+    ):
+        # keep a bounded number of tiles queued on the pool, so huge areas don't create millions of futures
+        max_in_flight = self.workers * 2
+        in_flight: dict[Future[bytes | None], Coordinate] = {}
+
+        def collect(done: set[Future[bytes | None]]):
+            for future in done:
+                tile = in_flight.pop(future)
+                error = future.exception()
+                if error is not None:
+                    logger.error(f"Failed to download tile {zoom}/{tile[0]}/{tile[1]}: {error}")
+                    failures.append((tile, error))
+                else:
+                    add(tile, future.result())
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for tile in tiles:
+                if len(in_flight) >= max_in_flight:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+                in_flight[pool.submit(fetch, tile)] = tile
+            collect(wait(in_flight).done)
 
 
 # def test_save_tile():
@@ -1,7 +1,7 @@
 """ Define a grid of lat/lon points """
 
 from .config import Config
-from .coordinates import Coordinate
+from .coordinates import Coordinate, tiles_in_bbox
 from numpy import linspace
 
 
@@ -10,7 +10,7 @@ class Grid:
         self.config = config
         self.lat_points: list[float] = []
         self.lon_points: list[float] = []
-        self.grid: list[Coordinate] = []
+        self._grid: list[Coordinate] | None = None
         self.generate_grid()
 
     def generate_grid(self):
@@ -20,4 +20,30 @@ class Grid:
         self.lon_points = linspace(
             self.config.min_lon, self.config.max_lon, self.config.width
         )
-        self.grid = [(lat, lon) for lat in self.lat_points for lon in self.lon_points]  # type: ignore
+        # the full list of points is only built if something asks for it
+        self._grid = None
+
+    @property
+    def grid(self) -> list[Coordinate]:
+        if self._grid is None:
+            self._grid = [(lat, lon) for lat in self.lat_points for lon in self.lon_points]  # type: ignore
+        return self._grid
+
+    def tiles(self, zoom: int | None = None) -> set[Coordinate]:
+        """The set of tiles covering the bounding box, found from the corner tiles rather than by walking the grid,
+        or the exact cover of the AOI polygon when the config has one"""
+        if zoom is None:
+            zoom = self.config.zoom
+        if self.config.aoi:
+            from .aoi import AOI
+
+            return AOI.from_file(self.config.aoi, zoom).tiles()
+        return set(
+            tiles_in_bbox(
+                self.config.min_lat,
+                self.config.max_lat,
+                self.config.min_lon,
+                self.config.max_lon,
+                zoom,
+            )
+        )
@@ -0,0 +1,108 @@
+"""Coarse-to-fine search for the tiles that can have changed, before detecting at the full zoom.
+
+Both layers are first downloaded and compared at a coarse zoom, where a tile covers the area of
+4^(zoom - coarse_zoom) detection tiles. Where the coarse tiles are byte-identical nothing under them can
+have changed and the whole block is left out. Elsewhere they're decoded, and only the quarters whose
+pixel colours differ are followed down to their four child tiles at the next zoom, and so on down to the
+detection zoom. Downloads and detection then scale with the area that changed rather than the whole area.
+Where the server has no coarse tile, its children are looked at instead, so no area is left out unseen.
+
+Pixels are compared by colour rather than by initial_label/final_label class, as zoomed out tiles blend
+the colours of small features, and a quarter is widened by a margin of pixels so a change on its edge
+reaches the children either side. A change too small to be drawn at all at the coarse zoom is still
+missed, so coarse_zoom shouldn't be set much lower than the zoom small buildings are drawn at. Nothing is
+left out for detectors where identical tiles still have an output, e.g. transitions, which count every
+class's transition to itself.
+"""
+
+import numpy as np
+from osm_changes.detector import Detector
+from osm_changes.downloader import Downloader
+from osm_changes.images import bytes_to_indexed
+from osm_changes.logger import logger
+from osm_changes.metrics import metrics
+from osm_changes.types import Coordinate, Image
+
+
+class HierarchicalSearch:
+    """Find the tiles at the detector's zoom under coarse tiles that differ between its input layers.
+
+    :param coarse_zoom: the zoom level the search starts at
+    :param margin: pixels either side of a quarter of a tile that also count towards its child
+    """
+
+    def __init__(self, downloader: Downloader, detector: Detector, coarse_zoom: int, margin: int = 1):
+        if coarse_zoom > detector.zoom:
+            raise ValueError(f"coarse_zoom ({coarse_zoom}) must not be above the detection zoom ({detector.zoom})")
+        self.downloader = downloader
+        self.detector = detector
+        self.store = detector.store
+        self.coarse_zoom = coarse_zoom
+        self.margin = margin
+
+    def search(self, tiles: set[Coordinate]) -> set[Coordinate]:
+        """The subset of tiles, at the detector's zoom, that can contain a change"""
+        zoom = self.detector.zoom
+        tiles = {(int(tile[0]), int(tile[1])) for tile in tiles}
+        if not self.detector.labels_are_disjoint():
+            # identical tiles can still hold a change, so nothing can be left out
+            logger.warning("Identical tiles can hold a change for these labels, so every tile is detected at the full zoom")
+            return tiles
+
+        candidates = _parents(tiles, zoom - self.coarse_zoom)
+        for level in range(self.coarse_zoom, zoom):
+            for layer in self.detector.input_layers:
+                self.downloader.set_layer(layer)
+                self.downloader.download_tiles(candidates, zoom=level)
+
+            # children are only followed where they're above a tile that was asked for
+            wanted = _parents(tiles, zoom - level - 1)
+            children = set()
+            for tile in sorted(candidates):
+                children.update(child for child in self.changed_children(tile, level) if child in wanted)
+            logger.info(f"Zoom {level}: {len(children)} child tiles under {len(candidates)} tiles with differences")
+            metrics.count("hierarchy_tiles_compared", len(candidates))
+            candidates = children
+
+        metrics.count("hierarchy_tiles_pruned", len(tiles) - len(candidates))
+        return candidates
+
+    def changed_children(self, tile: Coordinate, level: int) -> list[Coordinate]:
+        """The child tiles at level + 1 under the parts of a tile that differ between the input layers"""
+        x, y = tile
+        children = [(2 * x + i, 2 * y + j) for j in range(2) for i in range(2)]
+        data = [self.store.get(layer, level, x, y) for layer in self.detector.input_layers]
+        if any(tile_data is None for tile_data in data):
+            # nothing to compare, e.g. a server that doesn't have every zoom level, so look at the children
+            return children
+        if all(tile_data == data[0] for tile_data in data[1:]):
+            return []
+
+        with metrics.timer("hierarchy_compare"):
+            differences = pixel_differences(data)
+        height, width = differences.shape
+        m = self.margin
+        changed = []
+        for child in children:
+            i, j = child[0] - 2 * x, child[1] - 2 * y
+            rows = slice(max(0, j * height // 2 - m), (j + 1) * height // 2 + m)
+            cols = slice(max(0, i * width // 2 - m), (i + 1) * width // 2 + m)
+            if differences[rows, cols].any():
+                changed.append(child)
+        return changed
+
+
+def pixel_differences(data: list[bytes]) -> Image:
+    """Mask of the pixels whose colour differs between any of the tiles and the first"""
+    indices, palette = bytes_to_indexed(data[0])
+    first = palette[indices]
+    differences = np.zeros(indices.shape, dtype=bool)
+    for tile_data in data[1:]:
+        indices, palette = bytes_to_indexed(tile_data)
+        differences |= (palette[indices] != first).any(axis=-1)
+    return differences
+
+
+def _parents(tiles: set[Coordinate], levels: int) -> set[Coordinate]:
+    """The tiles `levels` zoom levels up that contain the given tiles"""
+    return {(x >> levels, y >> levels) for x, y in tiles}
@@ -1,79 +1,135 @@
-from osm_changes.coordinates import tile_to_latlon
+from osm_changes.coordinates import tile_mercator_bounds
+from osm_changes.metrics import metrics
 from osm_changes.types import Image
 from io import BytesIO
 import numpy as np
+import struct
 import rasterio  # type: ignore
-from rasterio.warp import reproject, Resampling  # type: ignore
+from functools import lru_cache
+from rasterio.crs import CRS  # type: ignore
+from rasterio.transform import from_bounds  # type: ignore
+from rasterio.warp import calculate_default_transform, reproject, Resampling  # type: ignore
 
 
 def bytes_to_image(binary_image_data: bytes, format: str) -> Image:
     from matplotlib.pyplot import imread
 
     # Convert binary image data to an image
-    image: Image = imread(BytesIO(binary_image_data), format=format)
+    with metrics.timer("decode"):
+        image: Image = imread(BytesIO(binary_image_data), format=format)
     return image
 
 
-def tile_to_geotiff(image: Image, x: int, y: int, z: int, filename: str):
-    with rasterio.Env():
-        # check if we're 2D:
-        if len(image.shape) != 3:
-            # reshape to (1xHxW)
-            image = np.expand_dims(image, axis=0)
-        else:
-            if image.shape[0] == 4:  # trim the alpha channel
-                image = image[:3]
-            if image.shape[2] == 3 or image.shape[2] == 1:  # rasterio expects 3x256x256, not 256x256x3
-                image = np.moveaxis(image, -1, 0)
-        band_count = image.shape[0]
-
-        # convert any bool images to uint8
-        if image.dtype == bool:
-            image = image.astype(np.uint8) * 255
-
-        dst_shape = image.shape
-
-        destination = image.copy()
-
-        src_crs = {"init": "EPSG:3857"}
-        dst_crs = {"init": "EPSG:4326"}
-
-        # Get the lat/lon bounds of the tile.
-        lat1, lon1 = tile_to_latlon(x, y, z)
-        lat2, lon2 = tile_to_latlon(x + 1, y + 1, z)
-
-        # Get the transform for the source image.
-        src_transform: rasterio.Affine = rasterio.transform.from_bounds(  # type: ignore
-            lon1, lat2, lon2, lat1, 256, 256
-        )
-        dst_transform: rasterio.Affine = rasterio.transform.from_bounds(  # type: ignore
-            lon1, lat2, lon2, lat1, 256, 256
+def bytes_to_indexed(binary_image_data: bytes) -> tuple[Image, Image]:
+    """Decode an image to palette indices instead of float RGBA.
+
+    Palette PNGs (as used by the OS map tiles) keep their uint8 indices and PNG palette.
+    Other images are packed to 24-bit RGB and reduced to their unique colours.
+
+    :return: (indices, palette) where indices is a HxW integer array and palette is a Nx3 uint8 array
+    """
+    from PIL import Image as PILImage  # type: ignore
+
+    with metrics.timer("decode"):
+        with PILImage.open(BytesIO(binary_image_data)) as pil_image:
+            if pil_image.mode == "P":
+                indices = np.asarray(pil_image)
+                palette = np.frombuffer(bytes(pil_image.getpalette("RGB")), dtype=np.uint8).reshape(-1, 3)  # type: ignore
+                # pad short palettes so every uint8 index can be looked up
+                if len(palette) < 256:
+                    palette = np.vstack([palette, np.zeros((256 - len(palette), 3), dtype=np.uint8)])
+                return indices, palette
+            rgb = np.asarray(pil_image.convert("RGB"))
+
+        packed = (rgb[..., 0].astype(np.uint32) << 16) | (rgb[..., 1].astype(np.uint32) << 8) | rgb[..., 2]
+        colours, inverse = np.unique(packed, return_inverse=True)
+        palette = np.stack([colours >> 16, (colours >> 8) & 0xFF, colours & 0xFF], axis=-1).astype(np.uint8)
+        index_dtype = np.uint8 if len(colours) <= 256 else np.uint32
+        return inverse.reshape(packed.shape).astype(index_dtype), palette
+
+
+def png_size(binary_image_data: bytes) -> tuple[int, int]:
+    """Read the (width, height) of a PNG from its IHDR header without decoding it"""
+    if binary_image_data[:8] != b"\x89PNG\r\n\x1a\n" or binary_image_data[12:16] != b"IHDR":
+        raise ValueError("Not a PNG image")
+    width, height = struct.unpack(">II", binary_image_data[16:24])
+    return width, height
+
+
+@lru_cache
+def _crs(crs: str) -> CRS:
+    # parsing a CRS string costs a noticeable share of a per-tile write
+    return CRS.from_string(crs)
+
+
+def tile_to_geotiff(
+    image: Image, x: int, y: int, z: int, filename: str, crs: str = "EPSG:3857", compress: str = "DEFLATE"
+):
+    """Write a tile to a GeoTIFF.
+
+    EPSG:3857 writes the pixels untouched with the tile's exact Web Mercator transform.
+    EPSG:4326 warps the tile to WGS84, using nearest neighbour for masks so they stay binary.
+    Bool masks are written as 1-bit (NBITS=1) rasters, other images as compressed uint8.
+    """
+    # check if we're 2D:
+    if len(image.shape) != 3:
+        # reshape to (1xHxW)
+        image = np.expand_dims(image, axis=0)
+    else:
+        if image.shape[2] == 4:  # trim the alpha channel
+            image = image[:, :, :3]
+        if image.shape[2] == 3 or image.shape[2] == 1:  # rasterio expects 3x256x256, not 256x256x3
+            image = np.moveaxis(image, -1, 0)
+    band_count, height, width = image.shape
+
+    is_mask = image.dtype == bool
+    if is_mask:
+        image = image.astype(np.uint8)
+    elif np.issubdtype(image.dtype, np.floating):
+        # decoded PNGs are floats from 0 to 1
+        image = np.rint(np.clip(image, 0, 1) * 255).astype(np.uint8)
+    elif image.dtype != np.uint8:
+        raise ValueError(f"Unsupported image dtype {image.dtype}")
+
+    src_crs = "EPSG:3857"
+    west, south, east, north = tile_mercator_bounds(x, y, z)
+    src_transform = from_bounds(west, south, east, north, width, height)
+
+    if crs == src_crs:
+        data, transform = image, src_transform
+    elif crs == "EPSG:4326":
+        transform, dst_width, dst_height = calculate_default_transform(
+            _crs(src_crs), _crs(crs), width, height, left=west, bottom=south, right=east, top=north
         )
-
+        data = np.zeros((band_count, dst_height, dst_width), dtype=np.uint8)
         reproject(
             image,
-            destination,
+            data,
             src_transform=src_transform,
-            src_crs=src_crs,
-            dst_transform=dst_transform,
-            dst_crs=dst_crs,
-            resampling=Resampling.cubic,
+            src_crs=_crs(src_crs),
+            dst_transform=transform,
+            dst_crs=_crs(crs),
+            resampling=Resampling.nearest if is_mask else Resampling.bilinear,
         )
-
-        # Write it out to a file.
-        with rasterio.open(  # type: ignore
-            filename,
-            "w",
-            driver="GTiff",
-            width=dst_shape[2],
-            height=dst_shape[1],
-            count=band_count,
-            dtype=image.dtype,
-            transform=dst_transform,
-            crs=dst_crs,
-        ) as dst:  # type: ignore
-            for i in range(0, band_count):
-                dst.write(image[i], i + 1)  # type: ignore
+    else:
+        raise ValueError(f"Unsupported GeoTIFF CRS {crs}, use EPSG:3857 or EPSG:4326")
+
+    profile = {
+        "driver": "GTiff",
+        "width": data.shape[2],
+        "height": data.shape[1],
+        "count": band_count,
+        "dtype": "uint8",
+        "transform": transform,
+        "crs": _crs(crs),
+        "compress": compress,
+    }
+    if is_mask:
+        profile["nbits"] = 1
+
+    # Write it out to a file.
+    with rasterio.open(filename, "w", **profile) as dst:  # type: ignore
+        dst.write(data)  # type: ignore
 
 
 def tile_to_geotiff_example():
@@ -0,0 +1,89 @@
+"""A record of what every output tile was made from, so reruns only redo the tiles that would come out different.
+
+For each output tile the manifest keeps a fingerprint: a hash of the detection parameters and of the input
+tiles it was made from. On a rerun a tile whose fingerprint is unchanged is skipped, and any change to its
+inputs (e.g. a newer download) or to the parameters (e.g. class_tolerance) gets it detected again, without
+having to delete the old outputs. The fingerprints of a layer are read in one query when the manifest is
+opened, so checking a tile is a dictionary lookup rather than a stat of its output file.
+
+Only the png and tiff outputs are tracked. With min_area every tile is still detected, as regions are
+measured across neighbouring tiles, but only the outputs whose neighbourhood changed are written again.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+from typing import Iterable
+from osm_changes.types import Coordinate
+
+# the input hash of a tile the server doesn't have
+MISSING = "missing"
+
+
+class RunManifest:
+    """The fingerprints of one output layer's tiles, in a SQLite table keyed like the tiles.
+
+    :param parameters: everything besides the input tiles that the outputs depend on, as a JSON-able dict
+    """
+
+    def __init__(self, filepath: str, layer: str, zoom: int, parameters: dict, batch_size: int = 256):
+        self.filepath = filepath
+        self.layer = layer
+        self.zoom = zoom
+        self.batch_size = batch_size
+        self.parameters_hash = _hash(json.dumps(parameters, sort_keys=True))
+        self._pending: list[tuple[str, int, int, int, str]] = []
+        os.makedirs(os.path.dirname(os.path.abspath(filepath)), exist_ok=True)
+        self.connection = sqlite3.connect(filepath)
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS manifest ("
+                "layer TEXT NOT NULL, zoom_level INTEGER NOT NULL, tile_column INTEGER NOT NULL, "
+                "tile_row INTEGER NOT NULL, fingerprint TEXT NOT NULL, "
+                "PRIMARY KEY (layer, zoom_level, tile_column, tile_row)) WITHOUT ROWID"
+            )
+        rows = self.connection.execute(
+            "SELECT tile_column, tile_row, fingerprint FROM manifest WHERE layer=? AND zoom_level=?", (layer, zoom)
+        )
+        self._fingerprints: dict[Coordinate, str] = {(x, y): fingerprint for x, y, fingerprint in rows}
+
+    def fingerprint(self, input_hashes: Iterable[str | None]) -> str | None:
+        """The fingerprint of an output made from inputs with these hashes, or None if any isn't known"""
+        input_hashes = list(input_hashes)
+        if any(input_hash is None for input_hash in input_hashes):
+            return None
+        return _hash(",".join([self.parameters_hash] + input_hashes))  # type: ignore
+
+    def is_current(self, tile: Coordinate, fingerprint: str | None) -> bool:
+        """True if the tile's output was made from the same inputs and parameters"""
+        return fingerprint is not None and self._fingerprints.get((int(tile[0]), int(tile[1]))) == fingerprint
+
+    def record(self, tile: Coordinate, fingerprint: str | None):
+        """Record that the tile's output has been written from inputs with this fingerprint"""
+        if fingerprint is None:
+            # the inputs weren't all known, so there's nothing to check the next run against
+            return
+        x, y = int(tile[0]), int(tile[1])
+        self._fingerprints[(x, y)] = fingerprint
+        self._pending.append((self.layer, self.zoom, x, y, fingerprint))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO manifest (layer, zoom_level, tile_column, tile_row, fingerprint) "
+                "VALUES (?, ?, ?, ?, ?)",
+                self._pending,
+            )
+        self._pending.clear()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+def _hash(text: str) -> str:
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
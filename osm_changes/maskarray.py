@@ -0,0 +1,197 @@
+"""Detection results for a whole area in a single memory-mapped array on disk.
+
+Each tile is written straight into its place in a .npy file opened with np.memmap, so the area is never
+held in memory, and the file can be opened again with np.load(filepath, mmap_mode="r") for analysis across
+tile edges. Windows of it are then views onto the file rather than copies.
+
+Boolean masks are bit-packed along each row (np.packbits), a byte for every 8 pixels, which is what
+makes a county fit on disk comfortably. Codes and layer indices are kept as they are, one byte per pixel.
+Where the area is, and how it's packed, is saved next to the array in a .json file.
+
+Written pages are flushed and dropped from memory every so often, so the resident memory stays the same
+however large the area is. A rerun writes into the existing array, growing it if the area got bigger, so
+tiles whose outputs were already up to date keep their results.
+"""
+
+import json
+import mmap
+import os
+import numpy as np
+from osm_changes.logger import logger
+from osm_changes.types import Coordinate, Image
+
+
+class MaskArray:
+    """A raster covering the tiles x_range by y_range at a zoom level, backed by a memory-mapped .npy file.
+
+    Create a new one with create() or open an existing one with open(). It can be used as a mask sink.
+
+    :param packed: whether rows are bit-packed, for boolean masks
+    :param release_every: number of tiles written between flushing the written pages to disk and dropping
+        them from memory
+    """
+
+    def __init__(
+        self,
+        filepath: str,
+        array: np.memmap,
+        x_range: range,
+        y_range: range,
+        zoom: int,
+        packed: bool,
+        tile_size: int = 256,
+        release_every: int = 256,
+    ):
+        self.filepath = filepath
+        self.array = array
+        self.x_range = x_range
+        self.y_range = y_range
+        self.zoom = zoom
+        self.packed = packed
+        self.tile_size = tile_size
+        self.release_every = release_every
+        self._written = 0
+
+    @classmethod
+    def create(
+        cls,
+        filepath: str,
+        x_range: range,
+        y_range: range,
+        zoom: int,
+        packed: bool = True,
+        tile_size: int = 256,
+        release_every: int = 256,
+    ) -> "MaskArray":
+        if packed and tile_size % 8:
+            raise ValueError(f"Bit-packed rows need a tile size that is a multiple of 8, not {tile_size}")
+        height = len(y_range) * tile_size
+        width = len(x_range) * tile_size
+        shape = (height, width // 8 if packed else width)
+        # the file is created sparse, so parts of the area with no tiles take no space on disk
+        array = np.lib.format.open_memmap(filepath, mode="w+", dtype=np.uint8, shape=shape)
+        metadata = {
+            "x_range": [x_range.start, x_range.stop],
+            "y_range": [y_range.start, y_range.stop],
+            "zoom": zoom,
+            "packed": packed,
+            "tile_size": tile_size,
+        }
+        with open(_metadata_filepath(filepath), "w") as f:
+            json.dump(metadata, f)
+        return cls(filepath, array, x_range, y_range, zoom, packed, tile_size, release_every)
+
+    @classmethod
+    def for_tiles(
+        cls,
+        filepath: str,
+        tiles: list[Coordinate],
+        zoom: int,
+        packed: bool = True,
+        tile_size: int = 256,
+        release_every: int = 256,
+    ) -> "MaskArray":
+        """An array covering the bounding box of a set of tiles.
+
+        An array already at filepath with the same layout is written into rather than replaced, grown first if
+        the tiles reach outside it, so the tiles not written this time (e.g. because their outputs were up to
+        date) keep their results from earlier runs.
+        """
+        xs = [int(tile[0]) for tile in tiles]
+        ys = [int(tile[1]) for tile in tiles]
+        x_range, y_range = range(min(xs), max(xs) + 1), range(min(ys), max(ys) + 1)
+        if not os.path.exists(filepath) or not os.path.exists(_metadata_filepath(filepath)):
+            return cls.create(filepath, x_range, y_range, zoom, packed, tile_size, release_every)
+
+        existing = cls.open(filepath, mode="r+")
+        if (existing.zoom, existing.packed, existing.tile_size) != (zoom, packed, tile_size):
+            logger.warning(f"Replacing {filepath}, which was written with a different zoom, tile size or packing")
+            del existing
+            return cls.create(filepath, x_range, y_range, zoom, packed, tile_size, release_every)
+        existing.release_every = release_every
+        x_range, y_range = _union(existing.x_range, x_range), _union(existing.y_range, y_range)
+        if x_range == existing.x_range and y_range == existing.y_range:
+            return existing
+
+        # grow the array into a new file, copying the old one across a row of tiles at a time
+        tmp_filepath = f"{filepath}.tmp.npy"
+        grown = cls.create(tmp_filepath, x_range, y_range, zoom, packed, tile_size, release_every)
+        row, col = grown._offset((existing.x_range.start, existing.y_range.start))
+        height, width = existing.array.shape
+        for start in range(0, height, tile_size):
+            stop = min(start + tile_size, height)
+            grown.array[row + start : row + stop, col : col + width] = existing.array[start:stop]
+        grown.release()
+        del existing
+        os.replace(tmp_filepath, filepath)
+        os.replace(_metadata_filepath(tmp_filepath), _metadata_filepath(filepath))
+        grown.filepath = filepath
+        return grown
+
+    @classmethod
+    def open(cls, filepath: str, mode: str = "r") -> "MaskArray":
+        """Open an array written earlier, read only unless mode is "r+" """
+        with open(_metadata_filepath(filepath)) as f:
+            metadata = json.load(f)
+        array = np.load(filepath, mmap_mode=mode)
+        return cls(
+            filepath,
+            array,
+            range(*metadata["x_range"]),
+            range(*metadata["y_range"]),
+            metadata["zoom"],
+            metadata["packed"],
+            metadata["tile_size"],
+        )
+
+    def _offset(self, tile: Coordinate) -> tuple[int, int]:
+        x, y = int(tile[0]), int(tile[1])
+        if x not in self.x_range or y not in self.y_range:
+            raise ValueError(f"Tile {self.zoom}/{x}/{y} is outside the array")
+        row = (y - self.y_range.start) * self.tile_size
+        col = (x - self.x_range.start) * self.tile_size
+        return row, col // 8 if self.packed else col
+
+    def write_tile(self, tile: Coordinate, mask: Image):
+        row, col = self._offset(tile)
+        data = np.packbits(mask.astype(bool), axis=1) if self.packed else mask
+        self.array[row : row + data.shape[0], col : col + data.shape[1]] = data
+        self._written += 1
+        if self._written % self.release_every == 0:
+            self.release()
+
+    def tile(self, tile: Coordinate) -> Image:
+        """A tile's raster, unpacked to a bool mask if the array is packed"""
+        row, col = self._offset(tile)
+        ts = self.tile_size
+        if self.packed:
+            return np.unpackbits(self.array[row : row + ts, col : col + ts // 8], axis=1).astype(bool)
+        return self.array[row : row + ts, col : col + ts]
+
+    def window(self, rows: slice, cols: slice) -> Image:
+        """A window of the raster in pixels from the top left of the area. For unpacked arrays this is a
+        view onto the file. Packed windows are unpacked, reading whole bytes either side of the window."""
+        if not self.packed:
+            return self.array[rows, cols]
+        start, stop, _ = cols.indices(self.array.shape[1] * 8)
+        packed = self.array[rows, start // 8 : (stop + 7) // 8]
+        return np.unpackbits(packed, axis=1)[:, start % 8 : start % 8 + stop - start].astype(bool)
+
+    def release(self):
+        """Flush written pages to the file and drop them from memory, so the resident size doesn't grow"""
+        self.array.flush()
+        mapping = getattr(self.array, "_mmap", None)
+        if mapping is not None and hasattr(mapping, "madvise") and hasattr(mmap, "MADV_DONTNEED"):
+            mapping.madvise(mmap.MADV_DONTNEED)
+
+    def close(self):
+        self.release()
+        logger.info(f"Saved the area's {'bit-packed mask' if self.packed else 'raster'} to {self.filepath}")
+
+
+def _union(a: range, b: range) -> range:
+    return range(min(a.start, b.start), max(a.stop, b.stop))
+
+
+def _metadata_filepath(filepath: str) -> str:
+    return f"{filepath}.json"
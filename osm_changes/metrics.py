@@ -0,0 +1,223 @@
+"""Timers and counters for each stage of a run, written out as a JSON summary or a Prometheus textfile.
+
+Like the logger, a single global `metrics` instance is shared by the whole package:
+
+    with metrics.timer("decode"):
+        ...
+    metrics.count("download_bytes", len(data))
+
+It is turned off by default, when timer() hands back a shared do-nothing context manager and count()
+returns straight away, so the instrumentation costs next to nothing. Latencies are kept in fixed
+logarithmic buckets rather than as a list, so memory doesn't grow with the number of tiles and the
+percentiles are accurate to within a few percent.
+"""
+
+import json
+import math
+import os
+import threading
+import time
+from osm_changes.logger import logger
+
+# latency buckets grow by 2^(1/8), about 9%, from 1 microsecond up to about 18 minutes
+_BUCKET_BASE = 1e-6
+_BUCKETS_PER_DOUBLING = 8
+_BUCKETS = 30 * _BUCKETS_PER_DOUBLING
+_LOG_FACTOR = math.log(2) / _BUCKETS_PER_DOUBLING
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics: "Metrics", name: str):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _Histogram:
+    __slots__ = ("count", "total", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (_BUCKETS + 1)
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if seconds <= _BUCKET_BASE:
+            index = 0
+        else:
+            index = min(_BUCKETS, int(math.log(seconds / _BUCKET_BASE) / _LOG_FACTOR) + 1)
+        self.buckets[index] += 1
+
+    def merge(self, state: dict):
+        self.count += state["count"]
+        self.total += state["total"]
+        self.max = max(self.max, state["max"])
+        for i, n in enumerate(state["buckets"]):
+            self.buckets[i] += n
+
+    def state(self) -> dict:
+        return {"count": self.count, "total": self.total, "max": self.max, "buckets": list(self.buckets)}
+
+    def quantile(self, q: float) -> float:
+        """The q quantile, as the geometric middle of the bucket it falls in"""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n > 0:
+                if index == 0:
+                    return _BUCKET_BASE
+                lower = _BUCKET_BASE * math.exp((index - 1) * _LOG_FACTOR)
+                return min(self.max, lower * math.exp(_LOG_FACTOR / 2))
+        return self.max
+
+
+class Metrics:
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._timers: dict[str, _Histogram] = {}
+        self._counters: dict[str, float] = {}
+        self._started = time.time()
+
+    def reset(self, enabled: bool | None = None):
+        """Clear everything recorded, and optionally turn the metrics on or off"""
+        with self._lock:
+            if enabled is not None:
+                self.enabled = enabled
+            self._timers = {}
+            self._counters = {}
+            self._started = time.time()
+
+    def timer(self, name: str):
+        """Context manager timing the code inside it as one observation of `name`"""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def observe(self, name: str, seconds: float):
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._timers.get(name)
+            if histogram is None:
+                histogram = self._timers[name] = _Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name: str, value: float = 1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def state(self) -> dict:
+        """Everything recorded so far, in a form that can be sent between processes and merged"""
+        with self._lock:
+            return {
+                "timers": {name: histogram.state() for name, histogram in self._timers.items()},
+                "counters": dict(self._counters),
+            }
+
+    def drain(self) -> dict | None:
+        """state(), clearing what has been recorded, or None when disabled. Used to send worker metrics back."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            state = {
+                "timers": {name: histogram.state() for name, histogram in self._timers.items()},
+                "counters": self._counters,
+            }
+            self._timers = {}
+            self._counters = {}
+        return state
+
+    def merge(self, state: dict | None):
+        """Add the state() of another Metrics, e.g. from a worker process"""
+        if state is None or not self.enabled:
+            return
+        with self._lock:
+            for name, timer_state in state["timers"].items():
+                self._timers.setdefault(name, _Histogram()).merge(timer_state)
+            for name, value in state["counters"].items():
+                self._counters[name] = self._counters.get(name, 0) + value
+
+    def summary(self) -> dict:
+        with self._lock:
+            timers = {
+                name: {
+                    "count": h.count,
+                    "total_seconds": h.total,
+                    "mean_seconds": h.total / h.count if h.count else 0.0,
+                    "p50_seconds": h.quantile(0.5),
+                    "p95_seconds": h.quantile(0.95),
+                    "max_seconds": h.max,
+                }
+                for name, h in sorted(self._timers.items())
+            }
+            counters = dict(sorted(self._counters.items()))
+        return {"wall_seconds": time.time() - self._started, "timers": timers, "counters": counters}
+
+    def write_json(self, filepath: str):
+        with open(filepath, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+        logger.info(f"Saved metrics to {filepath}")
+
+    def write_prometheus(self, filepath: str, prefix: str = "osm_changes"):
+        """Write the metrics in the Prometheus text format, e.g. for the node exporter's textfile collector"""
+        summary = self.summary()
+        lines = [
+            f"# HELP {prefix}_stage_seconds Time spent in each stage of the run",
+            f"# TYPE {prefix}_stage_seconds summary",
+        ]
+        for name, timer in summary["timers"].items():
+            for quantile in ("0.5", "0.95"):
+                key = "p50_seconds" if quantile == "0.5" else "p95_seconds"
+                lines.append(f'{prefix}_stage_seconds{{stage="{name}",quantile="{quantile}"}} {timer[key]}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {timer["total_seconds"]}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {timer["count"]}')
+        for name, value in summary["counters"].items():
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total {value}")
+        lines.append(f"# TYPE {prefix}_run_seconds gauge")
+        lines.append(f"{prefix}_run_seconds {summary['wall_seconds']}")
+
+        # write to a temporary file and rename, so the collector never reads a half-written file
+        tmp_filepath = f"{filepath}.{os.getpid()}.tmp"
+        with open(tmp_filepath, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_filepath, filepath)
+        logger.info(f"Saved Prometheus metrics to {filepath}")
+
+
+# Define a global metrics instance, turned on by the config's "metrics" option
+metrics = Metrics()
+
+
+def configure_metrics(enabled: bool):
+    metrics.reset(enabled)
@@ -0,0 +1,110 @@
+"""Write detection masks for a whole area into a single Cloud-Optimized GeoTIFF.
+
+Tiles are written straight into their window of an internally tiled, compressed GeoTIFF in the
+tiles' native EPSG:3857, so the whole mosaic is never held in memory. Overviews are built when
+the writer is closed and the file is rewritten in COG layout.
+"""
+
+import os
+import numpy as np
+import rasterio  # type: ignore
+from rasterio.enums import Resampling  # type: ignore
+from rasterio.shutil import copy as copy_dataset  # type: ignore
+from rasterio.transform import from_bounds  # type: ignore
+from rasterio.windows import Window  # type: ignore
+from osm_changes.coordinates import tile_to_mercator
+from osm_changes.types import Coordinate, Image
+from osm_changes.logger import logger
+
+
+class MosaicWriter:
+    def __init__(
+        self,
+        filepath: str,
+        x_range: range,
+        y_range: range,
+        zoom: int,
+        tile_size: int = 256,
+        compress: str = "DEFLATE",
+        resampling: str = "average",
+    ):
+        self.filepath = filepath
+        self.x_range = x_range
+        self.y_range = y_range
+        self.zoom = zoom
+        self.tile_size = tile_size
+        self.compress = compress
+        # how overviews are made: "average" for masks, "nearest" for rasters of codes or indices, which can't be
+        # averaged
+        self.resampling = Resampling[resampling]
+        self.width = len(x_range) * tile_size
+        self.height = len(y_range) * tile_size
+
+        west, north = tile_to_mercator(x_range.start, y_range.start, zoom)
+        east, south = tile_to_mercator(x_range.stop, y_range.stop, zoom)
+        self.transform = from_bounds(west, south, east, north, self.width, self.height)
+
+        # tiles are written to a plain tiled GeoTIFF first, then copied into COG layout on close
+        os.makedirs(os.path.dirname(os.path.abspath(filepath)), exist_ok=True)
+        self._tmp_filepath = f"{filepath}.tmp.tif"
+        self._dataset = rasterio.open(  # type: ignore
+            self._tmp_filepath,
+            "w",
+            driver="GTiff",
+            width=self.width,
+            height=self.height,
+            count=1,
+            dtype="uint8",
+            crs="EPSG:3857",
+            transform=self.transform,
+            tiled=True,
+            blockxsize=tile_size,
+            blockysize=tile_size,
+            compress=compress,
+            BIGTIFF="IF_SAFER",
+        )
+
+    @classmethod
+    def for_tiles(cls, filepath: str, tiles: list[Coordinate], zoom: int, **kwargs) -> "MosaicWriter":
+        """A writer covering the bounding box of a set of tiles"""
+        xs = [int(tile[0]) for tile in tiles]
+        ys = [int(tile[1]) for tile in tiles]
+        return cls(filepath, range(min(xs), max(xs) + 1), range(min(ys), max(ys) + 1), zoom, **kwargs)
+
+    def write_tile(self, tile: Coordinate, mask: Image):
+        """Write a tile's mask into its window of the mosaic. Bool masks are written as 0/255."""
+        if mask.dtype == bool:
+            mask = mask.astype(np.uint8) * 255
+        col = (int(tile[0]) - self.x_range.start) * self.tile_size
+        row = (int(tile[1]) - self.y_range.start) * self.tile_size
+        self._dataset.write(mask, 1, window=Window(col, row, mask.shape[1], mask.shape[0]))  # type: ignore
+
+    def close(self):
+        """Build overviews and rewrite the mosaic as a Cloud-Optimized GeoTIFF"""
+        factors = []
+        factor = 2
+        while max(self.width, self.height) // factor >= self.tile_size:
+            factors.append(factor)
+            factor *= 2
+        if factors:
+            # averaging masks keeps small changes visible as density when zoomed out
+            self._dataset.build_overviews(factors, self.resampling)  # type: ignore
+        self._dataset.close()
+
+        logger.info(f"Writing mosaic to {self.filepath}")
+        copy_dataset(
+            self._tmp_filepath,
+            self.filepath,
+            driver="COG",
+            compress=self.compress,
+            blocksize=self.tile_size,
+            resampling=self.resampling.name.upper(),
+            BIGTIFF="IF_SAFER",
+        )
+        os.remove(self._tmp_filepath)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
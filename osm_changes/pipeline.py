@@ -0,0 +1,235 @@
+"""Stream tiles through download, detection and writing at the same time.
+
+Each tile moves through three stages linked by bounded queues:
+
+    fetch (download_workers threads) -> detect (detect_workers) -> write (main thread)
+
+so detecting one tile overlaps with downloading the next ones, and the number of tiles held in
+memory is bounded by the queue sizes however large the area is.
+"""
+
+import queue
+import threading
+from dataclasses import dataclass, field
+from typing import Callable
+from osm_changes.config import Config
+from osm_changes.detector import Detector, MaskSink, _process_tile_data
+from osm_changes.downloader import Downloader, TileNotFoundError
+from osm_changes.logger import logger
+from osm_changes.metrics import metrics
+from osm_changes.storage import TileStore, TileRecord, open_tile_store
+from osm_changes.types import Coordinate, Image
+
+# put on a queue once per consumer thread to tell it to stop
+_DONE = object()
+
+
+@dataclass
+class TileJob:
+    tile: Coordinate
+    # the tile's place in the run, the order its mask is handed to the sinks in
+    index: int = 0
+    # the tile's bytes from each of the detector's input layers, None where the server has no tile
+    data: list[bytes | None] | None = None
+    # newly downloaded tiles, stored by the write stage
+    downloaded: list[TileRecord] = field(default_factory=list)
+    status: str | None = None
+    error: str | None = None
+    mask: Image | None = None
+
+
+class Pipeline:
+    def __init__(
+        self,
+        cfg: Config,
+        store: TileStore | None = None,
+        downloader: Downloader | None = None,
+        detector: Detector | None = None,
+    ):
+        self.store = store if store is not None else open_tile_store(cfg)
+        self.downloader = downloader if downloader is not None else Downloader(cfg, store=self.store)
+        self.detector = detector if detector is not None else Detector(cfg, store=self.store)
+        self.zoom = cfg.zoom
+        self.queue_size: int = cfg.pipeline_queue_size
+        self.fetch_workers = max(1, cfg.download_workers)
+        self.detect_workers = max(1, cfg.detect_workers)
+        self.batch_size = 256
+
+    def fetch(self, job: TileJob) -> TileJob:
+        """Read the tile from each input layer, downloading any that are missing from the store"""
+        x, y = int(job.tile[0]), int(job.tile[1])
+        try:
+            if not self.detector.use_manifest and self.detector.output_exists(job.tile):
+                job.status = "existing"
+                return job
+            data: list[bytes | None] = []
+            for layer in self.detector.input_layers:
+                tile_data = self.store.get(layer, self.zoom, x, y)
+                if tile_data is not None and self.downloader.is_fresh(layer, self.zoom, x, y):
+                    metrics.count("download_cached")
+                elif tile_data is None and self.store.is_missing(layer, self.zoom, x, y):
+                    metrics.count("download_known_missing")
+                else:
+                    # download missing tiles, and revalidate stale ones
+                    try:
+                        new_data = self.downloader.update_tile(
+                            x, y, zoom=self.zoom, layer=layer, stored=tile_data is not None
+                        )
+                    except TileNotFoundError:
+                        metrics.count("download_not_found")
+                        self.store.put_missing(layer, self.zoom, x, y)
+                        new_data = None
+                    if new_data is not None:
+                        tile_data = new_data
+                        job.downloaded.append((layer, self.zoom, x, y, tile_data))
+                data.append(tile_data)
+            job.data = data
+            if self.detector.use_manifest:
+                # with the manifest, whether the output is up to date depends on the inputs just fetched. With
+                # min_area it also depends on the neighbours', which may not be fetched yet, so finish_cleanup
+                # decides once they all have been
+                self.detector.hash_inputs(job.tile, data)
+                if not self.detector.cleans_regions and self.detector.output_exists(job.tile):
+                    job.status = "existing"
+                    job.data = None
+        except Exception as e:
+            job.status = "failed"
+            job.error = f"{type(e).__name__}: {e}"
+        return job
+
+    def run(self, tiles: set[Coordinate]) -> dict[str, int]:
+        ordered_tiles = sorted((int(tile[0]), int(tile[1])) for tile in tiles)
+        # the inputs are hashed as they're fetched
+        self.detector.open_manifest()
+        try:
+            counts = self._run(ordered_tiles)
+        finally:
+            self.detector.close_manifest()
+        self.detector.log_counts(counts)
+        return counts
+
+    def _run(self, ordered_tiles: list[Coordinate]) -> dict[str, int]:
+        if self.detector.cleans_regions:
+            # stream the raw masks to a temporary store, and write the cleaned up outputs at the end
+            raw_masks = self.detector.start_cleanup()
+            sinks: list[MaskSink] = [raw_masks]
+        else:
+            sinks = self.detector.open_sinks(ordered_tiles)
+            self.detector.return_masks = len(sinks) > 0
+
+        # only start a process pool once the detector is set up, as the workers get a copy of it
+        pool = self.detector.process_pool(self.detect_workers) if self.detect_workers > 1 else None
+
+        def detect(job: TileJob) -> TileJob:
+            if job.status is not None:
+                return job  # existing or failed to download
+            assert job.data is not None
+            if pool is None:
+                result = self.detector.try_process_tile(job.tile, job.data)
+            else:
+                result, worker_metrics = pool.submit(_process_tile_data, job.tile, job.data).result()
+                metrics.merge(worker_metrics)
+            _, job.status, job.error, job.mask = result
+            # the tile bytes are no longer needed, don't hold on to them while waiting to be written
+            job.data = None
+            return job
+
+        tile_queue: queue.Queue = queue.Queue(maxsize=self.queue_size)
+        fetched_queue: queue.Queue = queue.Queue(maxsize=self.queue_size)
+        detected_queue: queue.Queue = queue.Queue(maxsize=self.queue_size)
+
+        def feed():
+            for index, tile in enumerate(ordered_tiles):
+                tile_queue.put(TileJob(tile, index))
+            for _ in range(self.fetch_workers):
+                tile_queue.put(_DONE)
+
+        threads = [threading.Thread(target=feed, daemon=True)]
+        threads += _start_stage(self.fetch, tile_queue, fetched_queue, self.fetch_workers, self.detect_workers)
+        threads += _start_stage(detect, fetched_queue, detected_queue, self.detect_workers, 1)
+        threads[0].start()
+
+        counts = {"processed": 0, "unchanged": 0, "missing": 0, "skipped": 0, "existing": 0, "failed": 0}
+        self.failed_tiles: list[tuple[Coordinate, str]] = []
+        detected: dict[Coordinate, str] = {}
+        batch: list[TileRecord] = []
+        # tiles finish in whatever order the threads get through them, but sinks like the vector writer need
+        # them in order, so they're held here until the tiles before them are done. Only the tiles in the
+        # queues can overtake each other, so this holds at most a few queues' worth.
+        held: dict[int, TileJob] = {}
+        next_index = 0
+        try:
+            while (job := detected_queue.get()) is not _DONE:
+                batch.extend(job.downloaded)
+                if len(batch) >= self.batch_size:
+                    self.store.put_many(batch)
+                    batch.clear()
+
+                assert job.status is not None
+                counts[job.status] += 1
+                if job.error is not None:
+                    logger.error(f"Failed to process tile {self.zoom}/{job.tile[0]}/{job.tile[1]}: {job.error}")
+                    self.failed_tiles.append((job.tile, job.error))
+                if job.status in ("processed", "unchanged", "missing"):
+                    detected[job.tile] = job.status
+                held[job.index] = job
+                while next_index in held:
+                    ready = held.pop(next_index)
+                    next_index += 1
+                    if ready.mask is not None:
+                        self.detector.write_sinks(sinks, ready.tile, ready.mask)
+                if not self.detector.cleans_regions:
+                    self.detector.record_output(job.tile, job.status)
+        finally:
+            self.store.put_many(batch)
+            self.downloader.flush_metadata()
+            for sink in sinks:
+                sink.close()
+            if pool is not None:
+                pool.shutdown()
+
+        for thread in threads:
+            thread.join()
+
+        if self.detector.cleans_regions:
+            for tile in self.detector.finish_cleanup(raw_masks, list(detected)):
+                counts[detected[tile]] -= 1
+                counts["existing"] += 1
+        return counts
+
+
+def _start_stage(
+    func: Callable[[TileJob], TileJob],
+    inbox: queue.Queue,
+    outbox: queue.Queue,
+    workers: int,
+    downstream_workers: int,
+) -> list[threading.Thread]:
+    """Start `workers` threads passing jobs from inbox to outbox through func.
+    The last thread to finish tells each downstream thread to stop."""
+    remaining = [workers]
+    lock = threading.Lock()
+
+    def loop():
+        try:
+            while (job := inbox.get()) is not _DONE:
+                try:
+                    job = func(job)
+                except Exception as e:
+                    # e.g. a broken process pool, the job is still passed on so the run doesn't wait for it
+                    job.status = "failed"
+                    job.error = f"{type(e).__name__}: {e}"
+                    job.data = None
+                outbox.put(job)
+        finally:
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                for _ in range(downstream_workers):
+                    outbox.put(_DONE)
+
+    threads = [threading.Thread(target=loop, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    return threads
@@ -0,0 +1,112 @@
+"""A pyramid of change density tiles, for viewing large areas zoomed out.
+
+The base level, at the detection zoom, holds each tile's change mask. Each level below is built 2x2 from
+the one above it, so every pixel holds the fraction of the area under it that changed, as a greyscale PNG
+(0 for no change, 255 where everything changed). Tiles are laid out z/x/y like TileFilepath, so the layer
+directory can be served as it is as an XYZ layer. Tiles with no change at all aren't written.
+
+Only the tiles whose base tiles changed are rebuilt, so rerunning a detection over part of an area only
+updates the tiles above that part. For the layers outputs a pixel counts as changed if it changed in any
+epoch, for transitions if its class changed.
+"""
+
+import io
+import os
+from typing import Callable
+import numpy as np
+from PIL import Image as PILImage  # type: ignore
+from osm_changes.config import TileFilepath
+from osm_changes.logger import logger
+from osm_changes.types import Coordinate, Image
+
+
+class PyramidWriter:
+    """Writes the base level of the pyramid from each tile's output, then rebuilds the levels below on close.
+
+    :param layer: the pyramid's layer name, used in its TileFilepath paths
+    :param zoom: the zoom level of the tiles written
+    :param min_zoom: the lowest zoom level built
+    :param to_mask: turns a tile's output into a boolean change mask, e.g. for outputs holding codes
+    """
+
+    def __init__(
+        self,
+        layer: str,
+        zoom: int,
+        min_zoom: int,
+        to_mask: Callable[[Image], Image] | None = None,
+        tile_size: int = 256,
+    ):
+        if min_zoom > zoom:
+            raise ValueError(f"The pyramid's min_zoom {min_zoom} is above the detection zoom {zoom}")
+        self.layer = layer
+        self.zoom = zoom
+        self.min_zoom = min_zoom
+        self.to_mask = to_mask
+        self.tile_size = tile_size
+        # tiles of the next level down whose children have changed
+        self._dirty: set[Coordinate] = set()
+
+    def path(self, x: int, y: int, zoom: int) -> str:
+        return str(TileFilepath(self.layer, x, y, zoom, output="png"))
+
+    def write_tile(self, tile: Coordinate, mask: Image):
+        if self.to_mask is not None:
+            mask = self.to_mask(mask)
+        density = mask.astype(bool).astype(np.uint8) * np.uint8(255)
+        x, y = int(tile[0]), int(tile[1])
+        if self._write(x, y, self.zoom, density) and self.zoom > self.min_zoom:
+            self._dirty.add((x // 2, y // 2))
+
+    def close(self):
+        rebuilt = 0
+        for zoom in range(self.zoom - 1, self.min_zoom - 1, -1):
+            dirty = set()
+            for x, y in sorted(self._dirty):
+                rebuilt += 1
+                if self._write(x, y, zoom, self.aggregate(x, y, zoom)) and zoom > self.min_zoom:
+                    dirty.add((x // 2, y // 2))
+            self._dirty = dirty
+        logger.info(f"Rebuilt {rebuilt} tiles of the {self.layer} pyramid")
+
+    def aggregate(self, x: int, y: int, zoom: int) -> Image:
+        """A tile's density, averaging each 2x2 block of pixels of its four children"""
+        ts = self.tile_size
+        children = np.zeros((2 * ts, 2 * ts), dtype=np.uint16)
+        for j in range(2):
+            for i in range(2):
+                child = self._read(2 * x + i, 2 * y + j, zoom + 1)
+                if child is not None:
+                    children[j * ts : (j + 1) * ts, i * ts : (i + 1) * ts] = child
+        total = children.reshape(ts, 2, ts, 2).sum(axis=(1, 3))
+        # round to the nearest value, but keep any change at least 1 so sparse changes don't vanish lower down
+        return np.maximum((total + 2) // 4, total > 0).astype(np.uint8)
+
+    def _read(self, x: int, y: int, zoom: int) -> Image | None:
+        try:
+            with PILImage.open(self.path(x, y, zoom)) as image:
+                return np.asarray(image.convert("L"))
+        except FileNotFoundError:
+            return None
+
+    def _write(self, x: int, y: int, zoom: int, density: Image) -> bool:
+        """Write a tile, or remove it if it's empty. Returns whether it changed."""
+        path = self.path(x, y, zoom)
+        if not density.any():
+            if os.path.exists(path):
+                os.remove(path)
+                return True
+            return False
+
+        buffer = io.BytesIO()
+        PILImage.fromarray(density, mode="L").save(buffer, format="PNG")
+        data = buffer.getvalue()
+        try:
+            with open(path, "rb") as f:
+                if f.read() == data:
+                    return False
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        return True
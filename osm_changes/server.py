@@ -0,0 +1,265 @@
+"""An XYZ tile server that detects changes on demand, e.g. for viewing in QGIS without a run first.
+
+Tiles are served at /{layer1}/{layer2}/{label}/{z}/{x}/{y}.png, showing in red where pixels changed from
+the config's initial_label to `label` between the two layers, and transparent elsewhere. The source tiles
+are read from the tile store, or downloaded into it first, so a viewer panning around only ever fetches
+the tiles it looks at.
+
+Detected tiles are kept in a bounded in-memory LRU cache, and written to a cache directory so they
+survive a restart, until the detection settings change or the live layers' tiles expire. Requests for a
+tile that's already being detected wait for that detection rather than starting another, so a viewer
+asking for the same tile twice, or two viewers side by side, only download and detect it once.
+
+Run it with `python -m osm_changes.server` and add an XYZ Tiles connection in QGIS with the URL
+http://127.0.0.1:8080/201610/202310/Building/{z}/{x}/{y}.png
+"""
+
+import argparse
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+import numpy as np
+from osm_changes.config import Config
+from osm_changes.detector import Detector
+from osm_changes.downloader import Downloader, layer_urls
+from osm_changes.logger import logger
+from osm_changes.metrics import metrics
+from osm_changes.storage import TileStore, open_tile_store, tile_hash, write_file
+from osm_changes.types import Image
+
+TILE_PATH = re.compile(r"^/(?P<layer1>\w+)/(?P<layer2>\w+)/(?P<label>\w+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.png$")
+
+# changed pixels are drawn in this colour over a transparent background
+CHANGE_COLOUR = (255, 0, 0)
+
+# the detector parameters a change tile depends on, the others are about how a run writes its outputs
+CLASSIFICATION_PARAMETERS = ("layers", "labels", "class_colors", "class_tolerance")
+
+# the hash of the detector's classification parameters, then layer1, layer2, label, z, x, y
+TileKey = tuple[str, str, str, str, int, int, int]
+
+
+class TileNotServed(ValueError):
+    """The request isn't for a tile the server can make, answered with a 404"""
+
+
+class ChangeTileServer:
+    """Makes change tiles on demand, caching them in memory and on disk.
+
+    Cached tiles are keyed by a hash of the detector's CLASSIFICATION_PARAMETERS as well as the tile, so
+    changing e.g. initial_label or class_tolerance in the config makes new tiles rather than serving the old
+    ones, while options for runs like output or min_area keep the cache. Tiles
+    made from a layer with a max age in layer_max_age are made again once they're older than that.
+
+    :param cache_size: number of tiles kept in memory
+    :param cache_dir: directory the tiles are also written to, None to keep them in memory only
+    """
+
+    def __init__(
+        self,
+        cfg: Config,
+        store: TileStore | None = None,
+        downloader: Downloader | None = None,
+        cache_size: int = 4096,
+        cache_dir: str | None = None,
+    ):
+        self.cfg = cfg
+        self.store = store if store is not None else open_tile_store(cfg)
+        self.downloader = downloader if downloader is not None else Downloader(cfg, store=self.store)
+        self.cache_size = cache_size
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+        # each tile with the time it was made
+        self._cache: OrderedDict[TileKey, tuple[bytes, float]] = OrderedDict()
+        # tiles being made, which other requests for them wait on
+        self._in_flight: dict[TileKey, Future[bytes]] = {}
+        self._detectors: dict[tuple[str, str, str], tuple[Detector, str]] = {}
+
+    def tile(self, layer1: str, layer2: str, label: str, z: int, x: int, y: int) -> bytes:
+        """The PNG change tile, from the cache or made now"""
+        for layer in (layer1, layer2):
+            if layer not in layer_urls:
+                raise TileNotServed(f"Unknown layer {layer}")
+        if label not in Detector.class_colors:
+            raise TileNotServed(f"Unknown label {label}, labels are {list(Detector.class_colors)}")
+        if x >= 2**z or y >= 2**z:
+            raise TileNotServed(f"Tile {z}/{x}/{y} is outside the map")
+
+        _, parameters_hash = self.detector(layer1, layer2, label)
+        key = (parameters_hash, layer1, layer2, label, z, x, y)
+        max_age = self.max_age(layer1, layer2)
+        with self.lock:
+            cached = self._cache.get(key)
+            if cached is not None and _is_fresh(cached[1], max_age):
+                self._cache.move_to_end(key)
+                metrics.count("server_memory_hits")
+                return cached[0]
+            future = self._in_flight.get(key)
+            making = future is None
+            if making:
+                future = self._in_flight[key] = Future()
+        if not making:
+            metrics.count("server_coalesced")
+            return future.result()  # type: ignore
+
+        try:
+            cached = self._read_cache_file(key, max_age)
+            if cached is None:
+                cached = self.make_tile(layer1, layer2, label, z, x, y), time.time()
+                self._write_cache_file(key, cached[0])
+        except BaseException as e:
+            with self.lock:
+                del self._in_flight[key]
+            future.set_exception(e)  # type: ignore
+            raise
+        with self.lock:
+            self._cache[key] = cached
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            del self._in_flight[key]
+        future.set_result(cached[0])  # type: ignore
+        return cached[0]
+
+    def detector(self, layer1: str, layer2: str, label: str) -> tuple[Detector, str]:
+        """The detector for a pair of layers and label, and the hash of its classification parameters"""
+        with self.lock:
+            cached = self._detectors.get((layer1, layer2, label))
+            if cached is None:
+                detector = Detector(self.cfg, store=self.store)
+                detector.set_layers(layer1, layer2)
+                detector.set_target(self.cfg.initial_label, label)
+                parameters = detector.parameters()
+                classification = json.dumps({key: parameters[key] for key in CLASSIFICATION_PARAMETERS}, sort_keys=True)
+                cached = self._detectors[(layer1, layer2, label)] = (detector, tile_hash(classification.encode())[:16])
+            return cached
+
+    def max_age(self, layer1: str, layer2: str) -> float | None:
+        """Seconds a tile made from the two layers stays fresh, None if it never expires"""
+        ages = [age for age in (self.downloader.max_age(layer1), self.downloader.max_age(layer2)) if age is not None]
+        return min(ages) if ages else None
+
+    def make_tile(self, layer1: str, layer2: str, label: str, z: int, x: int, y: int) -> bytes:
+        detector, _ = self.detector(layer1, layer2, label)
+        data1 = self.downloader.read_tile(layer1, z, x, y)
+        data2 = self.downloader.read_tile(layer2, z, x, y)
+        with metrics.timer("server_detect"):
+            mask = detector.detect_changes_in_tile_bytes(data1, data2)
+        return encode_mask(mask)
+
+    def cache_filepath(self, key: TileKey) -> str | None:
+        if self.cache_dir is None:
+            return None
+        parameters_hash, layer1, layer2, label, z, x, y = key
+        return os.path.join(self.cache_dir, parameters_hash, layer1, layer2, label, str(z), str(x), f"{y}.png")
+
+    def _read_cache_file(self, key: TileKey, max_age: float | None) -> tuple[bytes, float] | None:
+        filepath = self.cache_filepath(key)
+        if filepath is None:
+            return None
+        try:
+            made = os.path.getmtime(filepath)
+            if not _is_fresh(made, max_age):
+                return None
+            with open(filepath, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        metrics.count("server_disk_hits")
+        return data, made
+
+    def _write_cache_file(self, key: TileKey, data: bytes):
+        filepath = self.cache_filepath(key)
+        if filepath is not None:
+            write_file(filepath, data)
+
+    def close(self):
+        self.downloader.flush_metadata()
+        self.store.close()
+
+
+def _is_fresh(made: float, max_age: float | None) -> bool:
+    return max_age is None or made + max_age > time.time()
+
+
+def encode_mask(mask: Image) -> bytes:
+    """A change mask as a palette PNG, CHANGE_COLOUR where it's set and transparent elsewhere"""
+    from PIL import Image as PILImage  # type: ignore
+
+    image = PILImage.fromarray((np.asarray(mask) > 0).astype(np.uint8), mode="P")
+    image.putpalette([0, 0, 0, *CHANGE_COLOUR])
+    buffer = BytesIO()
+    image.save(buffer, format="PNG", transparency=0, optimize=True)
+    return buffer.getvalue()
+
+
+class TileRequestHandler(BaseHTTPRequestHandler):
+    server: "TileHTTPServer"
+
+    def do_GET(self):
+        match = TILE_PATH.match(self.path.split("?")[0])
+        if match is None:
+            self.send_error(404, "Tiles are at /{layer1}/{layer2}/{label}/{z}/{x}/{y}.png")
+            return
+        try:
+            data = self.server.tiles.tile(
+                match["layer1"], match["layer2"], match["label"], int(match["z"]), int(match["x"]), int(match["y"])
+            )
+        except TileNotServed as e:
+            self.send_error(404, str(e))
+            return
+        except Exception as e:
+            logger.error(f"Failed to make tile {self.path}: {type(e).__name__}: {e}")
+            self.send_error(502, f"{type(e).__name__}: {e}")
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+class TileHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], tiles: ChangeTileServer):
+        super().__init__(address, TileRequestHandler)
+        self.tiles = tiles
+
+
+def serve(cfg: Config, host: str | None = None, port: int | None = None):
+    tiles = ChangeTileServer(
+        cfg, cache_size=cfg.server_cache_size, cache_dir=cfg.resolve_output_path(cfg.server_cache_dir)
+    )
+    server = TileHTTPServer((host or cfg.server_host, port or cfg.server_port), tiles)
+    host, port = server.server_address[:2]
+    logger.info(f"Serving change tiles at http://{host}:{port}/{{layer1}}/{{layer2}}/{{label}}/{{z}}/{{x}}/{{y}}.png")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        tiles.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", help="address to listen on, by default server_host from the config")
+    parser.add_argument("--port", type=int, help="port to listen on, by default server_port from the config")
+    args = parser.parse_args()
+    serve(Config(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
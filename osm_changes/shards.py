@@ -0,0 +1,342 @@
+"""Split a large area into shards of tiles, and run them from any number of workers over a shared queue.
+
+The queue is a SQLite file, e.g. on a filesystem shared by all the hosts. Each shard is a square block of
+tiles with a status, an attempt count and, while a worker is running it, a lease that the worker keeps
+renewing. A worker that crashes stops renewing its lease, and once the lease has run out the shard is
+handed to the next worker to ask for one. A shard that fails max_attempts times is left as failed.
+
+    python -m osm_changes.shards create   # split the config's area into shards
+    python -m osm_changes.shards work     # claim and run shards until there are none left, on each host
+    python -m osm_changes.shards status   # number of shards with each status
+    python -m osm_changes.shards retry    # run the failed shards again
+
+Outputs are written per tile, so shards never write to the same file. Shards run the same download and
+detection as a normal run, so a shard that is run twice (e.g. when a slow worker's lease ran out) just
+finds its tiles already downloaded. Options that write a file for the whole run, or that look across tile
+edges (mask_array, pyramid, the counts CSV of the layers and transitions outputs, and min_area) aren't
+supported, as each shard would only see its own tiles.
+
+The other SQLite files of a run use WAL, which doesn't work over a network filesystem, so with more than
+one host the 'sqlite' tile store and the manifest have to be kept on each host's own disk, with an
+absolute tile_store_path and manifest_path, or the 'directory' tile store used. The 'directory' tile store
+keeps the ETag/Last-Modified of layers in layer_max_age in a SQLite file too, so it needs an absolute
+tile_metadata_path.
+"""
+
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from typing import NamedTuple
+from osm_changes.config import Config, TILE_OUTPUTS
+from osm_changes.grid import Grid
+from osm_changes.logger import logger
+from osm_changes.types import Coordinate
+
+STATUSES = ("pending", "running", "done", "failed")
+
+
+class Shard(NamedTuple):
+    shard_id: int
+    zoom: int
+    min_x: int
+    min_y: int
+    max_x: int
+    max_y: int
+    attempts: int
+
+    def tiles(self) -> set[Coordinate]:
+        return {(x, y) for x in range(self.min_x, self.max_x + 1) for y in range(self.min_y, self.max_y + 1)}
+
+
+class ShardQueue:
+    """The shards of a run, shared between workers through a SQLite file.
+
+    Every claim or update is a single short transaction, so a queue on a shared filesystem can serve many
+    workers. The rollback journal is used rather than WAL, which needs shared memory between the processes.
+
+    :param lease_seconds: how long a claimed shard is held without being renewed
+    :param max_attempts: number of times a shard is tried before it is left as failed
+    """
+
+    def __init__(self, filepath: str, lease_seconds: float = 600, max_attempts: int = 3, timeout: float = 60):
+        self.filepath = filepath
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        os.makedirs(os.path.dirname(os.path.abspath(filepath)), exist_ok=True)
+        # transactions are started explicitly, so claims can take the write lock before reading
+        self.connection = sqlite3.connect(filepath, timeout=timeout, isolation_level=None)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS shards ("
+            "shard_id INTEGER PRIMARY KEY, zoom_level INTEGER NOT NULL, "
+            "min_x INTEGER NOT NULL, min_y INTEGER NOT NULL, max_x INTEGER NOT NULL, max_y INTEGER NOT NULL, "
+            "status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, "
+            "worker TEXT, lease_expires REAL, error TEXT, counts TEXT, "
+            "UNIQUE (zoom_level, min_x, min_y))"
+        )
+
+    def _transaction(self):
+        return _Transaction(self.connection)
+
+    def create(self, tiles: set[Coordinate], zoom: int, shard_size: int) -> int:
+        """Split the tiles into blocks of shard_size x shard_size tiles and add them to the queue.
+
+        Blocks are aligned to multiples of shard_size, so creating the shards of an area again only adds
+        the ones not already in the queue. Returns the number of shards added.
+        """
+        blocks: dict[Coordinate, list[int]] = {}
+        for x, y in tiles:
+            x, y = int(x), int(y)
+            block = blocks.get((x // shard_size, y // shard_size))
+            if block is None:
+                blocks[(x // shard_size, y // shard_size)] = [x, y, x, y]
+            else:
+                block[0], block[1] = min(block[0], x), min(block[1], y)
+                block[2], block[3] = max(block[2], x), max(block[3], y)
+
+        with self._transaction():
+            before = self.connection.total_changes
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO shards (zoom_level, min_x, min_y, max_x, max_y) VALUES (?, ?, ?, ?, ?)",
+                [(zoom, *block) for _, block in sorted(blocks.items())],
+            )
+            added = self.connection.total_changes - before
+        logger.info(
+            f"Added {added} shards of up to {shard_size}x{shard_size} tiles, {len(blocks) - added} already queued"
+        )
+        return added
+
+    def claim(self, worker: str) -> Shard | None:
+        """Lease the next pending shard, or one whose lease has run out, or None if there are none left"""
+        now = time.time()
+        with self._transaction():
+            # the workers of these crashed on their last attempt
+            self.connection.execute(
+                "UPDATE shards SET status = 'failed', worker = NULL, lease_expires = NULL, error = 'lease expired' "
+                "WHERE status = 'running' AND lease_expires < ? AND attempts >= ?",
+                (now, self.max_attempts),
+            )
+            row = self.connection.execute(
+                "SELECT shard_id, zoom_level, min_x, min_y, max_x, max_y, attempts FROM shards "
+                "WHERE (status = 'pending' OR (status = 'running' AND lease_expires < ?)) AND attempts < ? "
+                "ORDER BY shard_id LIMIT 1",
+                (now, self.max_attempts),
+            ).fetchone()
+            if row is None:
+                return None
+            shard = Shard(*row[:-1], attempts=row[-1] + 1)
+            self.connection.execute(
+                "UPDATE shards SET status = 'running', attempts = ?, worker = ?, lease_expires = ? WHERE shard_id = ?",
+                (shard.attempts, worker, now + self.lease_seconds, shard.shard_id),
+            )
+        if shard.attempts > 1:
+            logger.warning(f"Shard {shard.shard_id} is being run again, attempt {shard.attempts}")
+        return shard
+
+    def renew(self, shard: Shard, worker: str) -> bool:
+        """Extend the lease on a shard, returning False if the worker no longer holds it"""
+        with self._transaction():
+            cursor = self.connection.execute(
+                "UPDATE shards SET lease_expires = ? WHERE shard_id = ? AND worker = ? AND status = 'running'",
+                (time.time() + self.lease_seconds, shard.shard_id, worker),
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, shard: Shard, worker: str, counts: dict[str, int]):
+        self._finish(shard, worker, "done", counts=json.dumps(counts))
+
+    def fail(self, shard: Shard, worker: str, error: str):
+        """Record a failed attempt, leaving the shard for another try unless it has used up its attempts"""
+        status = "failed" if shard.attempts >= self.max_attempts else "pending"
+        self._finish(shard, worker, status, error=error)
+
+    def _finish(self, shard: Shard, worker: str, status: str, counts: str | None = None, error: str | None = None):
+        with self._transaction():
+            cursor = self.connection.execute(
+                "UPDATE shards SET status = ?, worker = NULL, lease_expires = NULL, counts = ?, error = ? "
+                "WHERE shard_id = ? AND worker = ? AND status = 'running'",
+                (status, counts, error, shard.shard_id, worker),
+            )
+        if cursor.rowcount == 0:
+            logger.warning(f"Lost the lease on shard {shard.shard_id} to another worker, not recording it as {status}")
+
+    def retry_failed(self) -> int:
+        """Make the failed shards pending again with no attempts, returning how many there were"""
+        with self._transaction():
+            cursor = self.connection.execute(
+                "UPDATE shards SET status = 'pending', attempts = 0, error = NULL WHERE status = 'failed'"
+            )
+        return cursor.rowcount
+
+    def status(self) -> dict[str, int]:
+        """The number of shards with each status, counting running shards whose lease ran out as pending,
+        or failed if they have no attempts left"""
+        counts = dict.fromkeys(STATUSES, 0)
+        rows = self.connection.execute(
+            "SELECT CASE WHEN status != 'running' OR lease_expires >= ? THEN status "
+            "WHEN attempts < ? THEN 'pending' ELSE 'failed' END, COUNT(*) FROM shards GROUP BY 1",
+            (time.time(), self.max_attempts),
+        )
+        for status, n in rows:
+            counts[status] = n
+        return counts
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE takes the write lock up front, so two workers can't claim the same shard"""
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+
+    def __exit__(self, exc_type, *args):
+        self.connection.execute("ROLLBACK" if exc_type is not None else "COMMIT")
+        return False
+
+
+class _LeaseRenewer:
+    """Renews a shard's lease in the background while it runs, with its own connection to the queue"""
+
+    def __init__(self, queue: ShardQueue, shard: Shard, worker: str):
+        self.queue = ShardQueue(queue.filepath, lease_seconds=queue.lease_seconds, max_attempts=queue.max_attempts)
+        self.shard = shard
+        self.worker = worker
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._renew, daemon=True)
+
+    def _renew(self):
+        while not self.stopped.wait(self.queue.lease_seconds / 3):
+            try:
+                if not self.queue.renew(self.shard, self.worker):
+                    logger.warning(f"Lost the lease on shard {self.shard.shard_id}")
+                    return
+            except sqlite3.Error as e:
+                # try again next time, the lease has time left
+                logger.warning(f"Failed to renew the lease on shard {self.shard.shard_id}: {e}")
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+        self.queue.close()
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def open_shard_queue(cfg: Config) -> ShardQueue:
+    return ShardQueue(
+        cfg.resolve_output_path(cfg.shard_queue_path),
+        lease_seconds=cfg.shard_lease_seconds,
+        max_attempts=cfg.shard_max_attempts,
+    )
+
+
+def check_shardable(cfg: Config):
+    """Raise a ValueError if the config has options that can't be split into shards"""
+    if cfg.output not in TILE_OUTPUTS:
+        raise ValueError(f"Sharded runs write an output per tile, use one of {TILE_OUTPUTS} rather than {cfg.output}")
+    # each of these covers the whole run, so every shard would replace the others'
+    whole_run = {
+        "mask_array": cfg.mask_array,
+        "pyramid": cfg.pyramid,
+        "layers (its counts CSV)": bool(cfg.layers),
+        "transitions (its counts CSV)": cfg.transitions,
+        # regions crossing a shard edge would be cut in two and measured as smaller than they are
+        "min_area": cfg.min_area > 0,
+    }
+    unsupported = [option for option, used in whole_run.items() if used]
+    if unsupported:
+        raise ValueError(f"Sharded runs don't support {', '.join(unsupported)}")
+    # WAL files can't be shared between hosts
+    shared = []
+    if cfg.tile_store == "sqlite" and not os.path.isabs(cfg.tile_store_path):
+        shared.append("tile_store_path")
+    if cfg.manifest and not os.path.isabs(cfg.manifest_path):
+        shared.append("manifest_path")
+    # the directory store keeps the cache metadata of layers that expire in a SQLite file of its own
+    expiring = any(cfg.layer_max_age.get(layer) is not None for layer in (cfg.layer1, cfg.layer2))
+    if cfg.tile_store == "directory" and expiring and not os.path.isabs(cfg.tile_metadata_path or ""):
+        shared.append("tile_metadata_path")
+    if shared:
+        raise ValueError(
+            f"Sharded runs need {' and '.join(shared)} on each host's own disk rather than in the shared "
+            "output_dir, give an absolute path"
+        )
+
+
+def work(cfg: Config, queue: ShardQueue, worker: str | None = None, max_shards: int | None = None) -> int:
+    """Claim and run shards until the queue has none left, or max_shards have been run.
+    Returns the number of shards run."""
+    from osm_changes.__main__ import run
+
+    check_shardable(cfg)
+    if worker is None:
+        worker = default_worker_id()
+    # shards are blocks of tiles, only the ones in an AOI polygon are run
+    cover = Grid(cfg).tiles() if cfg.aoi else None
+    done = 0
+    while max_shards is None or done < max_shards:
+        shard = queue.claim(worker)
+        if shard is None:
+            break
+        logger.info(
+            f"Worker {worker} running shard {shard.shard_id}, "
+            f"tiles x {shard.min_x}-{shard.max_x}, y {shard.min_y}-{shard.max_y}"
+        )
+        with _LeaseRenewer(queue, shard, worker):
+            try:
+                tiles = shard.tiles() if cover is None else shard.tiles() & cover
+                counts = run(cfg, tiles)
+            except Exception as e:
+                logger.error(f"Shard {shard.shard_id} failed: {type(e).__name__}: {e}")
+                queue.fail(shard, worker, f"{type(e).__name__}: {e}")
+            else:
+                queue.complete(shard, worker, counts)
+        done += 1
+    logger.info(f"Worker {worker} finished after {done} shards")
+    return done
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("create", help="split the config's area into shards and add them to the queue")
+    work_parser = subparsers.add_parser("work", help="claim and run shards until there are none left")
+    work_parser.add_argument("--worker-id", help="name of this worker, by default <host>:<pid>")
+    work_parser.add_argument("--max-shards", type=int, help="stop after this many shards")
+    subparsers.add_parser("status", help="print the number of shards with each status")
+    subparsers.add_parser("retry", help="run the failed shards again")
+    args = parser.parse_args()
+
+    cfg = Config()
+    with open_shard_queue(cfg) as queue:
+        if args.command == "create":
+            queue.create(Grid(cfg).tiles(), cfg.zoom, cfg.shard_size)
+        elif args.command == "work":
+            work(cfg, queue, worker=args.worker_id, max_shards=args.max_shards)
+        elif args.command == "retry":
+            logger.info(f"{queue.retry_failed()} failed shards will be run again")
+        print(json.dumps(queue.status()))
+
+
+if __name__ == "__main__":
+    main()
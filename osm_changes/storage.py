@@ -0,0 +1,383 @@
+"""Storage backends for downloaded tiles, keyed by (layer, zoom, x, y).
+
+DirectoryTileStore keeps the original output/<layer>/<zoom>/<x>/<y>.png layout.
+SQLiteTileStore packs every tile into a single MBTiles-style SQLite file.
+
+Identical tiles, like the many blank sea tiles, are only stored once: SQLiteTileStore keeps each distinct
+image once and maps tiles to it, and DirectoryTileStore hard links the tile files to one copy. Both also
+record tiles the server doesn't have (e.g. outside the OS layers' coverage of Great Britain), so they're
+not requested again.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+from typing import Iterable, NamedTuple
+from osm_changes.config import Config, TileFilepath
+from osm_changes.logger import logger
+
+# (layer, zoom, x, y, data)
+TileRecord = tuple[str, int, int, int, bytes]
+
+# extended attribute holding the tile_hash of a DirectoryTileStore tile
+HASH_ATTRIBUTE = "user.osm_changes.tile_hash"
+
+
+class TileStore:
+    """Base class for tile storage backends"""
+
+    def get(self, layer: str, zoom: int, x: int, y: int) -> bytes | None:
+        """The stored bytes of a tile, or None if the tile is not stored"""
+        raise NotImplementedError
+
+    def put(self, layer: str, zoom: int, x: int, y: int, data: bytes) -> None:
+        raise NotImplementedError
+
+    def put_many(self, tiles: Iterable[TileRecord]) -> None:
+        for tile in tiles:
+            self.put(*tile)
+
+    def has(self, layer: str, zoom: int, x: int, y: int) -> bool:
+        return self.get(layer, zoom, x, y) is not None
+
+    def get_hash(self, layer: str, zoom: int, x: int, y: int) -> str | None:
+        """The tile_hash of a stored tile, or None if the tile is not stored"""
+        data = self.get(layer, zoom, x, y)
+        return None if data is None else tile_hash(data)
+
+    def put_missing(self, layer: str, zoom: int, x: int, y: int) -> None:
+        """Record that the server has no tile here"""
+        raise NotImplementedError
+
+    def is_missing(self, layer: str, zoom: int, x: int, y: int) -> bool:
+        """True if the server is known to have no tile here"""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class DirectoryTileStore(TileStore):
+    """One PNG file per tile, laid out as z/x/y like a tile server. Paths come from TileFilepath."""
+
+    def path(self, layer: str, zoom: int, x: int, y: int) -> str:
+        return TileFilepath(layer, x, y, zoom)()
+
+    def get(self, layer: str, zoom: int, x: int, y: int) -> bytes | None:
+        try:
+            with open(self.path(layer, zoom, x, y), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def blob_path(self, filepath: TileFilepath, digest: str) -> str:
+        # identical tiles are hard links to a single copy, named by its hash, under output/.blobs
+        return os.path.join(filepath.output_dir, ".blobs", digest[:2], f"{digest}.png")  # type: ignore
+
+    def put(self, layer: str, zoom: int, x: int, y: int, data: bytes) -> None:
+        filepath = TileFilepath(layer, x, y, zoom)
+        digest = tile_hash(data)
+        blob = self.blob_path(filepath, digest)
+        if not os.path.exists(blob):
+            write_file(blob, data)
+            _record_hash(blob, digest)
+        path = filepath()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # the copy the tile used before, removed below if no other tile links to it any more
+        replaced = self.get_hash(layer, zoom, x, y)
+        old_blob = None if replaced is None or replaced == digest else self.blob_path(filepath, replaced)
+        # replace rather than overwrite, which would change every tile linked to the same copy
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            os.link(blob, tmp_path)
+        except OSError:
+            # e.g. a file system without hard links, where the copy would only take up space
+            _remove_unlinked(blob)
+            write_file(path, data)
+            _record_hash(path, digest)
+        else:
+            os.replace(tmp_path, path)
+        try:
+            os.remove(self.missing_path(layer, zoom, x, y))
+        except FileNotFoundError:
+            pass
+        if old_blob is not None:
+            _remove_unlinked(old_blob)
+
+    def get_hash(self, layer: str, zoom: int, x: int, y: int) -> str | None:
+        # recorded on the tile's copy when it was stored, so the tile isn't read again
+        try:
+            return os.getxattr(self.path(layer, zoom, x, y), HASH_ATTRIBUTE).decode()
+        except FileNotFoundError:
+            return None
+        except (AttributeError, OSError):
+            # no extended attributes on this platform or file system
+            return super().get_hash(layer, zoom, x, y)
+
+    def has(self, layer: str, zoom: int, x: int, y: int) -> bool:
+        return os.path.exists(self.path(layer, zoom, x, y))
+
+    def missing_path(self, layer: str, zoom: int, x: int, y: int) -> str:
+        return os.path.splitext(self.path(layer, zoom, x, y))[0] + ".missing"
+
+    def put_missing(self, layer: str, zoom: int, x: int, y: int) -> None:
+        # an empty marker file in place of the tile
+        write_file(self.missing_path(layer, zoom, x, y), b"")
+
+    def is_missing(self, layer: str, zoom: int, x: int, y: int) -> bool:
+        return os.path.exists(self.missing_path(layer, zoom, x, y))
+
+
+def _record_hash(filepath: str, digest: str):
+    """Record a tile's hash in an extended attribute of its file, shared by every hard link to it"""
+    try:
+        os.setxattr(filepath, HASH_ATTRIBUTE, digest.encode())
+    except (AttributeError, OSError):
+        pass  # get_hash reads and hashes the tile instead
+
+
+def _remove_unlinked(blob: str):
+    """Remove a copy of a tile that no tile links to any more"""
+    try:
+        if os.stat(blob).st_nlink <= 1:
+            os.remove(blob)
+    except FileNotFoundError:
+        pass
+
+
+def tile_hash(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def write_file(filepath: str, data: bytes):
+    """Write a file via a temporary file, so it's never seen half written"""
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    tmp_path = f"{filepath}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, filepath)
+
+
+class SQLiteTileStore(TileStore):
+    """All tiles in a single SQLite file, using the MBTiles column names with an extra layer column.
+
+    Like deduplicated MBTiles, each distinct image is stored once in tile_images and tile_map points each
+    tile at one, with a `tiles` view joining the two.
+
+    Rows are keyed by the XYZ tile row (not the flipped TMS row used by MBTiles proper).
+    The connection is shared between threads behind a lock.
+    """
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.lock = threading.Lock()
+        self._connect()
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.filepath)), exist_ok=True)
+        self.connection = sqlite3.connect(self.filepath, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS tile_images (tile_id TEXT PRIMARY KEY, tile_data BLOB NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS tile_map ("
+                "layer TEXT NOT NULL, zoom_level INTEGER NOT NULL, tile_column INTEGER NOT NULL, "
+                "tile_row INTEGER NOT NULL, tile_id TEXT NOT NULL, "
+                "PRIMARY KEY (layer, zoom_level, tile_column, tile_row)) WITHOUT ROWID"
+            )
+            # to find the images no tile uses any more
+            self.connection.execute("CREATE INDEX IF NOT EXISTS tile_map_tile_id ON tile_map (tile_id)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS missing_tiles ("
+                "layer TEXT NOT NULL, zoom_level INTEGER NOT NULL, tile_column INTEGER NOT NULL, "
+                "tile_row INTEGER NOT NULL, PRIMARY KEY (layer, zoom_level, tile_column, tile_row)) WITHOUT ROWID"
+            )
+            self.connection.execute(
+                "CREATE VIEW IF NOT EXISTS tiles AS "
+                "SELECT layer, zoom_level, tile_column, tile_row, tile_data FROM tile_map JOIN tile_images USING (tile_id)"
+            )
+
+    def __getstate__(self):
+        # connections can't be pickled, worker processes open their own
+        return {"filepath": self.filepath}
+
+    def __setstate__(self, state):
+        self.filepath = state["filepath"]
+        self.lock = threading.Lock()
+        self._connect()
+
+    def get(self, layer: str, zoom: int, x: int, y: int) -> bytes | None:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT tile_data FROM tile_map JOIN tile_images USING (tile_id) "
+                "WHERE layer=? AND zoom_level=? AND tile_column=? AND tile_row=?",
+                (layer, zoom, int(x), int(y)),
+            ).fetchone()
+        return None if row is None else bytes(row[0])
+
+    def put(self, layer: str, zoom: int, x: int, y: int, data: bytes) -> None:
+        self.put_many([(layer, zoom, x, y, data)])
+
+    def put_many(self, tiles: Iterable[TileRecord]) -> None:
+        """Insert a batch of tiles in one transaction, removing the images of replaced tiles no other tile uses"""
+        images: dict[str, bytes] = {}
+        rows = []
+        for layer, zoom, x, y, data in tiles:
+            tile_id = tile_hash(data)
+            images[tile_id] = data
+            rows.append((layer, zoom, int(x), int(y), tile_id))
+        keys = [row[:4] for row in rows]
+        with self.lock, self.connection:
+            replaced = set()
+            for key in keys:
+                old = self.connection.execute(
+                    "SELECT tile_id FROM tile_map WHERE layer=? AND zoom_level=? AND tile_column=? AND tile_row=?", key
+                ).fetchone()
+                if old is not None and old[0] not in images:
+                    replaced.add(old[0])
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO tile_images (tile_id, tile_data) VALUES (?, ?)", images.items()
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO tile_map (layer, zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self.connection.executemany(
+                "DELETE FROM tile_images WHERE tile_id=? AND NOT EXISTS (SELECT 1 FROM tile_map WHERE tile_id=?)",
+                [(tile_id, tile_id) for tile_id in replaced],
+            )
+            self.connection.executemany(
+                "DELETE FROM missing_tiles WHERE layer=? AND zoom_level=? AND tile_column=? AND tile_row=?", keys
+            )
+
+    def has(self, layer: str, zoom: int, x: int, y: int) -> bool:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT 1 FROM tile_map WHERE layer=? AND zoom_level=? AND tile_column=? AND tile_row=?",
+                (layer, zoom, int(x), int(y)),
+            ).fetchone()
+        return row is not None
+
+    def get_hash(self, layer: str, zoom: int, x: int, y: int) -> str | None:
+        # images are keyed by their hash, so the tile data doesn't need to be read
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT tile_id FROM tile_map WHERE layer=? AND zoom_level=? AND tile_column=? AND tile_row=?",
+                (layer, zoom, int(x), int(y)),
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def put_missing(self, layer: str, zoom: int, x: int, y: int) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO missing_tiles (layer, zoom_level, tile_column, tile_row) VALUES (?, ?, ?, ?)",
+                (layer, zoom, int(x), int(y)),
+            )
+
+    def is_missing(self, layer: str, zoom: int, x: int, y: int) -> bool:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT 1 FROM missing_tiles WHERE layer=? AND zoom_level=? AND tile_column=? AND tile_row=?",
+                (layer, zoom, int(x), int(y)),
+            ).fetchone()
+        return row is not None
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
+class TileMetadata(NamedTuple):
+    """HTTP cache validators of a stored tile, and when it was last downloaded or revalidated (a Unix time)"""
+
+    etag: str | None
+    last_modified: str | None
+    checked: float
+
+
+class TileMetadataIndex:
+    """Cache metadata of the stored tiles, in a SQLite table keyed like the tiles.
+
+    Writes are buffered and made in batches, so it can be updated from the download threads.
+    """
+
+    def __init__(self, filepath: str, batch_size: int = 256):
+        self.filepath = filepath
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self._pending: dict[tuple[str, int, int, int], TileMetadata] = {}
+        os.makedirs(os.path.dirname(os.path.abspath(filepath)), exist_ok=True)
+        self.connection = sqlite3.connect(filepath, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS tile_metadata ("
+                "layer TEXT NOT NULL, zoom_level INTEGER NOT NULL, tile_column INTEGER NOT NULL, "
+                "tile_row INTEGER NOT NULL, etag TEXT, last_modified TEXT, checked REAL NOT NULL, "
+                "PRIMARY KEY (layer, zoom_level, tile_column, tile_row)) WITHOUT ROWID"
+            )
+
+    def get(self, layer: str, zoom: int, x: int, y: int) -> TileMetadata | None:
+        key = (layer, zoom, int(x), int(y))
+        with self.lock:
+            if key in self._pending:
+                return self._pending[key]
+            row = self.connection.execute(
+                "SELECT etag, last_modified, checked FROM tile_metadata "
+                "WHERE layer=? AND zoom_level=? AND tile_column=? AND tile_row=?",
+                key,
+            ).fetchone()
+        return None if row is None else TileMetadata(*row)
+
+    def put(self, layer: str, zoom: int, x: int, y: int, metadata: TileMetadata) -> None:
+        with self.lock:
+            self._pending[(layer, zoom, int(x), int(y))] = metadata
+            if len(self._pending) >= self.batch_size:
+                self._flush()
+
+    def flush(self) -> None:
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        rows = [key + tuple(metadata) for key, metadata in self._pending.items()]
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO tile_metadata "
+                "(layer, zoom_level, tile_column, tile_row, etag, last_modified, checked) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        self._pending.clear()
+
+    def close(self) -> None:
+        self.flush()
+        with self.lock:
+            self.connection.close()
+
+
+def open_metadata_index(cfg: Config, store: TileStore) -> TileMetadataIndex:
+    """The metadata index for a tile store, kept in the same file as a SQLite store"""
+    if isinstance(store, SQLiteTileStore):
+        return TileMetadataIndex(store.filepath)
+    return TileMetadataIndex(cfg.resolve_output_path(cfg.tile_metadata_path))
+
+
+def open_tile_store(cfg: Config) -> TileStore:
+    """Create the tile store selected by the config"""
+    if cfg.tile_store == "directory":
+        return DirectoryTileStore()
+    elif cfg.tile_store == "sqlite":
+        filepath = cfg.resolve_output_path(cfg.tile_store_path)
+        logger.debug(f"Using SQLite tile store {filepath}")
+        return SQLiteTileStore(filepath)
+    else:
+        raise RuntimeError(f"Unknown tile store {cfg.tile_store}")
@@ -0,0 +1,105 @@
+"""Find when a change first happened across a series of layers, in one pass over the tiles."""
+
+import numpy as np
+from osm_changes.config import Config
+from osm_changes.counts import TileCountsWriter
+from osm_changes.detector import Detector, MaskSink
+from osm_changes.images import bytes_to_indexed, png_size
+from osm_changes.storage import TileStore
+from osm_changes.types import Coordinate, Image
+
+
+class TimeSeriesDetector(Detector):
+    """Detects the initial_label -> final_label change across an ordered list of layers.
+
+    Each tile is decoded once per layer. The output raster holds, for each pixel, the index in
+    `layers` of the first layer where the change is seen (0 for no change), as uint8. Per-tile
+    counts of pixels first changing in each layer are written to <layer name>_counts.csv.
+    """
+
+    # the outputs are codes rather than masks, so min_area doesn't apply
+    supports_cleanup = False
+
+    def __init__(
+        self,
+        config: Config,
+        layers: list[str] | None = None,
+        overwrite: bool = False,
+        store: TileStore | None = None,
+    ) -> None:
+        if layers is None:
+            layers = config.layers if config.layers else [config.layer1, config.layer2]
+        if not 2 <= len(layers) <= 255:
+            raise ValueError(f"A time series needs between 2 and 255 layers, got {len(layers)}")
+        # set before Detector.__init__, which builds the layer name
+        self.layers = list(layers)
+        super().__init__(config, overwrite=overwrite, store=store)
+        self.set_layers(self.layers[0], self.layers[-1])
+
+    def update_layer_name(self) -> None:
+        self.layerName = f"{self.layers[0]}To{self.layers[-1]}FirstChange{self.initial_label}To{self.final_label}"
+
+    @property
+    def input_layers(self) -> list[str]:
+        return self.layers
+
+    def first_change(self, data: list[bytes]) -> Image:
+        """Index of the first layer where each pixel changes from initial_label to final_label, 0 if it never does"""
+        # identical neighbouring layers can't contain a change, so only decode each distinct tile once
+        decoded: dict[bytes, tuple[Image, Image]] = {}
+        epochs: Image | None = None
+        final = None
+        for i in range(1, len(data)):
+            if self.tiles_unchanged(data[i - 1], data[i]):
+                continue
+            for tile_data in (data[i - 1], data[i]):
+                if tile_data not in decoded:
+                    decoded[tile_data] = bytes_to_indexed(tile_data)
+            initial = self.classify_indexed(*decoded[data[i - 1]], self.initial_label)
+            final = self.classify_indexed(*decoded[data[i]], self.final_label)
+            if epochs is None:
+                epochs = np.zeros(initial.shape, dtype=np.uint8)
+            epochs[initial & final & (epochs == 0)] = i
+
+        if epochs is None:
+            epochs = np.zeros(png_size(data[0])[::-1], dtype=np.uint8)
+        return epochs
+
+    def process_tile_data(self, tile: Coordinate, data: list[bytes]) -> tuple[str, Image | None]:
+        if all(self.tiles_unchanged(data[0], tile_data) for tile_data in data[1:]):
+            if self.skip_unchanged:
+                return "skipped", None
+            status = "unchanged"
+        else:
+            status = "processed"
+        epochs = self.clip(tile, self.first_change(data))
+
+        new_filepath = self.output_filepath(tile)
+        if new_filepath is not None:
+            self.save_mask(epochs, tile, new_filepath)
+        return status, epochs if self.return_masks else None
+
+    def empty_mask(self) -> Image:
+        return np.zeros((256, 256), dtype=np.uint8)
+
+    def change_mask(self, output: Image) -> Image:
+        # changed in any epoch
+        return output > 0
+
+    def detect_changes_in_tile(self, tile: Coordinate):
+        data = self.read_tiles(tile)
+        if any(tile_data is None for tile_data in data):
+            return self.empty_mask()
+        return self.first_change(data)  # type: ignore
+
+    def open_sinks(self, tiles: list[Coordinate]) -> list[MaskSink]:
+        sinks = super().open_sinks(tiles)
+        if tiles:
+            sinks.append(
+                TileCountsWriter(
+                    self.config.resolve_output_path(f"{self.layerName}_counts.csv"),
+                    ["no_change"] + self.layers[1:],
+                    lambda epochs: np.bincount(epochs.ravel(), minlength=len(self.layers)).tolist(),
+                )
+            )
+        return sinks
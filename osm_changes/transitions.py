@@ -0,0 +1,96 @@
+"""Classify every pixel against all classes in both layers, giving every class-to-class transition in one pass."""
+
+import numpy as np
+from osm_changes.config import Config
+from osm_changes.counts import TileCountsWriter
+from osm_changes.detector import Detector, MaskSink
+from osm_changes.images import bytes_to_indexed
+from osm_changes.logger import logger
+from osm_changes.storage import TileStore
+from osm_changes.types import Coordinate, Image
+
+# pixels that don't match any of the class colours
+OTHER_LABEL = "Other"
+
+
+class TransitionDetector(Detector):
+    """Writes a per-pixel transition code raster, class1 * K + class2 as uint8, where the classes are
+    the entries of class_colors in order followed by "Other", and K is the number of classes.
+    Per-tile counts of every transition are written to <layer name>_counts.csv.
+
+    Any single transition mask can be derived from the codes later with transition_mask.
+    """
+
+    # the outputs are codes rather than masks, so min_area doesn't apply
+    supports_cleanup = False
+
+    def __init__(self, config: Config, overwrite: bool = False, store: TileStore | None = None) -> None:
+        super().__init__(config, overwrite=overwrite, store=store)
+        if len(self.classes) ** 2 > 256:
+            raise ValueError(f"Too many classes for uint8 transition codes: {self.classes}")
+
+    @property
+    def classes(self) -> list[str]:
+        return list(self.class_colors) + [OTHER_LABEL]
+
+    def labels_are_disjoint(self) -> bool:
+        # every class is also compared with itself, so identical tiles still hold transitions, e.g. BuildingToBuilding
+        return False
+
+    def update_layer_name(self) -> None:
+        self.layerName = f"{self.layer1}To{self.layer2}Transitions"
+
+    def transition_codes(self, data1: bytes, data2: bytes) -> Image:
+        classes1 = self.classify_all_indexed(*bytes_to_indexed(data1))
+        # identical tiles are only decoded once
+        classes2 = classes1 if data1 == data2 else self.classify_all_indexed(*bytes_to_indexed(data2))
+        return classes1 * np.uint8(len(self.classes)) + classes2
+
+    def process_tile_bytes(self, tile: Coordinate, data1: bytes, data2: bytes) -> tuple[str, Image | None]:
+        if data1 == data2 and self.skip_unchanged:
+            logger.debug(f"Tiles for {tile} are identical, skipping")
+            return "skipped", None
+        codes = self.clip(tile, self.transition_codes(data1, data2))
+        new_filepath = self.output_filepath(tile)
+        if new_filepath is not None:
+            self.save_mask(codes, tile, new_filepath)
+        return "unchanged" if data1 == data2 else "processed", codes if self.return_masks else None
+
+    def empty_mask(self) -> Image:
+        # no data in either layer, so Other to Other
+        other = len(self.classes) - 1
+        return np.full((256, 256), other * len(self.classes) + other, dtype=np.uint8)
+
+    def change_mask(self, output: Image) -> Image:
+        # any pixel whose class changed
+        n = np.uint8(len(self.classes))
+        return output // n != output % n
+
+    def detect_changes_in_tile(self, tile: Coordinate):
+        data1, data2 = self.read_tiles(tile)
+        if data1 is None or data2 is None:
+            return self.empty_mask()
+        return self.transition_codes(data1, data2)
+
+    def open_sinks(self, tiles: list[Coordinate]) -> list[MaskSink]:
+        sinks = super().open_sinks(tiles)
+        if tiles:
+            n = len(self.classes)
+            sinks.append(
+                TileCountsWriter(
+                    self.config.resolve_output_path(f"{self.layerName}_counts.csv"),
+                    [f"{a}To{b}" for a in self.classes for b in self.classes],
+                    lambda codes: np.bincount(codes.ravel(), minlength=n * n).tolist(),
+                )
+            )
+        return sinks
+
+
+def transition_mask(codes: Image, initial_label: str, final_label: str, classes: list[str]) -> Image:
+    """Mask of the pixels going from initial_label to final_label, from a transition code raster"""
+    return codes == classes.index(initial_label) * len(classes) + classes.index(final_label)
+
+
+def transition_matrix(counts: dict[str, int], classes: list[str]) -> Image:
+    """A KxK matrix of transition counts (rows: first layer class, columns: second layer class) from a counts table row"""
+    return np.array([[counts[f"{a}To{b}"] for b in classes] for a in classes])
@@ -0,0 +1,247 @@
+"""Polygonize detection masks as the tiles are detected, into newline-delimited GeoJSON or a GeoPackage.
+
+Each tile's changed regions are polygonized with rasterio.features.shapes. Regions touching a tile edge are
+held back and joined with the touching pieces in the neighbouring tiles, then polygonized together, so a
+building split by tile edges comes out as a single polygon. Pixels are connected the same way as for
+min_area (min_area_connectivity), so the polygons match the regions it measured. With 8-connectivity,
+pixels touching only at a corner make one polygon, whose outline touches itself at that corner.
+
+Tiles must be written column by column (sorted by x, then y), the order detect_changes_in_tiles uses. Once
+the writer moves on to column x, regions lying only in columns before x - 1 can't grow any more and are
+written out, so only the edge regions of about two columns are held in memory however large the area is.
+"""
+
+import json
+import numpy as np
+from affine import Affine  # type: ignore
+from rasterio.features import shapes  # type: ignore
+from scipy import ndimage  # type: ignore
+from osm_changes.config import SUPPORTED_VECTOR_OUTPUTS
+from osm_changes.coordinates import tile_to_latlon_array
+from osm_changes.logger import logger
+from osm_changes.types import Coordinate, Image
+
+
+class _NDJSONFile:
+    def __init__(self, filepath: str):
+        self.file = open(filepath, "w")
+
+    def write(self, features: list[dict]):
+        self.file.write("".join(json.dumps(feature) + "\n" for feature in features))
+
+    def close(self):
+        self.file.close()
+
+
+class _GeoPackageFile:
+    def __init__(self, filepath: str, layer: str):
+        try:
+            import fiona  # type: ignore
+        except ImportError:
+            raise ImportError("Writing a GeoPackage needs fiona, install it with 'pip install fiona'") from None
+
+        schema = {"geometry": "Polygon", "properties": {"pixels": "int"}}
+        self.collection = fiona.open(filepath, "w", driver="GPKG", layer=layer, schema=schema, crs="EPSG:4326")
+
+    def write(self, features: list[dict]):
+        # each call is written in a single transaction
+        self.collection.writerecords(features)
+
+    def close(self):
+        self.collection.close()
+
+
+class VectorWriter:
+    """Writes the changed regions of every tile's mask as WGS84 polygons, with their size in pixels.
+
+    :param output: "geojson" for newline-delimited GeoJSON, one feature per line, or "gpkg" for a GeoPackage
+        (needs fiona)
+    :param batch_size: number of features written at a time
+    :param connectivity: 4 or 8 connected neighbours
+    """
+
+    def __init__(
+        self,
+        filepath: str,
+        zoom: int,
+        output: str = "geojson",
+        tile_size: int = 256,
+        batch_size: int = 1000,
+        connectivity: int = 8,
+    ):
+        if output not in SUPPORTED_VECTOR_OUTPUTS:
+            raise ValueError(f"Unsupported vector output {output}, supported: {list(SUPPORTED_VECTOR_OUTPUTS)}")
+        self.filepath = filepath
+        self.zoom = zoom
+        self.tile_size = tile_size
+        self.batch_size = batch_size
+        self.connectivity = connectivity
+        self.structure = ndimage.generate_binary_structure(2, 1 if connectivity == 4 else 2)
+        if output == "gpkg":
+            self.file: _NDJSONFile | _GeoPackageFile = _GeoPackageFile(filepath, "changes")
+        else:
+            self.file = _NDJSONFile(filepath)
+        self.features_written = 0
+        self._batch: list[dict] = []
+        self._column: int | None = None
+
+        # regions touching a tile edge, as (tile x, top row, left column, mask) in pixels across the whole zoom level
+        self._pieces: dict[int, tuple[int, int, int, Image]] = {}
+        self._next_piece = 0
+        # union-find over the pieces, with the members of each group and the last column it reaches
+        self._parent: dict[int, int] = {}
+        self._members: dict[int, list[int]] = {}
+        self._last_column: dict[int, int] = {}
+        # piece ids along the (top, bottom, left, right) edges of the recent tiles, -1 where nothing changed
+        self._edges: dict[Coordinate, tuple[Image, Image, Image, Image]] = {}
+
+    def write_tile(self, tile: Coordinate, mask: Image):
+        x, y = int(tile[0]), int(tile[1])
+        if self._column is not None and x < self._column:
+            raise ValueError(f"Tiles must be written column by column, got column {x} after {self._column}")
+        if x != self._column:
+            self._column = x
+            self._write_groups(before=x - 1)
+
+        labels, n = ndimage.label(mask.astype(bool), structure=self.structure)
+        if n == 0:
+            return
+        sizes = np.bincount(labels.ravel(), minlength=n + 1)
+        on_edge = np.zeros(n + 1, dtype=bool)
+        for edge in (labels[0], labels[-1], labels[:, 0], labels[:, -1]):
+            on_edge[edge] = True
+        on_edge[0] = False
+
+        # regions inside the tile are complete, write them straight away
+        inside = np.where(on_edge[labels], 0, labels)
+        self._polygonize(inside, y * self.tile_size, x * self.tile_size, sizes)
+
+        piece_ids = np.full(n + 1, -1, dtype=np.int64)
+        objects = ndimage.find_objects(labels)
+        for label in np.flatnonzero(on_edge):
+            rows, cols = objects[label - 1]
+            piece = self._next_piece
+            self._next_piece += 1
+            self._pieces[piece] = (
+                x,
+                y * self.tile_size + rows.start,
+                x * self.tile_size + cols.start,
+                labels[rows, cols] == label,
+            )
+            self._parent[piece] = piece
+            self._members[piece] = [piece]
+            self._last_column[piece] = x
+            piece_ids[label] = piece
+
+        edges = (piece_ids[labels[0]], piece_ids[labels[-1]], piece_ids[labels[:, 0]], piece_ids[labels[:, -1]])
+        self._edges[(x, y)] = edges
+        # the tiles to the right and below come later, and join up with this one then
+        above = self._edges.get((x, y - 1))
+        if above is not None:
+            self._join(above[1], edges[0])
+        left = self._edges.get((x - 1, y))
+        if left is not None:
+            self._join(left[3], edges[2])
+        if self.connectivity == 8:
+            # the corner pixels of the tiles diagonally to the left
+            above_left = self._edges.get((x - 1, y - 1))
+            if above_left is not None:
+                self._join(above_left[1][-1:], edges[0][:1])
+            below_left = self._edges.get((x - 1, y + 1))
+            if below_left is not None:
+                self._join(below_left[0][-1:], edges[1][:1])
+
+    def _find(self, piece: int) -> int:
+        while self._parent[piece] != piece:
+            self._parent[piece] = self._parent[self._parent[piece]]
+            piece = self._parent[piece]
+        return piece
+
+    def _join(self, edge1: Image, edge2: Image):
+        pairs = self._touching(edge1, edge2)
+        if self.connectivity == 8:
+            # and the pixels diagonally across the edge
+            pairs.update(self._touching(edge1[:-1], edge2[1:]))
+            pairs.update(self._touching(edge1[1:], edge2[:-1]))
+        for a, b in pairs:
+            root_a, root_b = self._find(a), self._find(b)
+            if root_a == root_b:
+                continue
+            if len(self._members[root_a]) < len(self._members[root_b]):
+                root_a, root_b = root_b, root_a
+            self._parent[root_b] = root_a
+            self._members[root_a] += self._members.pop(root_b)
+            self._last_column[root_a] = max(self._last_column[root_a], self._last_column.pop(root_b))
+
+    @staticmethod
+    def _touching(edge1: Image, edge2: Image) -> set[tuple[int, int]]:
+        touching = (edge1 >= 0) & (edge2 >= 0)
+        return set(zip(edge1[touching].tolist(), edge2[touching].tolist()))
+
+    def _write_groups(self, before: int | None = None):
+        """Write the groups of pieces that lie entirely in columns before `before`, or all of them if None"""
+        done = [root for root, column in self._last_column.items() if before is None or column < before]
+        for root in done:
+            members = self._members.pop(root)
+            del self._last_column[root]
+            pieces = [self._pieces.pop(piece) for piece in members]
+            for piece in members:
+                del self._parent[piece]
+
+            top = min(row for _, row, _, _ in pieces)
+            left = min(col for _, _, col, _ in pieces)
+            bottom = max(row + mask.shape[0] for _, row, _, mask in pieces)
+            right = max(col + mask.shape[1] for _, _, col, mask in pieces)
+            group = np.zeros((bottom - top, right - left), dtype=np.int32)
+            for _, row, col, mask in pieces:
+                group[row - top : row - top + mask.shape[0], col - left : col - left + mask.shape[1]] |= mask
+            self._polygonize(group, top, left, np.array([0, sum(int(mask.sum()) for *_, mask in pieces)]))
+
+        if before is not None:
+            for tile in [tile for tile in self._edges if tile[0] < before]:
+                del self._edges[tile]
+
+    def _polygonize(self, labels: Image, top: int, left: int, sizes: Image):
+        """Write a polygon for each labelled region of a window whose top left pixel is at (top, left)"""
+        # polygonize in tile coordinates, which coordinates converts to lat/lon
+        transform = Affine(1 / self.tile_size, 0, left / self.tile_size, 0, 1 / self.tile_size, top / self.tile_size)
+        labels = labels.astype(np.int32)
+        for geometry, label in shapes(labels, mask=labels > 0, connectivity=self.connectivity, transform=transform):
+            rings = []
+            for ring in geometry["coordinates"]:
+                points = np.asarray(ring)
+                lat, lon = tile_to_latlon_array(points[:, 0], points[:, 1], self.zoom)
+                rings.append(np.column_stack([lon, lat]).round(8).tolist())
+            self._batch.append(
+                {
+                    "type": "Feature",
+                    "geometry": {"type": "Polygon", "coordinates": rings},
+                    "properties": {"pixels": int(sizes[int(label)])},
+                }
+            )
+            if len(self._batch) >= self.batch_size:
+                self._flush()
+
+    def _flush(self):
+        if self._batch:
+            self.file.write(self._batch)
+            self.features_written += len(self._batch)
+            self._batch = []
+
+    def close(self):
+        self._write_groups()
+        self._flush()
+        self.file.close()
+        logger.info(f"Wrote {self.features_written} polygons to {self.filepath}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_features(filepath: str) -> list[dict]:
+    """Read back the features of a newline-delimited GeoJSON file"""
+    with open(filepath) as f:
+        return [json.loads(line) for line in f if line.strip()]
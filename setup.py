@@ -11,8 +11,11 @@ setup(
         "requests",
         "requests_mock",
         "matplotlib",
+        "pillow",
         "rasterio",
+        "scipy",
     ],
+    extras_require={"gpkg": ["fiona"]},
     include_package_data=True,
     package_data={"osm_changes": ["config/*", "config.json"]},
     test_suite="tests",
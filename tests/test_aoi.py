@@ -0,0 +1,95 @@
+import json
+import numpy as np
+from matplotlib.path import Path
+from osm_changes.aoi import AOI
+from osm_changes.config import Config
+from osm_changes.coordinates import latlon_to_fractional_tile_array, tiles_in_bbox
+from osm_changes.detector import Detector
+from osm_changes.grid import Grid
+from tests.test_detector import make_tile
+
+ZOOM = 16
+
+
+def polygon(*rings: list[tuple[float, float]]) -> dict:
+    return {"type": "Polygon", "coordinates": [[list(point) for point in ring] for ring in rings]}
+
+
+def test_rectangle_cover_matches_bbox():
+    min_lat, max_lat, min_lon, max_lon = 51.521, 51.559, -1.749, -1.711
+    rectangle = polygon([(min_lon, min_lat), (max_lon, min_lat), (max_lon, max_lat), (min_lon, max_lat)])
+    assert AOI.from_geojson(rectangle, ZOOM).tiles() == set(tiles_in_bbox(min_lat, max_lat, min_lon, max_lon, ZOOM))
+
+
+def test_thin_diagonal_and_hole():
+    # a corridor about 50 m wide running diagonally across about 5 km
+    corridor = polygon([(-1.75, 51.52), (-1.7495, 51.52), (-1.6995, 51.56), (-1.70, 51.56)])
+    aoi = AOI.from_geojson(corridor, ZOOM)
+    tiles = aoi.tiles()
+    assert len(tiles) < len(set(tiles_in_bbox(51.52, 51.56, -1.75, -1.6995, ZOOM))) / 4
+
+    # every tile with part of the corridor in it is in the cover
+    lat = np.linspace(51.52, 51.56, 2000)
+    lon = np.linspace(-1.75, -1.70, 2000) + np.random.default_rng(0).random(2000) * 0.0005
+    x, y = latlon_to_fractional_tile_array(lat, lon, ZOOM)
+    assert set(zip(x.astype(int).tolist(), y.astype(int).tolist())) <= tiles
+    # and the tiles in the cover have some of it, though a sliver may not reach any pixel centres
+    empty = [tile for tile in tiles if (mask := aoi.mask(tile)) is not None and not mask.any()]
+    assert len(empty) <= 1
+
+    # tiles inside a hole are left out
+    outer = [(-1.75, 51.52), (-1.70, 51.52), (-1.70, 51.56), (-1.75, 51.56)]
+    hole = [(-1.74, 51.53), (-1.71, 51.53), (-1.71, 51.55), (-1.74, 51.55)]
+    with_hole = AOI.from_geojson(polygon(outer, hole), ZOOM)
+    (x,), (y,) = latlon_to_fractional_tile_array([51.54], [-1.725], ZOOM)
+    assert (int(x), int(y)) not in with_hole.tiles()
+    assert (int(x), int(y)) in AOI.from_geojson(polygon(outer), ZOOM).tiles()
+
+
+def test_mask_matches_point_in_polygon():
+    triangle = [(-1.7501, 51.5201), (-1.7460, 51.5203), (-1.7490, 51.5230)]
+    aoi = AOI.from_geojson({"type": "MultiPolygon", "coordinates": [[[list(p) for p in triangle]]]}, ZOOM)
+    x, y = latlon_to_fractional_tile_array([p[1] for p in triangle], [p[0] for p in triangle], ZOOM)
+    path = Path(np.column_stack([x, y]))
+    for tile in aoi.tiles():
+        centres = (np.stack(np.meshgrid(np.arange(256), np.arange(256)), axis=-1).reshape(-1, 2) + 0.5) / 256
+        expected = path.contains_points(centres + np.array(tile)).reshape(256, 256)
+        mask = aoi.mask(tile)
+        mask = np.ones((256, 256), dtype=bool) if mask is None else mask
+        # pixel centres exactly on an edge may go either way
+        assert (mask != expected).sum() <= 2
+
+
+def test_grid_and_detector_use_the_aoi(tmp_path, monkeypatch):
+    corridor = polygon([(-1.75, 51.52), (-1.7495, 51.52), (-1.6995, 51.56), (-1.70, 51.56)])
+    filepath = tmp_path / "aoi.geojson"
+    filepath.write_text(json.dumps({"type": "Feature", "properties": {}, "geometry": corridor}))
+    cfg = Config()
+    cfg.set_output_dir(str(tmp_path))
+    cfg.aoi = str(filepath)
+    cfg.clip_to_aoi = True
+    aoi = AOI.from_file(str(filepath), cfg.zoom)
+    assert Grid(cfg).tiles() == aoi.tiles()
+
+    detector = Detector(cfg, store=_NoStore())  # type: ignore
+    edge_tile = next(tile for tile in sorted(aoi.tiles()) if aoi.mask(tile) is not None)
+    clipped = detector.clip(edge_tile, np.ones((256, 256), dtype=bool))
+    assert np.array_equal(clipped, aoi.mask(edge_tile))
+
+    # the output is clipped once, when it's detected, and saved and sent to the sinks as it is
+    calls = []
+    original = detector.aoi.mask
+    monkeypatch.setattr(detector.aoi, "mask", lambda tile: calls.append(tile) or original(tile))
+    written = []
+    sink = type("Sink", (), {"write_tile": lambda self, tile, mask: written.append(mask), "close": lambda self: None})()
+    detector.return_masks = True
+    before = np.zeros((256, 256), dtype=bool)
+    status, mask = detector.process_tile_bytes(edge_tile, make_tile(before), make_tile(~before))
+    detector.write_sinks([sink], edge_tile, mask)
+    assert status == "processed" and calls == [edge_tile]
+    assert np.array_equal(written[0], aoi.mask(edge_tile))
+    assert (tmp_path / detector.layerName).exists()
+
+
+class _NoStore:
+    pass
@@ -0,0 +1,73 @@
+import numpy as np
+from matplotlib.pyplot import imread  # type: ignore
+from osm_changes.cleanup import RegionCleaner, pack_mask, remove_small_regions, unpack_mask
+from osm_changes.config import Config, TileFilepath
+from osm_changes.detector import Detector
+from osm_changes.storage import SQLiteTileStore
+from tests.test_detector import TILE, make_tile
+
+
+def test_remove_small_regions():
+    mask = np.zeros((20, 20), dtype=bool)
+    mask[2:4, 2:4] = True  # 4 pixels
+    mask[10:15, 10:15] = True  # 25 pixels
+    mask[0, 18:20] = True  # 2 pixels on the border
+    cleaned = remove_small_regions(mask, 10)
+    assert cleaned.sum() == 25
+    assert remove_small_regions(mask, 10, keep_border=True)[0, 18:20].all()
+
+
+def test_pack_mask_round_trip():
+    mask = np.random.default_rng(0).random((256, 256)) > 0.5
+    assert np.array_equal(unpack_mask(pack_mask(mask)), mask)
+
+
+def test_region_split_across_tiles_is_kept():
+    left = np.zeros((256, 256), dtype=bool)
+    right = left.copy()
+    # a 6x6 region, cut into 3x6 pieces by the tile edge
+    left[100:106, 253:256] = True
+    right[100:106, 0:3] = True
+    # a small isolated region
+    left[10:13, 10:13] = True
+    masks = {(0, 0): left, (1, 0): right}
+
+    cleaner = RegionCleaner(masks.get, min_area=20)
+    cleaned_left = cleaner.clean((0, 0))
+    assert cleaned_left[100:106, 253:256].all()
+    assert not cleaned_left[10:13, 10:13].any()
+    assert np.array_equal(cleaner.clean((1, 0)), right)
+    # the pieces are removed when each tile is cleaned on its own
+    assert not remove_small_regions(left, 20).any()
+
+
+def test_detect_changes_with_min_area(tmp_path):
+    cfg = Config()
+    cfg.set_output_dir(str(tmp_path))
+    cfg.output = "png"
+    cfg.min_area = 100
+    store = SQLiteTileStore(str(tmp_path / "tiles.sqlite"))
+    detector = Detector(cfg, store=store)
+
+    before = np.zeros((256, 256), dtype=bool)
+    left = before.copy()
+    right = before.copy()
+    left[50:60, 250:256] = True
+    right[50:60, 0:6] = True
+    left[200:202, 200:202] = True  # noise
+    neighbour = (TILE[0] + 1, TILE[1])
+    for tile, after in ((TILE, left), (neighbour, right)):
+        detector.store.put(detector.layer1, detector.zoom, *tile, make_tile(before))
+        detector.store.put(detector.layer2, detector.zoom, *tile, make_tile(after))
+
+    counts = detector.detect_changes_in_tiles({TILE, neighbour})
+    assert counts["processed"] == 2
+
+    output = imread(TileFilepath(detector.layerName, *TILE, detector.zoom, output="png")())[:, :, 0] > 0.5
+    expected = left.copy()
+    expected[200:202, 200:202] = False
+    assert np.array_equal(output, expected)
+
+    counts = detector.detect_changes_in_tiles({TILE, neighbour})
+    assert counts["existing"] == 2 and counts["processed"] == 0
+    store.close()
@@ -13,3 +13,44 @@ def test_coordinates():
     # check correct tile is returned
     tile = coordinates.latlon_to_tile(lat, lon, 16)[0]
     assert tile == (32350, 21207), f"Expected (32350, 21207) but got {tile}"
+
+
+def test_latlon_to_tile_array_matches_scalar():
+    import numpy as np
+    import osm_changes.coordinates as coordinates
+
+    rng = np.random.default_rng(0)
+    lat = rng.uniform(49.0, 61.0, 2000)
+    lon = rng.uniform(-8.0, 2.0, 2000)
+
+    for zoom in [10, 16]:
+        tile_x, tile_y, pixel_x, pixel_y = coordinates.latlon_to_tile_array(lat, lon, zoom)
+        for i in range(len(lat)):
+            tile, pix = coordinates.latlon_to_tile(lat[i], lon[i], zoom)
+            assert (tile_x[i], tile_y[i]) == tile
+            assert (pixel_x[i], pixel_y[i]) == pix
+
+
+def test_tile_to_latlon_array_matches_scalar():
+    import numpy as np
+    import osm_changes.coordinates as coordinates
+
+    tile_x = np.arange(32440, 32460)
+    tile_y = np.arange(21770, 21790)
+    expected_nw = np.array([coordinates.tile_to_latlon(x, y, 16) for x, y in zip(tile_x, tile_y)])
+    expected_se = np.array([coordinates.tile_to_latlon(x + 1, y + 1, 16) for x, y in zip(tile_x, tile_y)])
+
+    lat, lon = coordinates.tile_to_latlon_array(tile_x, tile_y, 16)
+    assert np.allclose(lat, expected_nw[:, 0], rtol=0, atol=1e-12)
+    assert np.allclose(lon, expected_nw[:, 1], rtol=0, atol=1e-12)
+
+    west, south, east, north = coordinates.tile_bounds_array(tile_x, tile_y, 16)
+    assert np.allclose(north, expected_nw[:, 0], rtol=0, atol=1e-12)
+    assert np.allclose(west, expected_nw[:, 1], rtol=0, atol=1e-12)
+    assert np.allclose(south, expected_se[:, 0], rtol=0, atol=1e-12)
+    assert np.allclose(east, expected_se[:, 1], rtol=0, atol=1e-12)
+
+    # the centre pixel of a tile lies half way across the tile
+    lat, lon = coordinates.pixel_to_latlon_array(tile_x, tile_y, 128, 128, 16)
+    assert np.allclose(lon, (west + east) / 2)
+    assert np.all((south < lat) & (lat < north))
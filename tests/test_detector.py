@@ -0,0 +1,173 @@
+import io
+import os
+import numpy as np
+import pytest
+from osm_changes.config import Config, TileFilepath
+from osm_changes.detector import Detector
+from osm_changes.storage import SQLiteTileStore
+
+NOTHING = (249, 249, 247)
+BUILDING = (248, 216, 184)
+TILE = (32449, 21776)
+
+
+def make_tile(buildings: np.ndarray) -> bytes:
+    """An OS-style palette PNG tile with buildings where the mask is True"""
+    from PIL import Image as PILImage
+
+    indices = buildings.astype(np.uint8)
+    image = PILImage.fromarray(indices, mode="P")
+    image.putpalette(list(NOTHING) + list(BUILDING))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def detector(tmp_path):
+    cfg = Config()
+    cfg.set_output_dir(str(tmp_path))
+    cfg.output = "png"
+    store = SQLiteTileStore(str(tmp_path / "tiles.sqlite"))
+    detector = Detector(cfg, store=store)
+    yield detector
+    store.close()
+
+
+def test_detect_changes_in_tile(detector):
+    before = np.zeros((256, 256), dtype=bool)
+    after = before.copy()
+    after[10:20, 30:50] = True
+    detector.store.put(detector.layer1, detector.zoom, *TILE, make_tile(before))
+    detector.store.put(detector.layer2, detector.zoom, *TILE, make_tile(after))
+
+    mask = detector.detect_changes_in_tile(TILE)
+    assert mask.shape == (256, 256)
+    assert np.array_equal(mask, after)
+
+    assert detector.process_tile(TILE)[0] == "processed"
+    assert detector.process_tile(TILE)[0] == "existing"
+
+
+def test_identical_tiles_are_not_decoded(detector, monkeypatch):
+    import osm_changes.detector
+
+    def fail(*args, **kwargs):
+        raise AssertionError("identical tiles should not be decoded")
+
+    monkeypatch.setattr(osm_changes.detector, "bytes_to_image", fail)
+    data = make_tile(np.zeros((256, 256), dtype=bool))
+    detector.store.put(detector.layer1, detector.zoom, *TILE, data)
+    detector.store.put(detector.layer2, detector.zoom, *TILE, data)
+
+    mask = detector.detect_changes_in_tile(TILE)
+    assert mask.shape == (256, 256) and not mask.any()
+
+    detector.skip_unchanged = True
+    assert detector.detect_changes_in_tiles({TILE}) == {
+        "processed": 0,
+        "unchanged": 0,
+        "missing": 0,
+        "skipped": 1,
+        "existing": 0,
+        "failed": 0,
+    }
+    filepath = TileFilepath(detector.layerName, *TILE, detector.zoom, output="png")()
+    assert not os.path.exists(filepath)
+
+    detector.skip_unchanged = False
+    assert detector.process_tile(TILE)[0] == "unchanged"
+    assert os.path.exists(filepath)
+
+
+def test_missing_tiles(detector):
+    with pytest.raises(FileNotFoundError):
+        detector.detect_changes_in_tile(TILE)
+
+
+def test_indexed_detection_matches_float_detection(detector):
+    from PIL import Image as PILImage
+    from osm_changes.images import bytes_to_image, bytes_to_indexed
+
+    rng = np.random.default_rng(1)
+    # colours scattered around the class colours, some inside the tolerance and some outside
+    centres = np.array([NOTHING, BUILDING, (0, 0, 0)])
+    palette = np.clip(centres[rng.integers(0, 3, 256)] + rng.integers(-40, 40, (256, 3)), 0, 255).astype(np.uint8)
+
+    tiles = []
+    for _ in range(2):
+        indices = rng.integers(0, 256, (256, 256)).astype(np.uint8)
+        image = PILImage.fromarray(indices, mode="P")
+        image.putpalette(palette.flatten().tolist())
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        tiles.append(buffer.getvalue())
+        # the same pixels stored as plain RGB
+        buffer = io.BytesIO()
+        PILImage.fromarray(palette[indices], mode="RGB").save(buffer, format="PNG")
+        tiles.append(buffer.getvalue())
+
+    for data1, data2 in [(tiles[0], tiles[2]), (tiles[1], tiles[3]), (tiles[0], tiles[3])]:
+        expected = detector.detect_change(bytes_to_image(data1, format="png"), bytes_to_image(data2, format="png"))
+        assert expected.any()
+        assert np.array_equal(detector.detect_change_in_bytes(data1, data2), expected)
+
+    indices, palette = bytes_to_indexed(tiles[0])
+    assert indices.dtype == np.uint8 and indices.shape == (256, 256)
+    assert palette.shape == (256, 3)
+
+
+def test_detect_changes_in_tiles_in_parallel(detector):
+    from matplotlib.pyplot import imread
+
+    tiles = [(TILE[0] + i, TILE[1]) for i in range(6)]
+    rng = np.random.default_rng(2)
+    for tile in tiles:
+        detector.store.put(detector.layer1, detector.zoom, *tile, make_tile(rng.random((256, 256)) < 0.5))
+        detector.store.put(detector.layer2, detector.zoom, *tile, make_tile(rng.random((256, 256)) < 0.5))
+    # one tile is missing from the second layer
+    missing = (TILE[0] + 6, TILE[1])
+    detector.store.put(detector.layer1, detector.zoom, *missing, make_tile(np.zeros((256, 256), dtype=bool)))
+
+    detector.chunk_size = 2
+    counts = detector.detect_changes_in_tiles(set(tiles + [missing]), workers=2)
+    assert counts["processed"] == 6 and counts["failed"] == 1
+    assert detector.failed_tiles[0][0] == missing
+    assert "FileNotFoundError" in detector.failed_tiles[0][1]
+
+    for tile in tiles:
+        written = imread(TileFilepath(detector.layerName, *tile, detector.zoom, output="png")())[:, :, 0] > 0.5
+        assert np.array_equal(written, detector.detect_changes_in_tile(tile))
+
+
+def test_detect_changes_into_mosaic(detector):
+    import rasterio
+
+    tiles = [(TILE[0] + i, TILE[1]) for i in range(2)]
+    after = np.zeros((256, 256), dtype=bool)
+    after[100:110, 0:256] = True
+    for tile in tiles:
+        detector.store.put(detector.layer1, detector.zoom, *tile, make_tile(np.zeros((256, 256), dtype=bool)))
+        detector.store.put(detector.layer2, detector.zoom, *tile, make_tile(after))
+
+    detector.output = "cog"
+    counts = detector.detect_changes_in_tiles(set(tiles))
+    assert counts["processed"] == 2
+
+    with rasterio.open(detector.mosaic_filepath()) as dataset:
+        data = dataset.read(1)
+        assert data.shape == (256, 512)
+        assert np.array_equal(data == 255, np.hstack([after, after]))
+
+
+def test_missing_tiles_are_empty(detector):
+    after = np.ones((256, 256), dtype=bool)
+    detector.store.put(detector.layer2, detector.zoom, *TILE, make_tile(after))
+    # not downloaded yet
+    with pytest.raises(FileNotFoundError):
+        detector.detect_changes_in_tile(TILE)
+
+    # known to be outside the layer's coverage
+    detector.store.put_missing(detector.layer1, detector.zoom, *TILE)
+    assert not detector.detect_changes_in_tile(TILE).any()
+    assert detector.detect_changes_in_tiles({TILE})["missing"] == 1
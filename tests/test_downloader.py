@@ -1,3 +1,5 @@
+import pytest
+import requests
 import requests_mock
 from osm_changes.config import Config
 from osm_changes.downloader import Downloader
@@ -22,3 +24,163 @@ def test_get_tile_png():
 
         # Assert that the method returned the expected result
         assert result == b"some image content"
+
+
+def test_get_tile_png_retries():
+    cfg = Config()
+    cfg.download_retries = 2
+    cfg.download_backoff = 0
+    downloader = Downloader(cfg)
+    downloader.set_layer("default")
+
+    with requests_mock.Mocker() as m:
+        m.get(
+            "https://tile.openstreetmap.org/17/65521/43969.png",
+            [{"status_code": 429}, {"status_code": 503}, {"content": b"some image content"}],
+        )
+        assert downloader.get_tile_png(17, 65521, 43969) == b"some image content"
+        assert m.call_count == 3
+
+
+def test_retry_after_is_capped():
+    cfg = Config()
+    cfg.download_max_delay = 5
+    downloader = Downloader(cfg)
+    response = requests.Response()
+    response.headers["Retry-After"] = "3600"
+    assert downloader._retry_delay(0, response) == 5
+    assert downloader._retry_delay(20) == 5
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_failed_tiles_dont_stop_the_others(tmp_path, workers):
+    cfg = Config()
+    cfg.set_output_dir(str(tmp_path))
+    cfg.download_workers = workers
+    cfg.download_retries = 0
+    downloader = Downloader(cfg)
+    downloader.set_layer("default")
+    tiles = [(32449, 21776), (32450, 21776), (32451, 21776)]
+
+    with requests_mock.Mocker() as m:
+        m.get(f"https://tile.openstreetmap.org/{cfg.zoom}/32449/21776.png", status_code=500)
+        for x, y in tiles[1:]:
+            m.get(f"https://tile.openstreetmap.org/{cfg.zoom}/{x}/{y}.png", content=b"tile")
+        with pytest.raises(Exception, match="Failed to download 1 tiles"):
+            downloader.download_tiles(tiles)
+        assert m.call_count == len(tiles)
+    assert all(downloader.store.has("default", cfg.zoom, x, y) for x, y in tiles[1:])
+
+
+def test_download_tiles_concurrently(tmp_path):
+    from osm_changes.config import TileFilepath
+
+    cfg = Config()
+    cfg.set_output_dir(str(tmp_path))
+    cfg.download_workers = 4
+    downloader = Downloader(cfg)
+    downloader.set_layer("default")
+    tiles = {(x, y) for x in range(32449, 32453) for y in range(21776, 21780)}
+
+    with requests_mock.Mocker() as m:
+        for x, y in tiles:
+            m.get(f"https://tile.openstreetmap.org/{cfg.zoom}/{x}/{y}.png", content=f"{x}/{y}".encode())
+        downloader.download_tiles(tiles)
+        assert m.call_count == len(tiles)
+
+    for x, y in tiles:
+        with open(TileFilepath("default", x, y, cfg.zoom)(), "rb") as f:
+            assert f.read() == f"{x}/{y}".encode()
+
+
+def test_token_bucket_limits_rate():
+    import time
+    from osm_changes.downloader import TokenBucket
+
+    bucket = TokenBucket(rate=50, capacity=1)
+    start = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    # the first token is free, the other five have to wait 1/50s each
+    assert time.monotonic() - start >= 5 / 50 * 0.9
+
+
+def test_download_tiles_into_sqlite_store(tmp_path):
+    from osm_changes.storage import SQLiteTileStore
+
+    cfg = Config()
+    # the live layer's tiles would be revalidated, see test_stale_tiles_are_revalidated
+    cfg.layer_max_age = {}
+    store = SQLiteTileStore(str(tmp_path / "tiles.sqlite"))
+    store.put("default", cfg.zoom, 32449, 21776, b"already stored")
+    downloader = Downloader(cfg, store=store)
+    downloader.set_layer("default")
+    tiles = {(32449, 21776), (32450, 21776)}
+
+    with requests_mock.Mocker() as m:
+        m.get(f"https://tile.openstreetmap.org/{cfg.zoom}/32450/21776.png", content=b"new tile")
+        downloader.download_tiles(tiles)
+        # the stored tile is not downloaded again
+        assert m.call_count == 1
+
+    assert store.get("default", cfg.zoom, 32449, 21776) == b"already stored"
+    assert store.get("default", cfg.zoom, 32450, 21776) == b"new tile"
+    store.close()
+
+
+def test_stale_tiles_are_revalidated(tmp_path):
+    from osm_changes.storage import SQLiteTileStore
+
+    cfg = Config()
+    cfg.layer_max_age = {"default": 60}
+    store = SQLiteTileStore(str(tmp_path / "tiles.sqlite"))
+    downloader = Downloader(cfg, store=store)
+    downloader.set_layer("default")
+    url = f"https://tile.openstreetmap.org/{cfg.zoom}/32449/21776.png"
+    tile = {(32449, 21776)}
+
+    with requests_mock.Mocker() as m:
+        m.get(url, content=b"first", headers={"ETag": '"v1"', "Last-Modified": "Wed, 01 Oct 2025 00:00:00 GMT"})
+        downloader.download_tiles(tile)
+        # still fresh, so not checked again
+        downloader.download_tiles(tile)
+        assert m.call_count == 1
+
+        # once stale, a 304 keeps the stored tile
+        downloader.layer_max_age["default"] = 0
+        m.get(url, status_code=304)
+        downloader.download_tiles(tile)
+        assert m.call_count == 2
+        assert m.last_request.headers["If-None-Match"] == '"v1"'
+        assert m.last_request.headers["If-Modified-Since"] == "Wed, 01 Oct 2025 00:00:00 GMT"
+        assert store.get("default", cfg.zoom, 32449, 21776) == b"first"
+
+        # and a changed tile replaces it
+        m.get(url, content=b"second", headers={"ETag": '"v2"'})
+        downloader.download_tiles(tile)
+        assert store.get("default", cfg.zoom, 32449, 21776) == b"second"
+        assert downloader.metadata.get("default", cfg.zoom, 32449, 21776).etag == '"v2"'
+
+    # archive layers never expire
+    assert downloader.is_fresh("201610", cfg.zoom, 32449, 21776)
+    store.close()
+
+
+def test_tiles_not_on_the_server_are_remembered(tmp_path):
+    from osm_changes.storage import SQLiteTileStore
+
+    cfg = Config()
+    store = SQLiteTileStore(str(tmp_path / "tiles.sqlite"))
+    downloader = Downloader(cfg, store=store)
+    downloader.set_layer("201610")
+    tiles = {(32449, 21776), (32450, 21776)}
+
+    with requests_mock.Mocker() as m:
+        m.get(f"https://os.openstreetmap.org/layer/gb_os_om_local_2016_10/{cfg.zoom}/32449/21776.png", content=b"land")
+        m.get(f"https://os.openstreetmap.org/layer/gb_os_om_local_2016_10/{cfg.zoom}/32450/21776.png", status_code=404)
+        downloader.download_tiles(tiles)
+        assert store.is_missing("201610", cfg.zoom, 32450, 21776)
+        # not requested again
+        downloader.download_tiles(tiles)
+        assert m.call_count == 2
+    store.close()
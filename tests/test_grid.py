@@ -15,4 +15,20 @@ def test_grid():
     assert cfg.max_lat in grid.lat_points
     assert cfg.min_lon in grid.lon_points
     assert cfg.max_lon in grid.lon_points
-    
+
+
+def test_grid_tiles_match_point_walk():
+    """The calculated tile cover should give the same tiles as walking every grid point"""
+    import osm_changes.config as config
+    import osm_changes.grid as grid
+    from osm_changes.coordinates import latlon_to_tile
+
+    cfg = config.Config()
+    cfg.height = 200
+    cfg.width = 200
+    grid = grid.Grid(cfg)
+
+    walked = {latlon_to_tile(lat, lon, cfg.zoom)[0] for lat, lon in grid.grid}
+
+    assert grid.tiles() == walked
+    assert grid.tiles(cfg.zoom - 2) == {latlon_to_tile(lat, lon, cfg.zoom - 2)[0] for lat, lon in grid.grid}
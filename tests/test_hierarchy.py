@@ -0,0 +1,108 @@
+import numpy as np
+import requests_mock
+from osm_changes.__main__ import run
+from osm_changes.config import Config
+from osm_changes.detector import Detector
+from osm_changes.downloader import Downloader, layer_urls
+from osm_changes.hierarchy import HierarchicalSearch
+from osm_changes.storage import SQLiteTileStore
+from tests.test_detector import TILE, make_tile
+
+COARSE_ZOOM = 14
+
+
+def render(buildings: np.ndarray, origin: tuple[int, int], x: int, y: int, zoom: int, detection_zoom: int) -> bytes:
+    """The tile at a zoom at or above the detection zoom, drawn from the buildings of an area starting at origin"""
+    step = 2 ** (detection_zoom - zoom)
+    rows = slice((y * step - origin[1]) * 256, ((y + 1) * step - origin[1]) * 256, step)
+    cols = slice((x * step - origin[0]) * 256, ((x + 1) * step - origin[0]) * 256, step)
+    return make_tile(buildings[rows, cols])
+
+
+def make_layers(cfg: Config, store: SQLiteTileStore, from_zoom: int = COARSE_ZOOM) -> tuple[set, tuple[int, int]]:
+    """Two coarse tiles of random buildings, with one building added in one detection tile"""
+    levels = cfg.zoom - COARSE_ZOOM
+    origin = ((TILE[0] >> levels) << levels, (TILE[1] >> levels) << levels)
+    rng = np.random.default_rng(5)
+    before = rng.random((256 << levels, 2 * (256 << levels))) < 0.01
+    after = before.copy()
+    after[2 * 256 + 100 : 2 * 256 + 112, 256 + 100 : 256 + 112] = True
+    changed = (origin[0] + 1, origin[1] + 2)
+
+    tiles = set()
+    for zoom in range(from_zoom, cfg.zoom + 1):
+        step = 2 ** (cfg.zoom - zoom)
+        for x in range(origin[0] // step, (origin[0] + (2 << levels)) // step):
+            for y in range(origin[1] // step, (origin[1] + (1 << levels)) // step):
+                store.put(cfg.layer1, zoom, x, y, render(before, origin, x, y, zoom, cfg.zoom))
+                store.put(cfg.layer2, zoom, x, y, render(after, origin, x, y, zoom, cfg.zoom))
+                if zoom == cfg.zoom:
+                    tiles.add((x, y))
+    return tiles, changed
+
+
+def make_config(tmp_path) -> Config:
+    cfg = Config()
+    cfg.set_output_dir(str(tmp_path))
+    cfg.output = "png"
+    cfg.tile_store = "sqlite"
+    cfg.layer_max_age = {}
+    return cfg
+
+
+def test_search_follows_changes_down(tmp_path):
+    cfg = make_config(tmp_path)
+    with SQLiteTileStore(str(tmp_path / "tiles.sqlite")) as store:
+        tiles, changed = make_layers(cfg, store)
+        detector = Detector(cfg, store=store)
+        search = HierarchicalSearch(Downloader(cfg, store=store), detector, COARSE_ZOOM)
+        assert search.search(tiles) == {changed}
+        # only tiles that were asked for are followed
+        assert search.search(tiles - {changed}) == set()
+
+        # a change on the edge between quarters reaches the children either side
+        x, y = changed[0] >> 1, changed[1] >> 1
+        edge = np.zeros((256, 256), dtype=bool)
+        edge[10, 128] = True
+        store.put(cfg.layer1, cfg.zoom - 1, x, y, make_tile(np.zeros((256, 256), dtype=bool)))
+        store.put(cfg.layer2, cfg.zoom - 1, x, y, make_tile(edge))
+        assert search.changed_children((x, y), cfg.zoom - 1) == [(2 * x, 2 * y), (2 * x + 1, 2 * y)]
+
+
+def test_run_with_coarse_zoom(tmp_path):
+    cfg = make_config(tmp_path)
+    with SQLiteTileStore(cfg.resolve_output_path(cfg.tile_store_path)) as store:
+        tiles, changed = make_layers(cfg, store)
+
+    cfg.coarse_zoom = COARSE_ZOOM
+    counts = run(cfg, tiles)
+    assert counts["processed"] == 1
+    assert counts["skipped"] == len(tiles) - 1
+
+
+def test_transitions_are_not_pruned(tmp_path):
+    counts = []
+    for coarse_zoom in (None, COARSE_ZOOM):
+        cfg = make_config(tmp_path / str(coarse_zoom))
+        cfg.transitions = True
+        with SQLiteTileStore(cfg.resolve_output_path(cfg.tile_store_path)) as store:
+            tiles, changed = make_layers(cfg, store)
+        cfg.coarse_zoom = coarse_zoom
+        counts.append(run(cfg, tiles))
+    # identical tiles still hold the transitions of each class to itself
+    assert counts[0] == counts[1]
+    assert counts[1]["processed"] + counts[1]["unchanged"] == len(tiles)
+
+
+def test_missing_coarse_tiles_are_searched_below(tmp_path):
+    cfg = make_config(tmp_path)
+    with SQLiteTileStore(str(tmp_path / "tiles.sqlite")) as store:
+        tiles, changed = make_layers(cfg, store, from_zoom=COARSE_ZOOM + 1)
+        detector = Detector(cfg, store=store)
+        search = HierarchicalSearch(Downloader(cfg, store=store), detector, COARSE_ZOOM)
+        with requests_mock.Mocker() as m:
+            # the server doesn't have the coarse zoom
+            m.get(requests_mock.ANY, status_code=404)
+            assert search.search(tiles) == {changed}
+        assert all(request.url.startswith(tuple(layer_urls.values())) for request in m.request_history)
+        assert {request.url.split("/")[-3] for request in m.request_history} == {str(COARSE_ZOOM)}
@@ -0,0 +1,48 @@
+import numpy as np
+import rasterio
+from osm_changes.coordinates import tile_mercator_bounds, tile_to_latlon
+from osm_changes.images import tile_to_geotiff
+
+TILE = (32449, 21776, 16)
+
+
+def test_tile_to_geotiff_native_mercator(tmp_path):
+    filepath = str(tmp_path / "mask.tiff")
+    mask = np.zeros((256, 256), dtype=bool)
+    mask[50:60, 70:90] = True
+    tile_to_geotiff(mask, *TILE, filepath)
+
+    with rasterio.open(filepath) as dataset:
+        assert dataset.crs.to_epsg() == 3857
+        assert dataset.tags(1, "IMAGE_STRUCTURE").get("NBITS") == "1"
+        assert np.allclose(dataset.bounds, tile_mercator_bounds(*TILE))
+        # written without any resampling
+        assert np.array_equal(dataset.read(1).astype(bool), mask)
+
+
+def test_tile_to_geotiff_wgs84(tmp_path):
+    filepath = str(tmp_path / "mask.tiff")
+    mask = np.zeros((256, 256), dtype=bool)
+    mask[:128] = True
+    tile_to_geotiff(mask, *TILE, filepath, crs="EPSG:4326")
+
+    north, west = tile_to_latlon(TILE[0], TILE[1], TILE[2])
+    south, east = tile_to_latlon(TILE[0] + 1, TILE[1] + 1, TILE[2])
+    with rasterio.open(filepath) as dataset:
+        assert dataset.crs.to_epsg() == 4326
+        assert np.allclose(dataset.bounds, (west, south, east, north), atol=1e-6)
+        data = dataset.read(1)
+        # nearest neighbour keeps the mask binary
+        assert set(np.unique(data)) == {0, 1}
+        assert data[0].all() and not data[-1].any()
+
+
+def test_tile_to_geotiff_rgb(tmp_path):
+    filepath = str(tmp_path / "rgb.tiff")
+    image = np.random.default_rng(4).random((256, 256, 4)).astype(np.float32)
+    tile_to_geotiff(image, *TILE, filepath)
+
+    with rasterio.open(filepath) as dataset:
+        assert dataset.count == 3
+        assert dataset.dtypes[0] == "uint8"
+        assert np.array_equal(dataset.read(), np.moveaxis(np.rint(image[:, :, :3] * 255).astype(np.uint8), -1, 0))
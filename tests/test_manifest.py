@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+from osm_changes.config import Config
+from osm_changes.detector import Detector
+from osm_changes.manifest import RunManifest
+from osm_changes.storage import SQLiteTileStore
+from tests.test_detector import TILE, make_tile
+
+
+@pytest.fixture
+def detector(tmp_path):
+    cfg = Config()
+    cfg.set_output_dir(str(tmp_path))
+    cfg.output = "png"
+    cfg.manifest = True
+    store = SQLiteTileStore(str(tmp_path / "tiles.sqlite"))
+    detector = Detector(cfg, store=store)
+    yield detector
+    store.close()
+
+
+def put_tiles(detector: Detector, tiles: list, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    for tile in tiles:
+        detector.store.put(detector.layer1, detector.zoom, *tile, make_tile(np.zeros((256, 256), dtype=bool)))
+        detector.store.put(detector.layer2, detector.zoom, *tile, make_tile(rng.random((256, 256)) < 0.01))
+
+
+def test_fingerprints(tmp_path):
+    manifest = RunManifest(str(tmp_path / "manifest.sqlite"), "layer", 16, {"tolerance": 0.1})
+    fingerprint = manifest.fingerprint(["a", "b"])
+    assert fingerprint is not None and fingerprint != manifest.fingerprint(["b", "a"])
+    assert manifest.fingerprint(["a", None]) is None
+    manifest.record(TILE, fingerprint)
+    manifest.close()
+
+    manifest = RunManifest(str(tmp_path / "manifest.sqlite"), "layer", 16, {"tolerance": 0.1})
+    assert manifest.is_current(TILE, fingerprint)
+    assert not manifest.is_current(TILE, None)
+    assert not manifest.is_current((0, 0), fingerprint)
+    manifest.close()
+    changed = RunManifest(str(tmp_path / "manifest.sqlite"), "layer", 16, {"tolerance": 0.2})
+    assert not changed.is_current(TILE, changed.fingerprint(["a", "b"]))
+    changed.close()
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_only_changed_tiles_are_detected_again(detector, monkeypatch, workers):
+    tiles = [(TILE[0] + i, TILE[1]) for i in range(3)]
+    put_tiles(detector, tiles)
+    assert detector.detect_changes_in_tiles(set(tiles), workers=workers)["processed"] == 3
+
+    # up to date tiles are found without looking at their files
+    import os
+
+    exists = os.path.exists
+    checked = []
+    monkeypatch.setattr(os.path, "exists", lambda path: checked.append(path) or exists(path))
+    assert detector.detect_changes_in_tiles(set(tiles), workers=workers)["existing"] == 3
+    monkeypatch.undo()
+    assert not [path for path in checked if detector.layerName in str(path)]
+
+    # a new download of one tile
+    put_tiles(detector, tiles[1:2], seed=1)
+    counts = detector.detect_changes_in_tiles(set(tiles), workers=workers)
+    assert counts["processed"] == 1 and counts["existing"] == 2
+
+    # a change of parameters
+    detector.class_tolerance = 0.05
+    assert detector.detect_changes_in_tiles(set(tiles), workers=workers)["processed"] == 3
+
+
+def test_cleanup_neighbourhood(detector):
+    detector.min_area = 10
+    tiles = [(TILE[0] + i, TILE[1]) for i in range(4)]
+    put_tiles(detector, tiles)
+    assert detector.detect_changes_in_tiles(set(tiles))["processed"] == 4
+    assert detector.detect_changes_in_tiles(set(tiles))["existing"] == 4
+
+    # regions can cross into the tiles either side of the one that changed
+    put_tiles(detector, tiles[:1], seed=1)
+    counts = detector.detect_changes_in_tiles(set(tiles))
+    assert counts["processed"] == 2 and counts["existing"] == 2
+
+    # and the outputs next to the edge of the area depend on the area
+    counts = detector.detect_changes_in_tiles(set(tiles[:3]))
+    assert counts["processed"] == 1 and counts["existing"] == 2
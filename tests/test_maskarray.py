@@ -0,0 +1,78 @@
+import numpy as np
+from osm_changes.config import Config
+from osm_changes.detector import Detector
+from osm_changes.maskarray import MaskArray
+from osm_changes.storage import SQLiteTileStore
+from osm_changes.timeseries import TimeSeriesDetector
+from tests.test_detector import TILE, make_tile
+
+
+def test_packed_tiles_and_windows(tmp_path):
+    filepath = str(tmp_path / "mask.npy")
+    rng = np.random.default_rng(3)
+    masks = {(x, y): rng.random((256, 256)) < 0.3 for x in range(10, 13) for y in range(4, 6)}
+    array = MaskArray.create(filepath, range(10, 13), range(4, 6), 16, release_every=2)
+    for tile, mask in masks.items():
+        array.write_tile(tile, mask)
+    array.close()
+    assert array.array.shape == (512, 3 * 256 // 8)
+
+    array = MaskArray.open(filepath)
+    full = np.block([[masks[(x, y)] for x in range(10, 13)] for y in range(4, 6)])
+    assert np.array_equal(array.tile((11, 5)), masks[(11, 5)])
+    assert np.array_equal(array.window(slice(200, 300), slice(250, 531)), full[200:300, 250:531])
+    assert np.array_equal(np.unpackbits(np.load(filepath, mmap_mode="r"), axis=1).astype(bool), full)
+
+
+def test_detector_mask_array(tmp_path):
+    cfg = Config()
+    cfg.set_output_dir(str(tmp_path))
+    cfg.output = "png"
+    cfg.mask_array = True
+    cfg.layers = [cfg.layer1, cfg.layer2]
+    store = SQLiteTileStore(str(tmp_path / "tiles.sqlite"))
+    detector = TimeSeriesDetector(cfg, store=store)
+    tiles = [TILE, (TILE[0] + 2, TILE[1])]
+    after = np.zeros((256, 256), dtype=bool)
+    after[10:20, 30:50] = True
+    for tile in tiles:
+        store.put(cfg.layer1, cfg.zoom, *tile, make_tile(np.zeros((256, 256), dtype=bool)))
+        store.put(cfg.layer2, cfg.zoom, *tile, make_tile(after))
+
+    detector.detect_changes_in_tiles(set(tiles))
+    array = MaskArray.open(str(tmp_path / f"{detector.layerName}.npy"))
+    # layer indices aren't packed, and windows are views onto the file
+    assert not array.packed and array.array.shape == (256, 3 * 256)
+    assert np.array_equal(array.tile(tiles[1]), after.astype(np.uint8))
+    assert not array.tile((TILE[0] + 1, TILE[1])).any()
+    assert np.shares_memory(array.window(slice(0, 10), slice(0, 10)), array.array)
+    store.close()
+
+
+def test_rerun_keeps_existing_tiles(tmp_path):
+    cfg = Config()
+    cfg.set_output_dir(str(tmp_path))
+    cfg.output = "png"
+    cfg.mask_array = True
+    store = SQLiteTileStore(str(tmp_path / "tiles.sqlite"))
+    detector = Detector(cfg, store=store)
+    after = np.zeros((256, 256), dtype=bool)
+    after[10:20, 30:50] = True
+    other = (TILE[0] + 2, TILE[1] + 1)
+    for tile in (TILE, other):
+        store.put(cfg.layer1, cfg.zoom, *tile, make_tile(np.zeros((256, 256), dtype=bool)))
+        store.put(cfg.layer2, cfg.zoom, *tile, make_tile(after))
+    filepath = str(tmp_path / f"{detector.layerName}.npy")
+
+    detector.detect_changes_in_tiles({TILE})
+    assert MaskArray.open(filepath).tile(TILE).sum() == 200
+    # the tile's output exists so it isn't detected again, but keeps its place in the array
+    assert detector.detect_changes_in_tiles({TILE})["existing"] == 1
+    assert MaskArray.open(filepath).tile(TILE).sum() == 200
+
+    # and the array grows to take in tiles outside it
+    detector.detect_changes_in_tiles({TILE, other})
+    array = MaskArray.open(filepath)
+    assert array.array.shape == (2 * 256, 3 * 256 // 8)
+    assert array.tile(TILE).sum() == 200 and array.tile(other).sum() == 200
+    store.close()
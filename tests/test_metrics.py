@@ -0,0 +1,46 @@
+import json
+import numpy as np
+import pytest
+from osm_changes.metrics import Metrics
+
+
+def test_disabled_metrics_record_nothing():
+    metrics = Metrics()
+    with metrics.timer("decode"):
+        pass
+    metrics.count("download_bytes", 10)
+    assert metrics.summary()["timers"] == {} and metrics.summary()["counters"] == {}
+    assert metrics.drain() is None
+
+
+def test_quantiles():
+    metrics = Metrics(enabled=True)
+    latencies = np.random.default_rng(0).lognormal(np.log(0.01), 1.0, size=5000)
+    for seconds in latencies:
+        metrics.observe("download", float(seconds))
+    timer = metrics.summary()["timers"]["download"]
+    assert timer["count"] == 5000
+    assert timer["p50_seconds"] == pytest.approx(np.percentile(latencies, 50), rel=0.1)
+    assert timer["p95_seconds"] == pytest.approx(np.percentile(latencies, 95), rel=0.1)
+    assert timer["max_seconds"] == pytest.approx(latencies.max())
+
+
+def test_merge_and_write(tmp_path):
+    parent = Metrics(enabled=True)
+    worker = Metrics(enabled=True)
+    parent.count("download_bytes", 100)
+    worker.count("download_bytes", 50)
+    worker.observe("detect", 0.002)
+    parent.merge(worker.drain())
+    assert worker.summary()["counters"] == {}
+
+    parent.write_json(str(tmp_path / "metrics.json"))
+    with open(tmp_path / "metrics.json") as f:
+        summary = json.load(f)
+    assert summary["counters"]["download_bytes"] == 150
+    assert summary["timers"]["detect"]["count"] == 1
+
+    parent.write_prometheus(str(tmp_path / "metrics.prom"))
+    text = (tmp_path / "metrics.prom").read_text()
+    assert "osm_changes_download_bytes_total 150" in text
+    assert 'osm_changes_stage_seconds_count{stage="detect"} 1' in text
@@ -0,0 +1,47 @@
+import numpy as np
+import rasterio
+from osm_changes.coordinates import tile_mercator_bounds
+from osm_changes.mosaic import MosaicWriter
+
+
+def test_mosaic_writer(tmp_path):
+    filepath = str(tmp_path / "mosaic.tif")
+    zoom = 16
+    tiles = [(32449 + i, 21776 + j) for i in range(3) for j in range(2)]
+    rng = np.random.default_rng(3)
+    masks = {tile: rng.random((256, 256)) < 0.1 for tile in tiles}
+
+    with MosaicWriter.for_tiles(filepath, tiles, zoom) as writer:
+        for tile in tiles:
+            writer.write_tile(tile, masks[tile])
+
+    with rasterio.open(filepath) as dataset:
+        assert dataset.crs.to_epsg() == 3857
+        assert (dataset.width, dataset.height) == (3 * 256, 2 * 256)
+        assert dataset.block_shapes[0] == (256, 256)
+        assert dataset.compression.name.upper() == "DEFLATE"
+        assert dataset.overviews(1) == [2]
+
+        # the mosaic covers exactly the tiles' mercator bounds
+        west, _, _, north = tile_mercator_bounds(32449, 21776, zoom)
+        _, south, east, _ = tile_mercator_bounds(32451, 21777, zoom)
+        assert np.allclose(dataset.bounds, (west, south, east, north))
+
+        data = dataset.read(1)
+        for (x, y), mask in masks.items():
+            window = data[(y - 21776) * 256 : (y - 21775) * 256, (x - 32449) * 256 : (x - 32448) * 256]
+            assert np.array_equal(window == 255, mask)
+
+
+def test_code_overviews_are_not_averaged(tmp_path):
+    filepath = str(tmp_path / "codes.tif")
+    tiles = [(32449 + i, 21776) for i in range(2)]
+    # a checkerboard of two codes, whose average would be a third
+    codes = np.where(np.indices((256, 256)).sum(axis=0) % 2, 3, 7).astype(np.uint8)
+    with MosaicWriter.for_tiles(filepath, tiles, 16, resampling="nearest") as writer:
+        for tile in tiles:
+            writer.write_tile(tile, codes)
+
+    with rasterio.open(filepath) as dataset:
+        overview = dataset.read(1, out_shape=(128, 256))
+    assert set(np.unique(overview)) <= {3, 7}
@@ -0,0 +1,158 @@
+import os
+import random
+import time
+import numpy as np
+import pytest
+import requests_mock
+from osm_changes.config import Config
+from osm_changes.downloader import layer_urls
+from osm_changes.pipeline import Pipeline
+from osm_changes.storage import SQLiteTileStore
+from osm_changes.vector import read_features
+from tests.test_detector import make_tile
+
+
+@pytest.mark.parametrize("detect_workers", [1, 2])
+def test_pipeline(tmp_path, detect_workers):
+    cfg = Config()
+    cfg.set_output_dir(str(tmp_path))
+    cfg.output = "cog"
+    cfg.download_workers = 3
+    cfg.detect_workers = detect_workers
+    cfg.pipeline_queue_size = 2
+    store = SQLiteTileStore(str(tmp_path / "tiles.sqlite"))
+    pipeline = Pipeline(cfg, store=store)
+
+    tiles = [(32449 + i, 21776 + j) for i in range(4) for j in range(3)]
+    rng = np.random.default_rng(5)
+    tile_data = {}
+    with requests_mock.Mocker() as m:
+        for layer in [cfg.layer1, cfg.layer2]:
+            for x, y in tiles:
+                tile_data[layer, x, y] = make_tile(rng.random((256, 256)) < 0.5)
+                m.get(f"{layer_urls[layer]}{cfg.zoom}/{x}/{y}.png", content=tile_data[layer, x, y])
+        # one tile is missing from the server
+        missing = (32453, 21776)
+        m.get(f"{layer_urls[cfg.layer1]}{cfg.zoom}/{missing[0]}/{missing[1]}.png", status_code=404)
+
+        counts = pipeline.run(set(tiles + [missing]))
+
+    assert counts["processed"] == len(tiles)
+    assert counts["failed"] == 1 and pipeline.failed_tiles[0][0] == missing
+
+    # downloaded tiles were stored, and the mosaic matches detecting each tile separately
+    import rasterio
+
+    with rasterio.open(pipeline.detector.mosaic_filepath()) as dataset:
+        data = dataset.read(1) == 255
+    for x, y in tiles:
+        assert store.get(cfg.layer1, cfg.zoom, x, y) == tile_data[cfg.layer1, x, y]
+        window = data[(y - 21776) * 256 : (y - 21775) * 256, (x - 32449) * 256 : (x - 32448) * 256]
+        assert np.array_equal(window, pipeline.detector.detect_changes_in_tile((x, y)))
+    store.close()
+
+
+def test_pipeline_manifest(tmp_path):
+    cfg = Config()
+    cfg.set_output_dir(str(tmp_path))
+    cfg.output = "png"
+    cfg.manifest = True
+    store = SQLiteTileStore(str(tmp_path / "tiles.sqlite"))
+    tiles = [(32449 + i, 21776) for i in range(3)]
+    rng = np.random.default_rng(6)
+    for x, y in tiles:
+        store.put(cfg.layer1, cfg.zoom, x, y, make_tile(rng.random((256, 256)) < 0.5))
+        store.put(cfg.layer2, cfg.zoom, x, y, make_tile(rng.random((256, 256)) < 0.5))
+    # the stored tiles are fresh, so nothing is downloaded
+    cfg.layer_max_age = {"default": None}
+
+    assert Pipeline(cfg, store=store).run(set(tiles))["processed"] == 3
+    assert Pipeline(cfg, store=store).run(set(tiles))["existing"] == 3
+    store.put(cfg.layer2, cfg.zoom, *tiles[0], make_tile(np.zeros((256, 256), dtype=bool)))
+    counts = Pipeline(cfg, store=store).run(set(tiles))
+    assert counts["processed"] == 1 and counts["existing"] == 2
+
+    # with min_area every tile is detected, as a tile's output depends on its neighbours, but only the outputs
+    # whose neighbourhood changed are written again
+    cfg.min_area = 10
+    cfg.download_workers = 1
+    assert Pipeline(cfg, store=store).run(set(tiles))["processed"] == 3
+    store.put(cfg.layer2, cfg.zoom, *tiles[0], make_tile(np.ones((256, 256), dtype=bool)))
+    pipeline = Pipeline(cfg, store=store)
+    counts = pipeline.run(set(tiles))
+    assert counts["processed"] == 2 and counts["existing"] == 1
+
+    # the kept output is the same as detecting everything again from scratch
+    outputs = [pipeline.detector.output_filepath(tile) for tile in tiles]
+    written = [open(path, "rb").read() for path in outputs]  # type: ignore
+    for path in outputs + [str(tmp_path / cfg.manifest_path)]:
+        os.remove(path)  # type: ignore
+    Pipeline(cfg, store=store).run(set(tiles))
+    assert [open(path, "rb").read() for path in outputs] == written  # type: ignore
+    store.close()
+
+
+def test_pipeline_stage_errors(tmp_path):
+    cfg = Config()
+    cfg.set_output_dir(str(tmp_path))
+    cfg.output = "png"
+    cfg.download_workers = 2
+    cfg.layer_max_age = {}
+    store = SQLiteTileStore(str(tmp_path / "tiles.sqlite"))
+    tiles = [(32449 + i, 21776) for i in range(4)]
+    for x, y in tiles:
+        store.put(cfg.layer1, cfg.zoom, x, y, make_tile(np.zeros((256, 256), dtype=bool)))
+        store.put(cfg.layer2, cfg.zoom, x, y, make_tile(np.eye(256, dtype=bool)))
+    pipeline = Pipeline(cfg, store=store)
+    output_exists = pipeline.detector.output_exists
+
+    def broken_output_exists(tile):
+        if tile == tiles[1]:
+            raise OSError("disk on fire")
+        return output_exists(tile)
+
+    pipeline.detector.output_exists = broken_output_exists  # type: ignore
+    # a tile that fails in the detect stage itself is also counted rather than stopping the run
+    try_process_tile = pipeline.detector.try_process_tile
+
+    def broken_try_process_tile(tile, data=None):
+        if tile == tiles[2]:
+            raise RuntimeError("pool broke")
+        return try_process_tile(tile, data)
+
+    pipeline.detector.try_process_tile = broken_try_process_tile  # type: ignore
+    counts = pipeline.run(set(tiles))
+    assert counts["processed"] == 2 and counts["failed"] == 2
+    assert sorted(tile for tile, _ in pipeline.failed_tiles) == tiles[1:3]
+    store.close()
+
+
+def test_pipeline_geojson(tmp_path):
+    cfg = Config()
+    cfg.set_output_dir(str(tmp_path))
+    cfg.output = "geojson"
+    cfg.download_workers = 4
+    cfg.layer_max_age = {}
+    store = SQLiteTileStore(str(tmp_path / "tiles.sqlite"))
+    tiles = [(32449 + i, 21776 + j) for i in range(4) for j in range(4)]
+    rng = np.random.default_rng(7)
+    for x, y in tiles:
+        store.put(cfg.layer1, cfg.zoom, x, y, make_tile(np.zeros((256, 256), dtype=bool)))
+        store.put(cfg.layer2, cfg.zoom, x, y, make_tile(rng.random((256, 256)) < 0.05))
+    pipeline = Pipeline(cfg, store=store)
+    fetch = pipeline.fetch
+
+    def slow_fetch(job):
+        # so the fetch threads finish their tiles out of order
+        time.sleep(random.random() * 0.02)
+        return fetch(job)
+
+    pipeline.fetch = slow_fetch  # type: ignore
+    assert pipeline.run(set(tiles))["processed"] == len(tiles)
+    filepath = pipeline.detector.config.resolve_output_path(pipeline.detector.layerName + ".geojsonl")
+    features = read_features(filepath)
+
+    # the same polygons as detecting the tiles one after another
+    pipeline.detector.detect_changes_in_tiles(set(tiles))
+    assert sorted(map(str, features)) == sorted(map(str, read_features(filepath)))
+    store.close()
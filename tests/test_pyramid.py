@@ -0,0 +1,81 @@
+import os
+import numpy as np
+from PIL import Image as PILImage  # type: ignore
+from osm_changes.config import Config
+from osm_changes.detector import Detector
+from osm_changes.pyramid import PyramidWriter
+from osm_changes.storage import SQLiteTileStore
+from tests.test_detector import TILE, make_tile
+
+ZOOM = 16
+
+
+def read_density(writer: PyramidWriter, x: int, y: int, zoom: int) -> np.ndarray:
+    with PILImage.open(writer.path(x, y, zoom)) as image:
+        return np.asarray(image)
+
+
+def test_levels_are_aggregated_2x2(tmp_path):
+    cfg = Config()
+    cfg.set_output_dir(str(tmp_path))
+    mask = np.zeros((256, 256), dtype=bool)
+    mask[:2, :2] = True
+    mask[2, 2] = True
+
+    with_changes = PyramidWriter("test", ZOOM, ZOOM - 2)
+    with_changes.write_tile((40, 20), mask)
+    with_changes.write_tile((41, 20), np.zeros((256, 256), dtype=bool))
+    with_changes.close()
+
+    assert read_density(with_changes, 40, 20, ZOOM)[0, 0] == 255
+    # the empty tile isn't written
+    assert not os.path.exists(with_changes.path(41, 20, ZOOM))
+    level1 = read_density(with_changes, 20, 10, ZOOM - 1)
+    assert level1[0, 0] == 255 and level1[1, 1] == 64 and level1[1:, :].sum() + level1[:, 1:].sum() == 128
+    level2 = read_density(with_changes, 10, 5, ZOOM - 2)
+    assert level2[0, 0] == (255 + 64 + 2) // 4
+    assert level2[1:, :].sum() == 0 and level2[:, 1:].sum() == 0
+
+
+def test_only_changed_tiles_are_rebuilt(tmp_path):
+    cfg = Config()
+    cfg.set_output_dir(str(tmp_path))
+    mask = np.zeros((256, 256), dtype=bool)
+    mask[100:110, 100:110] = True
+    writer = PyramidWriter("test", ZOOM, ZOOM - 3)
+    for tile in [(8, 8), (15, 15)]:
+        writer.write_tile(tile, mask)
+    writer.close()
+    far_corner = writer.path(7, 7, ZOOM - 1)
+    mtime = os.path.getmtime(far_corner)
+    os.utime(far_corner, (mtime - 100, mtime - 100))
+
+    # rewriting a tile with the same mask changes nothing, removing the changes from one clears the tiles above it
+    writer = PyramidWriter("test", ZOOM, ZOOM - 3)
+    writer.write_tile((15, 15), mask)
+    writer.write_tile((8, 8), np.zeros((256, 256), dtype=bool))
+    assert writer._dirty == {(4, 4)}
+    writer.close()
+    assert os.path.getmtime(far_corner) == mtime - 100
+    assert not os.path.exists(writer.path(4, 4, ZOOM - 1))
+    assert not os.path.exists(writer.path(2, 2, ZOOM - 2))
+    assert read_density(writer, 1, 1, ZOOM - 3).any()
+
+
+def test_detector_pyramid(tmp_path):
+    cfg = Config()
+    cfg.set_output_dir(str(tmp_path))
+    cfg.pyramid = True
+    cfg.pyramid_min_zoom = ZOOM - 1
+    store = SQLiteTileStore(str(tmp_path / "tiles.sqlite"))
+    detector = Detector(cfg, store=store)
+    after = np.zeros((256, 256), dtype=bool)
+    after[10:20, 30:50] = True
+    store.put(cfg.layer1, cfg.zoom, *TILE, make_tile(np.zeros((256, 256), dtype=bool)))
+    store.put(cfg.layer2, cfg.zoom, *TILE, make_tile(after))
+
+    detector.detect_changes_in_tiles({TILE})
+    writer = PyramidWriter(f"{detector.layerName}Density", ZOOM, ZOOM - 1)
+    assert np.array_equal(read_density(writer, *TILE, ZOOM) > 0, after)
+    assert read_density(writer, TILE[0] // 2, TILE[1] // 2, ZOOM - 1).sum() == 255 * 50
+    store.close()
@@ -0,0 +1,126 @@
+import io
+import threading
+import time
+import urllib.error
+import urllib.request
+import numpy as np
+import pytest
+from osm_changes.config import Config
+from osm_changes.server import ChangeTileServer, TileHTTPServer
+from osm_changes.storage import SQLiteTileStore
+from tests.test_detector import TILE, make_tile
+
+
+@pytest.fixture
+def tiles(tmp_path):
+    cfg = Config()
+    cfg.set_output_dir(str(tmp_path))
+    cfg.layer_max_age = {}
+    store = SQLiteTileStore(str(tmp_path / "tiles.sqlite"))
+    after = np.zeros((256, 256), dtype=bool)
+    after[10:20, 30:50] = True
+    store.put(cfg.layer1, cfg.zoom, *TILE, make_tile(np.zeros((256, 256), dtype=bool)))
+    store.put(cfg.layer2, cfg.zoom, *TILE, make_tile(after))
+    server = ChangeTileServer(cfg, store=store, cache_size=2, cache_dir=str(tmp_path / "cache"))
+    yield server
+    server.close()
+
+
+def decode(data: bytes) -> np.ndarray:
+    from PIL import Image as PILImage
+
+    return np.asarray(PILImage.open(io.BytesIO(data)).convert("RGBA"))
+
+
+def test_http_tiles(tiles):
+    server = TileHTTPServer(("127.0.0.1", 0), tiles)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        host, port = server.server_address[:2]
+        cfg = tiles.cfg
+        url = f"http://{host}:{port}/{cfg.layer1}/{cfg.layer2}/Building/{cfg.zoom}/{TILE[0]}/{TILE[1]}.png"
+        with urllib.request.urlopen(url) as response:
+            assert response.headers["Content-Type"] == "image/png"
+            rgba = decode(response.read())
+        # changed pixels are red, the rest transparent
+        assert (rgba[..., 3] > 0).sum() == 200
+        assert tuple(rgba[15, 40]) == (255, 0, 0, 255)
+
+        for path in [f"/{cfg.layer1}/000000/Building/16/0/0.png", f"/{cfg.layer1}/{cfg.layer2}/Sea/16/0/0.png", "/x"]:
+            with pytest.raises(urllib.error.HTTPError) as error:
+                urllib.request.urlopen(f"http://{host}:{port}{path}")
+            assert error.value.code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_requests_are_coalesced_and_cached(tiles, monkeypatch):
+    calls = []
+    original = tiles.make_tile
+
+    def slow_make_tile(*key):
+        calls.append(key)
+        time.sleep(0.2)
+        return original(*key)
+
+    monkeypatch.setattr(tiles, "make_tile", slow_make_tile)
+    cfg = tiles.cfg
+    key = (cfg.layer1, cfg.layer2, "Building", cfg.zoom, *TILE)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(tiles.tile(*key))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1 and len(set(results)) == 1
+
+    # tiles with no source tiles are empty, and the least recently used tile drops out of memory
+    empty = [(cfg.layer1, cfg.layer2, "Building", cfg.zoom, TILE[0] + i, TILE[1]) for i in (1, 2)]
+    for other in empty:
+        tiles.store.put_missing(cfg.layer1, *other[3:])
+        tiles.store.put_missing(cfg.layer2, *other[3:])
+        assert not decode(tiles.tile(*other))[..., 3].any()
+    assert not any(cached[1:] == key for cached in tiles._cache)
+    # but it's still on disk
+    assert tiles.tile(*key) == results[0]
+    assert len(calls) == 3
+
+
+def test_cache_follows_settings_and_max_age(tiles, monkeypatch):
+    cfg = tiles.cfg
+    key = (cfg.layer1, cfg.layer2, "Building", cfg.zoom, *TILE)
+    made = []
+    original = tiles.make_tile
+    monkeypatch.setattr(tiles, "make_tile", lambda *key: made.append(key) or original(*key))
+    tiles.tile(*key)
+
+    # a server restarted with the same settings finds the tile on disk
+    restarted = ChangeTileServer(cfg, store=tiles.store, cache_dir=tiles.cache_dir)
+    monkeypatch.setattr(restarted, "make_tile", lambda *key: made.append(key) or original(*key))
+    restarted.tile(*key)
+    assert len(made) == 1
+
+    # or with settings that only change how runs write their outputs
+    cfg.output, cfg.min_area, cfg.skip_unchanged = "tiff", 10, True
+    other_outputs = ChangeTileServer(cfg, store=tiles.store, cache_dir=tiles.cache_dir)
+    monkeypatch.setattr(other_outputs, "make_tile", lambda *key: made.append(key) or original(*key))
+    other_outputs.tile(*key)
+    assert len(made) == 1
+
+    # but not after the detection settings change
+    cfg.initial_label = "Building"
+    changed = ChangeTileServer(cfg, store=tiles.store, cache_dir=tiles.cache_dir)
+    monkeypatch.setattr(changed, "make_tile", lambda *key: made.append(key) or original(*key))
+    changed.tile(*key)
+    assert len(made) == 2
+
+    # tiles of layers with a max age are made again once they're older than it
+    tiles.downloader.layer_max_age = {cfg.layer2: 0.1}
+    tiles.tile(*key)
+    assert len(made) == 2
+    time.sleep(0.2)
+    monkeypatch.setattr(tiles.downloader, "read_tile", tiles.store.get)
+    tiles.tile(*key)
+    assert len(made) == 3
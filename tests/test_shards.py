@@ -0,0 +1,102 @@
+import time
+import numpy as np
+import pytest
+from osm_changes.config import Config
+from osm_changes.shards import ShardQueue, check_shardable, work
+from osm_changes.storage import SQLiteTileStore
+from tests.test_detector import TILE, make_tile
+
+
+def test_shards_are_aligned_blocks(tmp_path):
+    tiles = {(x, y) for x in range(10, 20) for y in range(5, 9)}
+    with ShardQueue(str(tmp_path / "shards.sqlite")) as queue:
+        assert queue.create(tiles, 16, shard_size=8) == 4
+        # the same area again adds nothing
+        assert queue.create(tiles, 16, shard_size=8) == 0
+        shards = [queue.claim("worker") for _ in range(4)]
+        assert queue.claim("worker") is None
+        assert set().union(*(shard.tiles() for shard in shards)) == tiles
+        assert (shards[0].min_x, shards[0].min_y, shards[0].max_x, shards[0].max_y) == (10, 5, 15, 7)
+        assert queue.status() == {"pending": 0, "running": 4, "done": 0, "failed": 0}
+
+
+def test_leases(tmp_path):
+    filepath = str(tmp_path / "shards.sqlite")
+    with ShardQueue(filepath, lease_seconds=0.2, max_attempts=2) as queue:
+        queue.create({(0, 0)}, 16, shard_size=8)
+        shard = queue.claim("crashed")
+        assert shard is not None and shard.attempts == 1
+        with ShardQueue(filepath) as other:
+            assert other.claim("other") is None
+
+        # the crashed worker's lease runs out, and the shard goes to the next worker
+        time.sleep(0.3)
+        assert queue.status()["pending"] == 1
+        retried = queue.claim("other")
+        assert retried is not None and retried.attempts == 2
+        assert not queue.renew(shard, "crashed")
+        queue.complete(shard, "crashed", {"processed": 1})
+        assert queue.status()["running"] == 1
+
+        queue.fail(retried, "other", "RuntimeError: failed")
+        assert queue.status()["failed"] == 1
+        assert queue.claim("other") is None
+        assert queue.retry_failed() == 1
+        assert queue.claim("other").attempts == 1  # type: ignore
+
+
+def test_work(tmp_path):
+    cfg = Config()
+    cfg.set_output_dir(str(tmp_path))
+    cfg.output = "png"
+    cfg.tile_store = "sqlite"
+    # the tile store is kept on the host rather than in the shared output directory
+    cfg.tile_store_path = str(tmp_path / "host" / "tiles.sqlite")
+    cfg.layer_max_age = {}
+    tiles = {(TILE[0] + i, TILE[1] + j) for i in range(3) for j in range(2)}
+    with SQLiteTileStore(cfg.resolve_output_path(cfg.tile_store_path)) as store:
+        for tile in tiles:
+            store.put(cfg.layer1, cfg.zoom, *tile, make_tile(np.zeros((256, 256), dtype=bool)))
+            store.put(cfg.layer2, cfg.zoom, *tile, make_tile(np.eye(256, dtype=bool)))
+
+    with ShardQueue(str(tmp_path / "shards.sqlite")) as queue:
+        n = queue.create(tiles, cfg.zoom, shard_size=2)
+        assert work(cfg, queue, worker="a", max_shards=1) == 1
+        assert work(cfg, queue, worker="b") == n - 1
+        assert queue.status()["done"] == n
+        processed = queue.connection.execute("SELECT SUM(json_extract(counts, '$.processed')) FROM shards")
+        assert processed.fetchone()[0] == len(tiles)
+
+
+@pytest.mark.parametrize(
+    "option, value",
+    [
+        ("output", "cog"),
+        ("mask_array", True),
+        ("pyramid", True),
+        ("transitions", True),
+        ("min_area", 10),
+        ("tile_store", "sqlite"),
+        ("manifest", True),
+        ("layer_max_age", {"201610": 86400}),
+    ],
+)
+def test_unshardable_options(tmp_path, option, value):
+    cfg = Config()
+    cfg.set_output_dir(str(tmp_path))
+    cfg.output = "png"
+    cfg.tile_store = "directory"
+    cfg.layer_max_age = {}
+    setattr(cfg, option, value)
+    with pytest.raises(ValueError), ShardQueue(str(tmp_path / "shards.sqlite")) as queue:
+        work(cfg, queue)
+
+
+def test_metadata_on_each_hosts_disk(tmp_path):
+    cfg = Config()
+    cfg.set_output_dir(str(tmp_path))
+    cfg.output = "png"
+    cfg.tile_store = "directory"
+    cfg.layer_max_age = {cfg.layer2: 86400}
+    cfg.tile_metadata_path = str(tmp_path / "local" / "tile_metadata.sqlite")
+    check_shardable(cfg)
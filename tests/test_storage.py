@@ -0,0 +1,109 @@
+import os
+import pytest
+from osm_changes.config import Config
+from osm_changes.storage import DirectoryTileStore, SQLiteTileStore, open_tile_store, tile_hash
+
+
+def check_store(store):
+    assert store.get("201610", 16, 32449, 21776) is None
+    assert not store.has("201610", 16, 32449, 21776)
+
+    store.put("201610", 16, 32449, 21776, b"tile one")
+    store.put_many([("201610", 16, 32450, 21776, b"tile two"), ("202310", 16, 32449, 21776, b"tile three")])
+
+    assert store.has("201610", 16, 32449, 21776)
+    assert store.get("201610", 16, 32449, 21776) == b"tile one"
+    assert store.get("201610", 16, 32450, 21776) == b"tile two"
+    assert store.get("202310", 16, 32449, 21776) == b"tile three"
+    # different zoom is a different tile
+    assert store.get("201610", 15, 32449, 21776) is None
+
+    # replacing a tile overwrites it
+    store.put("201610", 16, 32449, 21776, b"tile one again")
+    assert store.get("201610", 16, 32449, 21776) == b"tile one again"
+
+    # identical tiles share their data, replacing one leaves the others alone
+    store.put_many([("201610", 16, 1, 1, b"sea"), ("201610", 16, 1, 2, b"sea")])
+    store.put("201610", 16, 1, 1, b"land")
+    assert store.get("201610", 16, 1, 1) == b"land"
+    assert store.get("201610", 16, 1, 2) == b"sea"
+
+    assert not store.is_missing("201610", 16, 5, 5)
+    store.put_missing("201610", 16, 5, 5)
+    assert store.is_missing("201610", 16, 5, 5)
+    assert not store.has("201610", 16, 5, 5)
+
+    # a tile found after all is no longer missing
+    store.put_missing("201610", 16, 5, 6)
+    store.put("201610", 16, 5, 6, b"late")
+    assert store.has("201610", 16, 5, 6) and not store.is_missing("201610", 16, 5, 6)
+
+
+def test_directory_store(tmp_path, monkeypatch):
+    cfg = Config()
+    cfg.set_output_dir(str(tmp_path))
+    store = DirectoryTileStore()
+    check_store(store)
+    assert (tmp_path / "201610" / "16" / "32449" / "21776.png").exists()
+    store.put_many([("202310", 16, 1, 3, b"sea"), ("202310", 16, 1, 4, b"sea")])
+    assert os.path.samefile(store.path("202310", 16, 1, 3), store.path("202310", 16, 1, 4))
+
+    # copies no tile links to any more are removed
+    blobs = tmp_path / ".blobs"
+    store.put("202310", 16, 1, 5, b"revision 1")
+    store.put("202310", 16, 1, 5, b"revision 2")
+    assert not any(path.read_bytes() == b"revision 1" for path in blobs.rglob("*.png"))
+    assert sum(path.read_bytes() == b"sea" for path in blobs.rglob("*.png")) == 1
+
+    # hashes are looked up rather than read from the tiles again
+    monkeypatch.setattr(store, "get", None)
+    assert store.get_hash("202310", 16, 1, 5) == tile_hash(b"revision 2")
+    assert store.get_hash("202310", 16, 1, 6) is None
+
+
+def test_directory_store_without_hard_links(tmp_path, monkeypatch):
+    cfg = Config()
+    cfg.set_output_dir(str(tmp_path))
+
+    def link(*args):
+        raise OSError("hard links aren't supported")
+
+    monkeypatch.setattr(os, "link", link)
+    store = DirectoryTileStore()
+    check_store(store)
+    # every tile is a copy of its own, with none left under .blobs
+    assert not any((tmp_path / ".blobs").rglob("*.png"))
+
+
+def test_sqlite_store(tmp_path):
+    filepath = str(tmp_path / "tiles.sqlite")
+    with SQLiteTileStore(filepath) as store:
+        check_store(store)
+
+    # tiles persist between connections
+    with SQLiteTileStore(filepath) as store:
+        assert store.get("201610", 16, 32450, 21776) == b"tile two"
+        assert store.is_missing("201610", 16, 5, 5)
+        images = store.connection.execute("SELECT COUNT(*) FROM tile_images WHERE tile_data = ?", (b"sea",))
+        assert images.fetchone()[0] == 1
+        # images no tile uses any more are removed
+        store.put("202310", 16, 1, 5, b"revision 1")
+        store.put_many([("202310", 16, 1, 5, b"revision 2")])
+        images = store.connection.execute("SELECT tile_data FROM tile_images").fetchall()
+        assert (b"revision 1",) not in images and (b"sea",) in images and (b"tile one",) not in images
+
+
+def test_open_tile_store(tmp_path):
+    cfg = Config()
+    cfg.set_output_dir(str(tmp_path))
+    assert isinstance(open_tile_store(cfg), DirectoryTileStore)
+
+    cfg.tile_store = "sqlite"
+    store = open_tile_store(cfg)
+    assert isinstance(store, SQLiteTileStore)
+    assert store.filepath == str(tmp_path / "tiles.sqlite")
+    store.close()
+
+    cfg.tile_store = "zip"
+    with pytest.raises(RuntimeError):
+        open_tile_store(cfg)
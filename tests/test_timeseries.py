@@ -0,0 +1,49 @@
+import numpy as np
+from osm_changes.config import Config
+from osm_changes.counts import read_tile_counts
+from osm_changes.storage import SQLiteTileStore
+from osm_changes.timeseries import TimeSeriesDetector
+from tests.test_detector import make_tile
+
+LAYERS = ["201610", "201710", "201804", "202310"]
+
+
+def test_first_change(tmp_path):
+    cfg = Config()
+    cfg.set_output_dir(str(tmp_path))
+    cfg.output = "png"
+    store = SQLiteTileStore(str(tmp_path / "tiles.sqlite"))
+    detector = TimeSeriesDetector(cfg, layers=LAYERS, store=store)
+    assert detector.layerName == "201610To202310FirstChangeNothingToBuilding"
+
+    # buildings appear in the second layer at rows 0-9, and in the last layer at rows 100-109
+    buildings = np.zeros((256, 256), dtype=bool)
+    tiles = [make_tile(buildings)]
+    buildings = buildings.copy()
+    buildings[0:10] = True
+    tiles += [make_tile(buildings), make_tile(buildings)]
+    buildings = buildings.copy()
+    buildings[100:110] = True
+    tiles.append(make_tile(buildings))
+
+    tile = (32449, 21776)
+    for layer, data in zip(LAYERS, tiles):
+        store.put(layer, cfg.zoom, *tile, data)
+    # a tile that doesn't change at all
+    unchanged_tile = (32450, 21776)
+    for layer in LAYERS:
+        store.put(layer, cfg.zoom, *unchanged_tile, tiles[0])
+
+    epochs = detector.detect_changes_in_tile(tile)
+    assert epochs.dtype == np.uint8
+    assert (epochs[0:10] == 1).all()
+    assert (epochs[100:110] == 3).all()
+    assert (epochs[10:100] == 0).all()
+
+    counts = detector.detect_changes_in_tiles({tile, unchanged_tile})
+    assert counts["processed"] == 1 and counts["unchanged"] == 1
+
+    table = read_tile_counts(str(tmp_path / f"{detector.layerName}_counts.csv"))
+    assert table[tile] == {"no_change": 256 * 236, "201710": 2560, "201804": 0, "202310": 2560}
+    assert table[unchanged_tile]["no_change"] == 256 * 256
+    store.close()
@@ -0,0 +1,52 @@
+import numpy as np
+from osm_changes.config import Config
+from osm_changes.counts import read_tile_counts
+from osm_changes.detector import Detector
+from osm_changes.storage import SQLiteTileStore
+from osm_changes.transitions import TransitionDetector, transition_mask, transition_matrix
+from tests.test_detector import make_tile
+
+
+def test_transitions(tmp_path):
+    cfg = Config()
+    cfg.set_output_dir(str(tmp_path))
+    cfg.output = "png"
+    store = SQLiteTileStore(str(tmp_path / "tiles.sqlite"))
+    detector = TransitionDetector(cfg, store=store)
+    classes = detector.classes
+    assert classes == ["Building", "Nothing", "Text", "Other"]
+
+    rng = np.random.default_rng(6)
+    before = rng.random((256, 256)) < 0.3
+    after = rng.random((256, 256)) < 0.3
+    tile = (32449, 21776)
+    store.put(cfg.layer1, cfg.zoom, *tile, make_tile(before))
+    store.put(cfg.layer2, cfg.zoom, *tile, make_tile(after))
+
+    codes = detector.detect_changes_in_tile(tile)
+    assert codes.dtype == np.uint8
+
+    # every single-transition mask matches running the two-class detector for that pair
+    single = Detector(cfg, store=store)
+    for initial, final in [("Nothing", "Building"), ("Building", "Nothing"), ("Building", "Building")]:
+        single.set_target(initial, final)
+        assert np.array_equal(transition_mask(codes, initial, final, classes), single.detect_changes_in_tile(tile))
+
+    detector.detect_changes_in_tiles({tile})
+    matrix = transition_matrix(read_tile_counts(str(tmp_path / f"{detector.layerName}_counts.csv"))[tile], classes)
+    assert matrix.sum() == 256 * 256
+    assert matrix[1, 0] == (~before & after).sum()
+    assert matrix[0, 1] == (before & ~after).sum()
+    store.close()
+
+
+def test_transitions_skip_unchanged(tmp_path):
+    cfg = Config()
+    cfg.set_output_dir(str(tmp_path))
+    cfg.output = "png"
+    cfg.skip_unchanged = True
+    with SQLiteTileStore(str(tmp_path / "tiles.sqlite")) as store:
+        detector = TransitionDetector(cfg, store=store)
+        data = make_tile(np.random.default_rng(6).random((256, 256)) < 0.3)
+        assert detector.process_tile_bytes((32449, 21776), data, data) == ("skipped", None)
+        assert not (tmp_path / detector.layerName).exists()
@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+from osm_changes.config import Config
+from osm_changes.detector import Detector
+from osm_changes.storage import SQLiteTileStore
+from osm_changes.vector import VectorWriter, read_features
+from tests.test_detector import TILE, make_tile
+
+ZOOM = 16
+
+
+def test_regions_split_across_tiles_are_joined(tmp_path):
+    filepath = str(tmp_path / "changes.geojsonl")
+    masks = {(x, y): np.zeros((256, 256), dtype=bool) for x in range(10, 13) for y in range(20, 22)}
+    # a region crossing the corner of four tiles
+    masks[(10, 20)][250:, 250:] = True
+    masks[(11, 20)][250:, :10] = True
+    masks[(10, 21)][:4, 250:] = True
+    masks[(11, 21)][:4, :10] = True
+    # a region inside a tile
+    masks[(12, 21)][100:110, 100:105] = True
+    # a U shape that only joins up through the next column
+    masks[(11, 20)][10:20, 250:] = True
+    masks[(11, 20)][30:40, 250:] = True
+    masks[(12, 20)][10:40, :3] = True
+
+    with VectorWriter(filepath, ZOOM) as writer:
+        for tile in sorted(masks):
+            writer.write_tile(tile, masks[tile])
+
+    features = read_features(filepath)
+    features = sorted(features, key=lambda feature: feature["properties"]["pixels"])
+    assert [feature["properties"]["pixels"] for feature in features] == [50, 16 * 10, 2 * 10 * 6 + 30 * 3]
+    # the four pieces make a single 16x10 pixel rectangle, with no seams along the tile edges
+    assert len(features[1]["geometry"]["coordinates"][0]) == 5
+    for feature in features:
+        assert feature["geometry"]["type"] == "Polygon"
+        lon, lat = np.array(feature["geometry"]["coordinates"][0]).T
+        assert -180 <= lon.min() and lat.max() <= 90
+
+
+@pytest.mark.parametrize("connectivity", [4, 8])
+def test_connectivity(tmp_path, connectivity):
+    filepath = str(tmp_path / "changes.geojsonl")
+    masks = {(x, y): np.zeros((256, 256), dtype=bool) for x in range(10, 12) for y in range(19, 22)}
+    # pixels touching at a corner, inside a tile, across an edge and across the corners of tiles
+    masks[(10, 20)][100, 100] = masks[(10, 20)][101, 101] = True
+    masks[(10, 20)][50, 255] = masks[(11, 20)][51, 0] = True
+    masks[(10, 20)][255, 255] = masks[(11, 21)][0, 0] = True
+    masks[(10, 20)][0, 255] = masks[(11, 19)][255, 0] = True
+
+    with VectorWriter(filepath, ZOOM, connectivity=connectivity) as writer:
+        for tile in sorted(masks):
+            writer.write_tile(tile, masks[tile])
+
+    pixels = [feature["properties"]["pixels"] for feature in read_features(filepath)]
+    assert sorted(pixels) == ([1] * 8 if connectivity == 4 else [2] * 4)
+
+
+def test_gpkg_output(tmp_path):
+    fiona = pytest.importorskip("fiona")
+    filepath = str(tmp_path / "changes.gpkg")
+    mask = np.zeros((256, 256), dtype=bool)
+    mask[10:20, 30:50] = True
+    with VectorWriter(filepath, ZOOM, output="gpkg") as writer:
+        writer.write_tile(TILE, mask)
+
+    with fiona.open(filepath, layer="changes") as collection:
+        features = list(collection)
+    assert [feature["properties"]["pixels"] for feature in features] == [200]
+    assert features[0]["geometry"]["type"] == "Polygon"
+
+
+def test_tiles_out_of_order(tmp_path):
+    writer = VectorWriter(str(tmp_path / "changes.geojsonl"), ZOOM)
+    writer.write_tile((1, 0), np.zeros((256, 256), dtype=bool))
+    with pytest.raises(ValueError):
+        writer.write_tile((0, 0), np.zeros((256, 256), dtype=bool))
+    writer.close()
+
+
+def test_detector_geojson_output(tmp_path):
+    cfg = Config()
+    cfg.set_output_dir(str(tmp_path))
+    cfg.output = "geojson"
+    store = SQLiteTileStore(str(tmp_path / "tiles.sqlite"))
+    detector = Detector(cfg, store=store)
+    after = np.zeros((256, 256), dtype=bool)
+    after[10:20, 30:50] = True
+    store.put(cfg.layer1, cfg.zoom, *TILE, make_tile(np.zeros((256, 256), dtype=bool)))
+    store.put(cfg.layer2, cfg.zoom, *TILE, make_tile(after))
+
+    detector.detect_changes_in_tiles({TILE})
+    features = read_features(str(tmp_path / f"{detector.layerName}.geojsonl"))
+    assert [feature["properties"]["pixels"] for feature in features] == [200]
+    store.close()